@@ -3,15 +3,20 @@
 ######################################################################
 # DMR Callsign/ID Finder using RadioID API: https://radioid.net/api/ #
 ######################################################################
+import re
 import sys
 import json
+import sqlite3
 import webbrowser
 from csv import DictWriter
-from os import listdir, remove
+from os import listdir, remove, replace
+from os.path import basename, isfile
+from time import sleep, perf_counter
 from urllib.request import urlopen
 
 
-from PyQt5.QtCore import (QRegExp, Qt, QUrl, QThread, pyqtSignal, QPointF)
+from PyQt5.QtCore import (QRegExp, Qt, QUrl, QThread, pyqtSignal, QPointF, QTimer,
+                          QAbstractTableModel, QModelIndex)
 from PyQt5.QtGui import (QColor, QIcon, QRegExpValidator, QCloseEvent,
                          QFont, QPalette, QLinearGradient, QFontDatabase,
                          QPixmap, QGradient)
@@ -21,9 +26,20 @@ from PyQt5.QtWidgets import (QMainWindow, QStatusBar, QMenuBar,
                              QHBoxLayout, QComboBox, QLineEdit, QTableWidget,
                              QPushButton, QFileDialog, QMessageBox, QProgressBar,
                              QTableWidgetItem, QDialog, QApplication, QSplashScreen,
-                             QHeaderView, QLabel)
+                             QHeaderView, QLabel, QTableView)
 from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
 
+import numpy as np
+
+from metrics import METRICS, now_ms
+from registry import Resolver, JoinIndex, DMRID_FILE
+from logtail import LogFollower, tokenize, annotate, POLL_INTERVAL
+from store import RegistryStore
+from blockstore import BLOCK_SUFFIX, dataset_exists
+from analytics import RegistryAnalytics, REPORTS
+from snapshots import record_download, SNAPSHOT_DATASETS, PREVIOUS_SUFFIX
+from sync import DatasetSync, DATASETS, summary as sync_summary
+
 APP_VERSION = "v1.00"
 APP_NAME = "PyRadioID"
 APP_TITLE = f"{APP_NAME} {APP_VERSION}"
@@ -56,6 +72,14 @@ QRZ_BASE_URL = "https://www.qrz.com/db/"
 GRAY_SHADOW = QColor(40, 40, 40)
 DARK_SHADOW = QColor(0, 0, 0)
 LIGHT_SHADOW = QColor(150, 150, 150)
+PROFILE_SEARCHES_LIST = ["1", "5", "10", "20", "50"]
+LAST_HEARD_ROWS = 200
+ALL_REGISTRIES = [("DMR User", "dmr/user/"),
+                  ("DMR Repeater", "dmr/repeater/"),
+                  ("NXDN User", "nxdn/user/"),
+                  ("C+ User", "cplus/user/")]
+MAX_PARALLEL_REQUESTS = 4
+RELATED_HEADERS = ["Relation", "Callsign", "ID", "City", "State", "Country"]
 
 
 def format_combo(combobox):
@@ -85,13 +109,29 @@ class MainWindow(QMainWindow):
         self.network_manager = None
         self.about_window = None
         self.parameter_window = None
+        self.diagnostics_window = None
+        self.last_heard_window = None
+        self.analytics_window = None
         self.current_theme = "Light"
         self.lang = "English"
         self.tooltips = False
-        self.dl_progressbar = None
-        self.downloader = None
+        # file name -> (Downloader, QProgressBar) of the downloads in progress
+        self.downloads = dict()
+        self.sync_worker = None
+        self.sync_progressbars = dict()
+        self.store = None
+        self.store_builder = None
+        self.snapshot_recorders = list()
+        self.joins = None
+        self.join_loader = None
         self.qrz = None
         self.reply_dict = dict()
+        self.query = None
+        self.pending_sources = list()
+        self.source_counts = dict()
+        # replies of an older search are ignored: each one is tagged with the generation that sent it
+        self.search_generation = 0
+        self.replies = list()
 
         # ####### StatusBar
         self.statusbar = QStatusBar(self)
@@ -116,6 +156,9 @@ class MainWindow(QMainWindow):
 
         # Actions
         self.parameter_action = QAction("Parameters")
+        self.diagnostics_action = QAction("Diagnostics")
+        self.last_heard_action = QAction("Last heard from log(s) ..")
+        self.analytics_action = QAction("Registry analytics")
         self.save_as_menu = QMenu("Save results ..")
         self.save_json_action = QAction("in .json")
         self.save_csv_action = QAction("in .csv")
@@ -124,12 +167,17 @@ class MainWindow(QMainWindow):
         self.rptrs_json_action = QAction("rptrs.json")
         self.users_csv_action = QAction("user.csv")
         self.users_json_action = QAction("users.json")
+        self.sync_action = QAction("Sync all datasets")
+        self.build_db_action = QAction("Build local database")
         self.exit_action = QAction("Exit")
 
         self.save_json_action.setDisabled(True)
         self.save_csv_action.setDisabled(True)
 
         self.parameter_action.triggered.connect(self.display_parameter_win)
+        self.diagnostics_action.triggered.connect(self.display_diagnostics_win)
+        self.last_heard_action.triggered.connect(self.display_last_heard_win)
+        self.analytics_action.triggered.connect(self.display_analytics_win)
         self.save_json_action.triggered.connect(self.save_results_json)
         self.save_csv_action.triggered.connect(self.save_results_csv)
         # noinspection PyTypeChecker
@@ -138,18 +186,26 @@ class MainWindow(QMainWindow):
         self.rptrs_json_action.triggered.connect(lambda: self.init_download(RPT_LINK_JSON, "./data_files/rptrs.json"))
         self.users_json_action.triggered.connect(lambda: self.init_download(USER_LINK_JSON, "./data_files/users.json"))
         self.users_csv_action.triggered.connect(lambda: self.init_download(USER_LINK_CSV, "./data_files/user.csv"))
+        self.build_db_action.triggered.connect(self.build_store)
+        self.sync_action.triggered.connect(self.sync_datasets)
 
         self.file_menu.addAction(self.parameter_action)
+        self.file_menu.addAction(self.diagnostics_action)
         self.file_menu.addSeparator()
         self.file_menu.addMenu(self.save_as_menu)
         self.save_as_menu.addAction(self.save_json_action)
         self.save_as_menu.addAction(self.save_csv_action)
         self.file_menu.addSeparator()
         self.file_menu.addMenu(self.dl_files_menu)
+        self.file_menu.addAction(self.build_db_action)
+        self.file_menu.addAction(self.last_heard_action)
+        self.file_menu.addAction(self.analytics_action)
         self.dl_files_menu.addActions([self.dmrid_dat_action,
                                        self.rptrs_json_action,
                                        self.users_csv_action,
                                        self.users_json_action])
+        self.dl_files_menu.addSeparator()
+        self.dl_files_menu.addAction(self.sync_action)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.exit_action)
 
@@ -157,8 +213,12 @@ class MainWindow(QMainWindow):
         self.add_filter_action.triggered.connect(self.add_fiter)
         self.remove_filter_action = QAction("Remove filter")
         self.remove_filter_action.triggered.connect(self.remove_filter)
+        self.local_action = QAction("Search local database")
+        self.local_action.setCheckable(True)
         self.edit_menu.addAction(self.add_filter_action)
         self.edit_menu.addAction(self.remove_filter_action)
+        self.edit_menu.addSeparator()
+        self.edit_menu.addAction(self.local_action)
 
         self.remove_filter_action.setDisabled(True)
 
@@ -166,16 +226,19 @@ class MainWindow(QMainWindow):
         self.dmr_rpt_action = QAction("DMR Repeter")
         self.nxdn_user_action = QAction("NXDN User")
         self.cplus_user_action = QAction("C+ User")
+        self.all_action = QAction("All registries")
 
         self.dmr_user_action.triggered.connect(self.set_dmr_user_mode)
         self.dmr_rpt_action.triggered.connect(self.set_dmr_rpt_mode)
         self.nxdn_user_action.triggered.connect(self.set_nxdn_user_mode)
         self.cplus_user_action.triggered.connect(self.set_cplus_user_mode)
+        self.all_action.triggered.connect(self.set_all_mode)
 
         self.dmr_user_action.setCheckable(True)
         self.dmr_rpt_action.setCheckable(True)
         self.nxdn_user_action.setCheckable(True)
         self.cplus_user_action.setCheckable(True)
+        self.all_action.setCheckable(True)
         self.dmr_user_action.setChecked(True)
 
         self.mode_action_grp = QActionGroup(self.mode_menu)
@@ -183,6 +246,9 @@ class MainWindow(QMainWindow):
         self.dmr_rpt_action.setActionGroup(self.mode_action_grp)
         self.nxdn_user_action.setActionGroup(self.mode_action_grp)
         self.cplus_user_action.setActionGroup(self.mode_action_grp)
+        self.all_action.setActionGroup(self.mode_action_grp)
+        # noinspection PyUnresolvedReferences
+        self.mode_action_grp.triggered.connect(lambda: self.cancel_search())
 
         self.mode_menu.addActions([
             self.dmr_user_action,
@@ -190,6 +256,8 @@ class MainWindow(QMainWindow):
             self.nxdn_user_action,
             self.cplus_user_action
         ])
+        self.mode_menu.addSeparator()
+        self.mode_menu.addAction(self.all_action)
 
         # ####### Central Widget
         self.central_Widget = QWidget()
@@ -253,22 +321,45 @@ class MainWindow(QMainWindow):
         self.input_2_grp.hide()
 
         # ####### Table
-        self.table = QTableWidget()
-        self.table.setColumnCount(6)
-        self.table.setSortingEnabled(False)
-        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(3, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(4, QHeaderView.Stretch)
-        self.table.horizontalHeader().setSectionResizeMode(5, QHeaderView.Stretch)
-        self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                              "State", "Country", "Surname"])
+        self.filter_entry = QLineEdit()
+        self.filter_entry.setAlignment(Qt.AlignCenter)
+        self.filter_entry.setPlaceholderText("Filter results")
+        self.filter_entry.setClearButtonEnabled(True)
+        self.main_layout.addWidget(self.filter_entry)
+
+        self.results = ResultsModel()
+        self.results.set_rows(["Callsign", "ID", "City", "State", "Country", "Surname"], list())
+        self.table = QTableView()
+        self.table.setModel(self.results)
+        self.table.setSortingEnabled(True)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
         self.table.setMinimumHeight(380)
+        self.filter_entry.textChanged.connect(self.filter_results)
         self.main_layout.addWidget(self.table)
         self.shadow_table = QGraphicsDropShadowEffect()
         self.shadow_table.setBlurRadius(SHADOW_BLUR)
         self.table.setGraphicsEffect(self.shadow_table)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.setSelectionMode(QTableView.SingleSelection)
+        # noinspection PyUnresolvedReferences
+        self.table.selectionModel().currentRowChanged.connect(self.show_related)
+        # noinspection PyUnresolvedReferences
+        self.results.modelReset.connect(self.clear_related)
+        # noinspection PyUnresolvedReferences
+        self.results.layoutChanged.connect(self.clear_related)
+
+        # ####### Related records of the selected row
+        self.related_table = QTableWidget()
+        self.related_table.setColumnCount(len(RELATED_HEADERS))
+        self.related_table.setHorizontalHeaderLabels(RELATED_HEADERS)
+        self.related_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.related_table.setMinimumHeight(150)
+        self.related_table.setMaximumHeight(200)
+        self.main_layout.addWidget(self.related_table)
+        self.shadow_related = QGraphicsDropShadowEffect()
+        self.shadow_related.setBlurRadius(SHADOW_BLUR)
+        self.related_table.setGraphicsEffect(self.shadow_related)
 
         # ###### Right Menu
         self.right_menu = QMenu()
@@ -299,25 +390,14 @@ class MainWindow(QMainWindow):
         with open(file_name, "w") as file_path:
             if self.dmr_rpt_action.isChecked():
                 fieldnames = ["callsign", "id", "city", "state", "country", "frequency"]
+            elif self.all_action.isChecked():
+                fieldnames = ["callsign", "id", "city", "state", "country", "surname", "frequency", "source"]
             else:
                 fieldnames = ["callsign", "id", "city", "state", "country", "surname"]
             writer = DictWriter(file_path, fieldnames=fieldnames)
             writer.writeheader()
-            for row in range(0, self.table.rowCount()):
-                if self.dmr_rpt_action.isChecked():
-                    writer.writerow({'callsign': self.table.item(row, 0).text(),
-                                     'id': self.table.item(row, 1).text(),
-                                     'city': self.table.item(row, 2).text(),
-                                     "state": self.table.item(row, 3).text(),
-                                     "country": self.table.item(row, 4).text(),
-                                     "frequency": self.table.item(row, 5).text()})
-                else:
-                    writer.writerow({'callsign': self.table.item(row, 0).text(),
-                                     'id': self.table.item(row, 1).text(),
-                                     'city': self.table.item(row, 2).text(),
-                                     "state": self.table.item(row, 3).text(),
-                                     "country": self.table.item(row, 4).text(),
-                                     "surname": self.table.item(row, 5).text()})
+            for row in range(0, self.results.rowCount()):
+                writer.writerow(self.row_dict(row))
 
     def save_results_json(self):
         # noinspection PyTypeChecker
@@ -332,26 +412,35 @@ class MainWindow(QMainWindow):
 
         result_dict = dict()
         result_list = list()
-        for row in range(0, self.table.rowCount()):
-            user_dict = dict()
-            user_dict["callsign"] = self.table.item(row, 0).text()
-            user_dict["id"] = self.table.item(row, 1).text()
-            user_dict["city"] = self.table.item(row, 2).text()
-            user_dict["state"] = self.table.item(row, 3).text()
-            user_dict["country"] = self.table.item(row, 4).text()
-            if self.dmr_rpt_action.isChecked():
-                user_dict["frequency"] = self.table.item(row, 5).text()
-            else:
-                user_dict["surname"] = self.table.item(row, 5).text()
-
-            result_list.append(user_dict)
+        for row in range(0, self.results.rowCount()):
+            result_list.append(self.row_dict(row))
 
         result_dict["users"] = result_list
 
         with open(file_name, "w") as file_path:
             json.dump(result_dict, file_path, indent=4, sort_keys=True, ensure_ascii=False)
 
+    def row_dict(self, row):
+        values = self.results.row_values(row)
+        user_dict = dict()
+        user_dict["callsign"] = values[0]
+        user_dict["id"] = values[1]
+        user_dict["city"] = values[2]
+        user_dict["state"] = values[3]
+        user_dict["country"] = values[4]
+        if self.all_action.isChecked():
+            user_dict["source"] = values[6]
+        if self.dmr_rpt_action.isChecked() or user_dict.get("source") == "DMR Repeater":
+            user_dict["frequency"] = values[5]
+        else:
+            user_dict["surname"] = values[5]
+        return user_dict
+
     def init_download(self, url, file_name):
+        if file_name in self.downloads or self.sync_worker is not None:
+            self.statusbar.showMessage(f"{file_name} is already being downloaded")
+            return
+
         if file_name.replace("./data_files/", "") in listdir("./data_files"):
             dialog = QMessageBox()
             rep = dialog.question(self,
@@ -360,30 +449,94 @@ class MainWindow(QMainWindow):
                                   f"already in data_files directory.\nWould you like to update it ?",
                                   dialog.Yes | dialog.No)
             if rep == dialog.Yes:
-                remove(file_name)
+                if file_name.replace("./data_files/", "") in SNAPSHOT_DATASETS:
+                    # kept until the snapshot archive has recorded it
+                    replace(file_name, file_name + PREVIOUS_SUFFIX)
+                else:
+                    remove(file_name)
             elif rep == dialog.No:
                 return
 
-        self.dl_progressbar = QProgressBar()
-        self.statusbar.addWidget(self.dl_progressbar, 1)
-        self.downloader = Downloader(url, file_name)
+        progressbar = QProgressBar()
+        progressbar.setFormat(f"{file_name.replace('./data_files/', '')} %p%")
+        self.statusbar.addWidget(progressbar, 1)
+        downloader = Downloader(url, file_name)
         # noinspection PyUnresolvedReferences
-        self.downloader.setTotalProgress.connect(self.dl_progressbar.setMaximum)
+        downloader.setTotalProgress.connect(progressbar.setMaximum)
         # noinspection PyUnresolvedReferences
-        self.downloader.setCurrentProgress.connect(self.dl_progressbar.setValue)
+        downloader.setCurrentProgress.connect(progressbar.setValue)
         # noinspection PyUnresolvedReferences
-        self.downloader.succeeded.connect(self.download_succeeded)
-        self.downloader.finished.connect(lambda: self.download_finished(file_name))
-        self.downloader.start()
+        downloader.succeeded.connect(lambda: self.download_succeeded(file_name))
+        downloader.finished.connect(lambda: self.download_finished(file_name))
+        if file_name.replace("./data_files/", "") in SNAPSHOT_DATASETS:
+            # noinspection PyUnresolvedReferences
+            downloader.succeeded.connect(lambda: self.record_snapshot(file_name))
+        self.downloads[file_name] = (downloader, progressbar)
+        downloader.start()
 
-    def download_succeeded(self):
-        self.dl_progressbar.setValue(self.dl_progressbar.maximum())
+    def download_succeeded(self, file_name):
+        progressbar = self.downloads[file_name][1]
+        progressbar.setValue(progressbar.maximum())
+        if isfile(file_name + BLOCK_SUFFIX):
+            # block store of the replaced copy, the raw file is read first
+            remove(file_name + BLOCK_SUFFIX)
 
     def download_finished(self, file_name):
-        del self.downloader
-        self.statusbar.removeWidget(self.dl_progressbar)
+        _, progressbar = self.downloads.pop(file_name)
+        self.joins = None
+        self.statusbar.removeWidget(progressbar)
         self.statusbar.showMessage(f"{file_name} downloaded with success")
 
+    def sync_datasets(self):
+        if self.sync_worker is not None or self.downloads:
+            self.statusbar.showMessage("Wait for the downloads in progress to finish")
+            return
+        self.sync_action.setDisabled(True)
+        for _, file_name in DATASETS:
+            name = basename(file_name)
+            progressbar = QProgressBar()
+            progressbar.setFormat(f"{name} %p%")
+            self.statusbar.addWidget(progressbar, 1)
+            self.sync_progressbars[name] = progressbar
+        self.sync_worker = SyncWorker()
+        # noinspection PyUnresolvedReferences
+        self.sync_worker.progress.connect(self.sync_progress)
+        # noinspection PyUnresolvedReferences
+        self.sync_worker.synced.connect(self.datasets_synced)
+        self.sync_worker.start()
+
+    def sync_progress(self, name, stage, done, total):
+        progressbar = self.sync_progressbars.get(name)
+        if progressbar is None:
+            return
+        if stage == "download":
+            progressbar.setMaximum(max(total, done, 1))
+            progressbar.setValue(done)
+        elif stage == "index":
+            progressbar.setFormat(f"{name} indexing ..")
+            progressbar.setMaximum(0)
+        else:
+            progressbar.setMaximum(1)
+            progressbar.setValue(1)
+            progressbar.setFormat(f"{name} {stage}")
+
+    def datasets_synced(self, message):
+        for progressbar in self.sync_progressbars.values():
+            self.statusbar.removeWidget(progressbar)
+        self.sync_progressbars = dict()
+        self.sync_worker = None
+        self.joins = None
+        self.sync_action.setEnabled(True)
+        self.statusbar.showMessage(message)
+
+    def record_snapshot(self, file_name):
+        recorder = SnapshotRecorder(file_name)
+        # noinspection PyUnresolvedReferences
+        recorder.recorded.connect(self.statusbar.showMessage)
+        recorder.finished.connect(lambda: self.snapshot_recorders.remove(recorder))
+        self.snapshot_recorders.append(recorder)
+        recorder.start()
+
     def display_parameter_win(self):
         if self.parameter_window is None:
             self.parameter_window = ParameterWindow(self)
@@ -392,6 +545,38 @@ class MainWindow(QMainWindow):
         else:
             pass
 
+    def display_diagnostics_win(self):
+        if self.diagnostics_window is None:
+            self.diagnostics_window = DiagnosticsWindow(self)
+            self.diagnostics_window.show()
+            self.diagnostics_window.resize(self.diagnostics_window.minimumSizeHint())
+        else:
+            pass
+
+    def display_last_heard_win(self):
+        if self.last_heard_window is None:
+            if not dataset_exists(DMRID_FILE):
+                self.statusbar.showMessage("Download dmrid.dat to follow the logs")
+                return
+            # noinspection PyTypeChecker
+            file_names = QFileDialog.getOpenFileNames(self, "MMDVMHost log file(s)",
+                                                      ".", "Log file (*.log);;All files (*)")[0]
+            if not file_names:
+                return
+            self.last_heard_window = LastHeardWindow(self, file_names)
+            self.last_heard_window.show()
+            self.last_heard_window.resize(self.last_heard_window.minimumSizeHint())
+        else:
+            pass
+
+    def display_analytics_win(self):
+        if self.analytics_window is None:
+            self.analytics_window = AnalyticsWindow(self)
+            self.analytics_window.show()
+            self.analytics_window.resize(self.analytics_window.minimumSizeHint())
+        else:
+            pass
+
     def display_about_win(self):
         if self.about_window is None:
             self.about_window = AboutWindow(self)
@@ -427,106 +612,307 @@ class MainWindow(QMainWindow):
             if not self.entry_2.hasAcceptableInput():
                 return
 
-        url = self.make_url()
+        self.cancel_search()
+        if self.all_action.isChecked():
+            self.search_all()
+            return
+
+        if self.local_action.isChecked() \
+                and (self.dmr_user_action.isChecked() or self.dmr_rpt_action.isChecked()):
+            self.search_local()
+            return
+
+        self.query = METRICS.begin_query(self.entry_1.text())
+        with METRICS.span("make_url", self.query):
+            url = self.make_url()
+        self.query.label = url
         self.do_request(url)
         self.statusbar.showMessage(f"{url}")
 
+    def cancel_search(self):
+        """Abort the replies still in flight, their answers would land in the next search"""
+        self.search_generation += 1
+        self.pending_sources = list()
+        replies, self.replies = self.replies, list()
+        for reply in replies:
+            reply.abort()
+
+    def current_reply(self, reply):
+        """False for a reply of an older search, dropped"""
+        if reply.property("generation") != self.search_generation:
+            reply.deleteLater()
+            return False
+        if reply in self.replies:
+            self.replies.remove(reply)
+        return True
+
+    def send_request(self, request):
+        reply = self.network_manager.get(request)
+        reply.setProperty("generation", self.search_generation)
+        self.replies.append(reply)
+        return reply
+
     def do_request(self, url):
         self.network_manager = QNetworkAccessManager()
         request = QNetworkRequest(QUrl(url))
         self.network_manager.finished.connect(self.display_results)
-        self.network_manager.get(request)
+        self.query.begin("net.wait")
+        reply = self.send_request(request)
+        query = self.query
+        reply.metaDataChanged.connect(lambda: self.reply_headers_received(query))
+
+    @staticmethod
+    def reply_headers_received(query):
+        """DNS, TLS and server time end when the headers arrive, the body download starts"""
+        if "net.wait" in query.open_spans:
+            query.end("net.wait")
+            query.begin("net.read")
 
     def display_results(self, reply):
+        if not self.current_reply(reply):
+            return
         error = reply.error()
+        query = self.query
+        if query is not None:
+            query.end("net.wait")
+            query.end("net.read")
 
         if error == QNetworkReply.NoError:
-            rep = reply.readAll()
-            self.reply_dict = json.loads(rep.data().decode("ascii"))
-            self.table.clear()
-            if self.dmr_rpt_action.isChecked():
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Frequency"])
-            else:
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Surname"])
-            self.table.setRowCount(len(self.reply_dict["results"]))
-            i = 0
-            for result in range(0, len(self.reply_dict["results"])):
-                callsign = self.reply_dict["results"][i]["callsign"]
-                dmr_id = self.reply_dict["results"][i]['id']
-                city = self.reply_dict["results"][i]["city"].capitalize()
-                state = self.reply_dict["results"][i]["state"]
-                country = self.reply_dict["results"][i]["country"].capitalize()
-                if self.dmr_rpt_action.isChecked():
-                    surname = self.reply_dict["results"][i]["frequency"]
-                else:
-                    surname = self.reply_dict["results"][i]["surname"]
-
-                col_1 = QTableWidgetItem(callsign)
-                col_2 = QTableWidgetItem(str(dmr_id))
-                col_3 = QTableWidgetItem(city)
-                col_4 = QTableWidgetItem(state)
-                col_5 = QTableWidgetItem(country)
-                col_6 = QTableWidgetItem(surname)
-
-                col_1.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_1.setTextAlignment(Qt.AlignCenter)
-                col_2.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_2.setTextAlignment(Qt.AlignCenter)
-                col_3.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_3.setTextAlignment(Qt.AlignCenter)
-                col_4.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_4.setTextAlignment(Qt.AlignCenter)
-                col_5.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_5.setTextAlignment(Qt.AlignCenter)
-                col_6.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-                col_6.setTextAlignment(Qt.AlignCenter)
-
-                col_1.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-                col_2.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-                col_3.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-                col_4.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-                col_5.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-                col_6.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
-
-                self.table.setItem(i, 0, col_1)
-                self.table.setItem(i, 1, col_2)
-                self.table.setItem(i, 2, col_3)
-                self.table.setItem(i, 3, col_4)
-                self.table.setItem(i, 4, col_5)
-                self.table.setItem(i, 5, col_6)
-                i += 1
-
-            self.statusbar.showMessage(f"Request OK. Result(s): {len(self.reply_dict['results'])}")
-            self.save_json_action.setEnabled(True)
-            self.save_csv_action.setEnabled(True)
+            try:
+                with METRICS.span("parse", query):
+                    rep = reply.readAll()
+                    self.reply_dict = json.loads(rep.data().decode("ascii"))
+                    if not isinstance(self.reply_dict.get("results"), list):
+                        raise ValueError("no results list")
+                self.show_results(query)
+            except Exception as parse_error:
+                # the query is closed either way: an armed profiler must not keep running
+                METRICS.count("parse errors")
+                self.statusbar.showMessage(f"Unreadable reply: {parse_error}")
+                self.reply_dict = dict()
+                self.reset_table()
+                self.save_json_action.setDisabled(True)
+                self.save_csv_action.setDisabled(True)
+                if query is not None:
+                    METRICS.end_query(query)
         else:
             self.statusbar.showMessage(reply.errorString())
-            if self.dmr_user_action.isChecked():
-                self.table.clear()
-                self.table.setRowCount(0)
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Surname"])
-            elif self.dmr_rpt_action.isChecked():
-                self.table.clear()
-                self.table.setRowCount(0)
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Frequency"])
-            elif self.nxdn_user_action.isChecked():
-                self.table.clear()
-                self.table.setRowCount(0)
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Surname"])
-            elif self.cplus_user_action.isChecked():
-                self.table.clear()
-                self.table.setRowCount(0)
-                self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                                      "State", "Country", "Surname"])
+            if query is not None:
+                METRICS.count("network errors")
+                METRICS.end_query(query)
+            self.reset_table()
 
             self.save_json_action.setDisabled(True)
             self.save_csv_action.setDisabled(True)
 
+    def show_results(self, query):
+        if query is not None:
+            query.begin("fill")
+        self.results.set_rows(self.table_headers(), self.make_rows(self.reply_dict["results"]))
+        message = f"Request OK. Result(s): {len(self.reply_dict['results'])}"
+        self.statusbar.showMessage(message)
+        self.save_json_action.setEnabled(True)
+        self.save_csv_action.setEnabled(True)
+        if query is not None:
+            query.end("fill")
+            query.begin("render")
+            QTimer.singleShot(0, lambda: self.query_rendered(query, message))
+
+    def search_filters(self):
+        filters = [(self.choice_1_combo.currentText(), self.entry_1.text())]
+        if not self.input_2_grp.isHidden():
+            filters.append((self.choice_2_combo.currentText(), self.entry_2.text()))
+        return filters
+
+    def search_local(self):
+        if self.store is None:
+            if not RegistryStore.exists():
+                self.statusbar.showMessage("No local database, use Files > Build local database")
+                return
+            self.store = RegistryStore()
+
+        table = "repeater" if self.dmr_rpt_action.isChecked() else "user"
+        filters = self.search_filters()
+        self.query = METRICS.begin_query(f"local {table} {filters}")
+        with METRICS.span("db", self.query):
+            self.reply_dict = self.store.search(table, filters)
+        self.show_results(self.query)
+
+    def build_store(self):
+        if self.store_builder is not None:
+            return
+        self.build_db_action.setDisabled(True)
+        self.statusbar.showMessage("Building the local database ..")
+        self.store_builder = StoreBuilder()
+        # noinspection PyUnresolvedReferences
+        self.store_builder.built.connect(self.store_built)
+        self.store_builder.start()
+
+    def store_built(self, message):
+        self.store_builder = None
+        self.build_db_action.setEnabled(True)
+        self.statusbar.showMessage(message)
+
+    def search_all(self):
+        """Send the query to every registry at once, rows are appended as each reply lands"""
+        self.query = METRICS.begin_query(self.entry_1.text())
+        with METRICS.span("make_url", self.query):
+            query_string = self.make_query()
+        self.query.label = f"all registries {query_string}"
+        self.reset_table()
+        self.reply_dict = {"results": list()}
+        self.source_counts = dict()
+        self.pending_sources = [(source, f"{BASE_URL}{path}{query_string}")
+                                for source, path in ALL_REGISTRIES]
+        self.network_manager = QNetworkAccessManager()
+        self.network_manager.finished.connect(self.display_source_results)
+        for _ in range(0, min(MAX_PARALLEL_REQUESTS, len(self.pending_sources))):
+            self.request_next_source()
+        self.statusbar.showMessage(f"{BASE_URL}*/{query_string}")
+
+    def request_next_source(self):
+        source, url = self.pending_sources.pop(0)
+        request = QNetworkRequest(QUrl(url))
+        self.query.begin(f"net.{source}")
+        reply = self.send_request(request)
+        reply.setProperty("source", source)
+
+    def display_source_results(self, reply):
+        if not self.current_reply(reply):
+            return
+        source = reply.property("source")
+        query = self.query
+        query.end(f"net.{source}")
+
+        if reply.error() == QNetworkReply.NoError:
+            try:
+                with METRICS.span(f"parse.{source}", query):
+                    results = json.loads(reply.readAll().data().decode("ascii")).get("results", list())
+                with METRICS.span(f"fill.{source}", query):
+                    self.results.append_rows(self.make_rows(results, source))
+            except Exception as parse_error:
+                METRICS.count("parse errors")
+                self.source_counts[source] = f"unreadable reply: {parse_error}"
+            else:
+                self.reply_dict["results"] += results
+                self.source_counts[source] = len(results)
+        else:
+            METRICS.count("network errors")
+            self.source_counts[source] = reply.errorString()
+        reply.deleteLater()
+
+        if self.pending_sources:
+            self.request_next_source()
+
+        counts = ", ".join(f"{name}: {count}" for name, count in self.source_counts.items())
+        message = f"Result(s): {len(self.reply_dict['results'])} ({counts})"
+        self.statusbar.showMessage(message)
+        if len(self.source_counts) == len(ALL_REGISTRIES):
+            self.save_json_action.setEnabled(self.results.rowCount() > 0)
+            self.save_csv_action.setEnabled(self.results.rowCount() > 0)
+            query.begin("render")
+            QTimer.singleShot(0, lambda: self.query_rendered(query, f"Request OK. {message}"))
+
+    def make_rows(self, results, source=None):
+        rows = list()
+        for result in results:
+            if self.dmr_rpt_action.isChecked() or source == "DMR Repeater":
+                surname = result.get("frequency", "")
+            else:
+                surname = result.get("surname", "")
+            cells = [result.get("callsign", ""),
+                     str(result.get("id", "")),
+                     (result.get("city") or "").capitalize(),
+                     result.get("state") or "",
+                     (result.get("country") or "").capitalize(),
+                     surname or ""]
+            if source is not None:
+                cells.append(source)
+            rows.append(tuple(cells))
+        return rows
+
+    def table_headers(self):
+        if self.dmr_rpt_action.isChecked():
+            return ["Callsign", "ID", "City", "State", "Country", "Frequency"]
+        elif self.all_action.isChecked():
+            return ["Callsign", "ID", "City", "State", "Country", "Surname / Frequency", "Source"]
+        else:
+            return ["Callsign", "ID", "City", "State", "Country", "Surname"]
+
+    def reset_table(self):
+        self.results.set_rows(self.table_headers(), list())
+
+    def filter_results(self, text):
+        start = now_ms()
+        self.results.set_filter(text)
+        METRICS.histogram("filter").add(now_ms() - start)
+        if text:
+            self.statusbar.showMessage(f"{self.results.rowCount()} / {len(self.results.rows)} result(s) "
+                                       f"match \"{text}\"")
+
+    def show_related(self, current, previous=None):
+        """Fill the related records pane from the join indexes, no request and no scan"""
+        if not current.isValid():
+            self.clear_related()
+            return
+        if self.joins is None:
+            if not dataset_exists(DMRID_FILE):
+                self.statusbar.showMessage("Download dmrid.dat and rptrs.json to see the related records")
+            elif self.join_loader is None:
+                self.statusbar.showMessage("Loading the join indexes ..")
+                self.join_loader = JoinLoader()
+                # noinspection PyUnresolvedReferences
+                self.join_loader.loaded.connect(self.joins_loaded)
+                # noinspection PyUnresolvedReferences
+                self.join_loader.finished.connect(self.join_loader_finished)
+                self.join_loader.start()
+            return
+
+        values = self.results.row_values(current.row())
+        source = values[6] if len(values) > 6 else None
+        if (self.nxdn_user_action.isChecked() or self.cplus_user_action.isChecked()
+                or source not in (None, "DMR User", "DMR Repeater")):
+            # NXDN and C+ IDs are not in dmrid.dat nor rptrs.json
+            self.clear_related()
+            return
+        start = now_ms()
+        repeater = self.dmr_rpt_action.isChecked() or source == "DMR Repeater"
+        try:
+            dmr_id = int(values[1])
+        except ValueError:
+            dmr_id = -1
+        related = self.joins.related(values[0], dmr_id, values[2], values[3], repeater)
+        self.related_table.setUpdatesEnabled(False)
+        self.related_table.setRowCount(len(related))
+        for row, (relation, record) in enumerate(related):
+            cells = [relation, record.get("callsign", ""), str(record["id"]),
+                     record.get("city", ""), record.get("state", ""), record.get("country", "")]
+            for column, text in enumerate(cells):
+                item = QTableWidgetItem(text)
+                item.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
+                item.setTextAlignment(Qt.AlignCenter)
+                self.related_table.setItem(row, column, item)
+        self.related_table.setUpdatesEnabled(True)
+        METRICS.histogram("related").add(now_ms() - start)
+
+    def joins_loaded(self, joins):
+        self.joins = joins
+        self.statusbar.showMessage("Join indexes loaded")
+        self.show_related(self.table.currentIndex())
+
+    def join_loader_finished(self):
+        self.join_loader = None
+
+    def clear_related(self):
+        self.related_table.setRowCount(0)
+
+    def query_rendered(self, query, message):
+        query.end("render")
+        breakdown = METRICS.end_query(query)
+        self.statusbar.showMessage(f"{message}   [{breakdown}]")
+        if self.diagnostics_window is not None:
+            self.diagnostics_window.refresh()
+
     def make_url(self):
         url = BASE_URL
         if self.dmr_user_action.isChecked():
@@ -538,44 +924,45 @@ class MainWindow(QMainWindow):
         elif self.cplus_user_action.isChecked():
             url += "cplus/user/"
 
+        return url + self.make_query()
+
+    def make_query(self):
+        query = ""
         if self.choice_1_combo.currentText() == "DMR ID of a user" \
                 or self.choice_1_combo.currentText() == "DMR Repeater ID":
-            url += f"?id={self.entry_1.text()}"
+            query += f"?id={self.entry_1.text()}"
         elif self.choice_1_combo.currentText() == "DMR user callsign" \
                 or self.choice_1_combo.currentText() == "Repeater callsign":
-            url += f"?callsign={self.entry_1.text()}"
+            query += f"?callsign={self.entry_1.text()}"
         elif self.choice_1_combo.currentText() == "City" \
                 or self.choice_1_combo.currentText() == "Repeater city":
-            url += f"?city={self.entry_1.text()}"
+            query += f"?city={self.entry_1.text()}"
         elif self.choice_1_combo.currentText() == "Country" \
                 or self.choice_1_combo.currentText() == "Repeater country":
-            url += f"?country={self.entry_1.text()}"
+            query += f"?country={self.entry_1.text()}"
 
         if not self.input_2_grp.isHidden():
             if self.choice_2_combo.currentText() == "DMR ID of a user" \
                     or self.choice_2_combo.currentText() == "DMR Repeater ID":
-                url += f"&id={self.entry_2.text()}"
+                query += f"&id={self.entry_2.text()}"
             elif self.choice_2_combo.currentText() == "DMR user callsign" \
                     or self.choice_2_combo.currentText() == "Repeater callsign":
-                url += f"&callsign={self.entry_2.text()}"
+                query += f"&callsign={self.entry_2.text()}"
             elif self.choice_2_combo.currentText() == "City" \
                     or self.choice_2_combo.currentText() == "Repeater city":
-                url += f"&city={self.entry_2.text()}"
+                query += f"&city={self.entry_2.text()}"
             elif self.choice_2_combo.currentText() == "Country" \
                     or self.choice_2_combo.currentText() == "Repeater country":
-                url += f"&country={self.entry_2.text()}"
+                query += f"&country={self.entry_2.text()}"
 
-        return url
+        return query
 
     def set_dmr_user_mode(self):
         self.choice_1_combo.clear()
         self.choice_1_combo.addItems(DMR_USER_COMBO_LIST)
         format_combo(self.choice_1_combo)
         self.entry_1.setPlaceholderText("ID")
-        self.table.clear()
-        self.table.setRowCount(0)
-        self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                              "State", "Country", "Surname"])
+        self.reset_table()
         self.set_regexp(self.entry_1, "1")
         self.set_regexp(self.entry_2, "2")
         self.save_json_action.setDisabled(True)
@@ -586,10 +973,7 @@ class MainWindow(QMainWindow):
         self.choice_1_combo.addItems(DMR_RPT_COMBO_LIST)
         format_combo(self.choice_1_combo)
         self.entry_1.setPlaceholderText("ID")
-        self.table.clear()
-        self.table.setRowCount(0)
-        self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                              "State", "Country", "Frequency"])
+        self.reset_table()
         self.set_regexp(self.entry_1, "1")
         self.set_regexp(self.entry_2, "2")
         self.save_json_action.setDisabled(True)
@@ -600,10 +984,7 @@ class MainWindow(QMainWindow):
         self.choice_1_combo.addItems(DMR_USER_COMBO_LIST)
         format_combo(self.choice_1_combo)
         self.entry_1.setPlaceholderText("ID")
-        self.table.clear()
-        self.table.setRowCount(0)
-        self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                              "State", "Country", "Surname"])
+        self.reset_table()
         self.set_regexp(self.entry_1, "1")
         self.set_regexp(self.entry_2, "2")
         self.save_json_action.setDisabled(True)
@@ -614,10 +995,18 @@ class MainWindow(QMainWindow):
         self.choice_1_combo.addItems(DMR_USER_COMBO_LIST)
         format_combo(self.choice_1_combo)
         self.entry_1.setPlaceholderText("ID")
-        self.table.clear()
-        self.table.setRowCount(0)
-        self.table.setHorizontalHeaderLabels(["Callsign", "ID", "City",
-                                              "State", "Country", "Surname"])
+        self.reset_table()
+        self.set_regexp(self.entry_1, "1")
+        self.set_regexp(self.entry_2, "2")
+        self.save_json_action.setDisabled(True)
+        self.save_csv_action.setDisabled(True)
+
+    def set_all_mode(self):
+        self.choice_1_combo.clear()
+        self.choice_1_combo.addItems(DMR_USER_COMBO_LIST)
+        format_combo(self.choice_1_combo)
+        self.entry_1.setPlaceholderText("ID")
+        self.reset_table()
         self.set_regexp(self.entry_1, "1")
         self.set_regexp(self.entry_2, "2")
         self.save_json_action.setDisabled(True)
@@ -736,6 +1125,299 @@ class Downloader(QThread):
         self.succeeded.emit()
 
 
+class LogTailWorker(QThread):
+    """ Follow log files and emit the resolved events by batch """
+
+    loaded = pyqtSignal(str)
+    heard = pyqtSignal(list)
+
+    def __init__(self, file_names):
+        super().__init__()
+        self._file_names = file_names
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        try:
+            resolver = Resolver.load()
+        except OSError as error:
+            # noinspection PyUnresolvedReferences
+            self.loaded.emit(f"dmrid.dat could not be loaded: {error}")
+            return
+        # noinspection PyUnresolvedReferences
+        self.loaded.emit(f"{len(resolver.index)} DMR IDs loaded")
+        followers = [LogFollower(file_name) for file_name in self._file_names]
+
+        while self._running:
+            batch = list()
+            for follower in followers:
+                for line in follower.read_lines():
+                    event = tokenize(line, follower.file_name)
+                    if event is None:
+                        continue
+                    source, destination = annotate(event, resolver)
+                    batch.append((event, source, destination))
+            if batch:
+                # noinspection PyUnresolvedReferences
+                self.heard.emit(batch)
+            sleep(POLL_INTERVAL)
+
+        for follower in followers:
+            follower.close()
+
+
+def sort_permutation(rows, column):
+    """ Row order of a column: numeric for the ID column, case insensitive for the others """
+    if column == 1:
+        keys = np.array([int(row[1]) if row[1].isdigit() else -1 for row in rows], dtype=np.int64)
+    else:
+        keys = np.array([row[column].casefold() for row in rows])
+    return np.argsort(keys, kind="stable")
+
+
+class SortKeysWorker(QThread):
+    """ Compute the sort permutation of every column of a result set """
+
+    computed = pyqtSignal(int, object)
+
+    def __init__(self, generation, rows, columns):
+        super().__init__()
+        self._generation = generation
+        self._rows = rows
+        self._columns = columns
+
+    def run(self):
+        permutations = dict()
+        for column in range(0, self._columns):
+            permutations[column] = sort_permutation(self._rows, column)
+        # noinspection PyUnresolvedReferences
+        self.computed.emit(self._generation, permutations)
+
+
+class ResultsModel(QAbstractTableModel):
+    """ Search results: clicking a header swaps in a precomputed permutation,
+    the filter searches a precomputed lower case key blob of all the rows """
+
+    def __init__(self):
+        super().__init__()
+        self.headers = list()
+        self.rows = list()
+        self.keys = ""
+        self.key_starts = np.zeros(0, dtype=np.int64)
+        self.order = list()
+        self.permutations = dict()
+        self.generation = 0
+        self.sort_column = -1
+        self.sort_order = Qt.AscendingOrder
+        self.filter_text = ""
+        self.workers = list()
+
+    # ####### Qt model interface
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            return self.rows[self.order[index.row()]][index.column()]
+        elif role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.headers[section] if section < len(self.headers) else None
+        return str(section + 1)
+
+    def flags(self, index):
+        return Qt.NoItemFlags | Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.update_order(self.filter_text)
+
+    # ####### Results
+    def set_rows(self, headers, rows):
+        self.beginResetModel()
+        self.headers = headers
+        self.rows = rows
+        self.make_keys()
+        self.permutations = dict()
+        self.generation += 1
+        self.order = self.ordered_rows(self.filter_text)
+        self.endResetModel()
+        self.compute_sort_keys()
+
+    def append_rows(self, rows):
+        if not rows:
+            return
+        self.rows = self.rows + rows
+        self.make_keys()
+        self.permutations = dict()
+        self.generation += 1
+        if self.sort_column < 0 and not self.filter_text:
+            self.beginInsertRows(QModelIndex(), len(self.order), len(self.rows) - 1)
+            self.order = range(0, len(self.rows))
+            self.endInsertRows()
+        else:
+            self.update_order(self.filter_text)
+        self.compute_sort_keys()
+
+    def make_keys(self):
+        """ One line per row, the row of a match is found back with the line starts """
+        keys = ["\t".join(row).lower() for row in self.rows]
+        self.keys = "\n".join(keys)
+        self.key_starts = np.cumsum([0] + [len(key) + 1 for key in keys[:-1]], dtype=np.int64)
+
+    def row_values(self, row):
+        """ Values of the displayed row `row` """
+        return self.rows[self.order[row]]
+
+    def compute_sort_keys(self):
+        if not self.rows:
+            return
+        worker = SortKeysWorker(self.generation, self.rows, len(self.headers))
+        # noinspection PyUnresolvedReferences
+        worker.computed.connect(self.sort_keys_computed)
+        worker.finished.connect(lambda: self.workers.remove(worker))
+        self.workers.append(worker)
+        worker.start()
+
+    def sort_keys_computed(self, generation, permutations):
+        if generation != self.generation:
+            return
+        self.permutations = permutations
+        if 0 <= self.sort_column < len(self.headers):
+            # the rows were shown in arrival order until now
+            self.update_order(self.filter_text)
+
+    # ####### Sort and filter
+    def set_filter(self, text):
+        self.update_order(text.lower())
+
+    def ordered_rows(self, text):
+        """ Rows matching `text` in the sort order, in arrival order while the sort worker runs """
+        if self.sort_column in self.permutations and self.rows:
+            base = self.permutations[self.sort_column]
+            if self.sort_order == Qt.DescendingOrder:
+                base = base[::-1]
+        else:
+            base = range(0, len(self.rows))
+        if not text or not self.rows:
+            return base
+        positions = np.fromiter((match.start() for match in re.finditer(re.escape(text), self.keys)),
+                                dtype=np.int64)
+        matching = np.zeros(len(self.rows), dtype=bool)
+        matching[np.searchsorted(self.key_starts, positions, side="right") - 1] = True
+        base = np.asarray(base)
+        return base[matching[base]]
+
+    def update_order(self, text):
+        self.layoutAboutToBeChanged.emit()
+        self.order = self.ordered_rows(text)
+        self.filter_text = text
+        self.layoutChanged.emit()
+
+
+class StoreBuilder(QThread):
+    """ Bulk ingest of the data_files datasets in the local database """
+
+    built = pyqtSignal(str)
+
+    def run(self):
+        store = RegistryStore()
+        try:
+            ingested = store.ingest_all()
+            counts = store.counts()
+        except Exception as error:
+            # noinspection PyUnresolvedReferences
+            self.built.emit(f"Local database not built: {error}")
+            return
+        finally:
+            store.close()
+        if not ingested:
+            message = "No dataset in data_files, download them first"
+        else:
+            message = f"Local database built: {counts['users']} users, {counts['repeaters']} repeaters"
+        # noinspection PyUnresolvedReferences
+        self.built.emit(message)
+
+
+class JoinLoader(QThread):
+    """ Build the user / repeater join indexes from dmrid.dat and rptrs.json """
+
+    loaded = pyqtSignal(object)
+
+    def run(self):
+        # noinspection PyUnresolvedReferences
+        self.loaded.emit(JoinIndex.load())
+
+
+class SyncWorker(QThread):
+    """ Sync all datasets: concurrent downloads, then snapshot and database per file """
+
+    progress = pyqtSignal(str, str, int, int)
+    synced = pyqtSignal(str)
+
+    def run(self):
+        start = perf_counter()
+        try:
+            # noinspection PyUnresolvedReferences
+            results = DatasetSync(progress=self.progress.emit).run()
+        except Exception as error:
+            # noinspection PyUnresolvedReferences
+            self.synced.emit(f"Sync failed: {error}")
+            return
+        # noinspection PyUnresolvedReferences
+        self.synced.emit(f"Sync done in {perf_counter() - start:.0f} s: {sync_summary(results)}")
+
+
+class SnapshotRecorder(QThread):
+    """ Archive a downloaded dmrid.dat or rptrs.json in the snapshot history """
+
+    recorded = pyqtSignal(str)
+
+    def __init__(self, file_name):
+        super().__init__()
+        self.file_name = file_name
+
+    def run(self):
+        try:
+            results = record_download(self.file_name)
+        except (OSError, ValueError, sqlite3.Error) as error:
+            message = f"Snapshot of {self.file_name} failed: {error}"
+        else:
+            if not results:
+                message = f"{self.file_name} unchanged since the last snapshot"
+            else:
+                message = "Snapshot history: " + ", ".join(
+                    f"{result['dataset']} +{result['added']} ~{result['changed']} -{result['removed']}"
+                    for result in results)
+        # noinspection PyUnresolvedReferences
+        self.recorded.emit(message)
+
+
+class AnalyticsLoader(QThread):
+    """ Load the dmrid.dat and rptrs.json columns for the analytics """
+
+    loaded = pyqtSignal(object)
+
+    def run(self):
+        try:
+            analytics = RegistryAnalytics.load()
+        except OSError:
+            analytics = None
+        # noinspection PyUnresolvedReferences
+        self.loaded.emit(analytics)
+
+
 class WebBrowser(QThread):
     def __init__(self, url):
         super().__init__()
@@ -942,6 +1624,7 @@ class ParameterWindow(QDialog):
             self.master.shadow_1_grp.setColor(GRAY_SHADOW)
             self.master.shadow_2_grp.setColor(GRAY_SHADOW)
             self.master.shadow_table.setColor(GRAY_SHADOW)
+            self.master.shadow_related.setColor(GRAY_SHADOW)
             self.master.shadow_api_btn.setColor(GRAY_SHADOW)
 
             self.master.current_theme = theme
@@ -985,6 +1668,7 @@ class ParameterWindow(QDialog):
             self.master.shadow_1_grp.setColor(DARK_SHADOW)
             self.master.shadow_2_grp.setColor(DARK_SHADOW)
             self.master.shadow_table.setColor(DARK_SHADOW)
+            self.master.shadow_related.setColor(DARK_SHADOW)
             self.master.shadow_api_btn.setColor(DARK_SHADOW)
 
             self.master.current_theme = theme
@@ -996,6 +1680,7 @@ class ParameterWindow(QDialog):
             self.master.shadow_1_grp.setColor(LIGHT_SHADOW)
             self.master.shadow_2_grp.setColor(LIGHT_SHADOW)
             self.master.shadow_table.setColor(LIGHT_SHADOW)
+            self.master.shadow_related.setColor(LIGHT_SHADOW)
             self.master.shadow_api_btn.setColor(LIGHT_SHADOW)
 
             self.master.current_theme = theme
@@ -1008,6 +1693,337 @@ class ParameterWindow(QDialog):
         self.master.parameter_action.setEnabled(True)
 
 
+class DiagnosticsWindow(QDialog):
+    """ Diagnostics Window """
+
+    def __init__(self, master, **kwargs):
+        super().__init__(**kwargs)
+
+        # ####### Window config
+        self.master = master
+        self.setWindowFlags(Qt.WindowCloseButtonHint)
+        self.setWindowTitle("Diagnostics")
+        self.setWindowIcon(QIcon(ICON))
+
+        self.master.diagnostics_action.setDisabled(True)
+
+        # ###### Main Layout
+        self.main_layout = QVBoxLayout()
+        self.setLayout(self.main_layout)
+
+        # ####### Histograms
+        self.histo_grp = QGroupBox("Timings (ms)")
+        self.main_layout.addWidget(self.histo_grp, 1)
+        self.histo_layout = QVBoxLayout()
+        self.histo_grp.setLayout(self.histo_layout)
+        self.histo_table = QTableWidget()
+        self.histo_table.setColumnCount(7)
+        self.histo_table.setHorizontalHeaderLabels(["Stage", "Count", "Mean",
+                                                    "p50", "p90", "p99", "Max"])
+        for column in range(0, 7):
+            self.histo_table.horizontalHeader().setSectionResizeMode(column, QHeaderView.Stretch)
+        self.histo_table.setMinimumWidth(600)
+        self.histo_table.setMinimumHeight(250)
+        self.histo_layout.addWidget(self.histo_table)
+        self.counters_label = QLabel()
+        self.counters_label.setAlignment(Qt.AlignCenter)
+        self.histo_layout.addWidget(self.counters_label)
+
+        self.histo_shadow = QGraphicsDropShadowEffect()
+        self.histo_shadow.setBlurRadius(SHADOW_BLUR)
+        self.histo_grp.setGraphicsEffect(self.histo_shadow)
+
+        # ####### Export and profiling
+        self.tools_grp = QGroupBox("Export / Profile")
+        self.main_layout.addWidget(self.tools_grp)
+        self.tools_layout = QHBoxLayout()
+        self.tools_grp.setLayout(self.tools_layout)
+        self.refresh_btn = QPushButton("Refresh")
+        self.refresh_btn.clicked.connect(self.refresh)
+        self.export_btn = QPushButton("Export trace ..")
+        self.export_btn.clicked.connect(self.export_trace)
+        self.profile_combo = QComboBox()
+        self.profile_combo.setEditable(True)
+        self.profile_combo.lineEdit().setReadOnly(True)
+        self.profile_combo.lineEdit().setAlignment(Qt.AlignCenter)
+        self.profile_combo.addItems(PROFILE_SEARCHES_LIST)
+        format_combo(self.profile_combo)
+        self.profile_btn = QPushButton("Profile next search(es) ..")
+        self.profile_btn.clicked.connect(self.start_profile)
+        self.tools_layout.addWidget(self.refresh_btn, 1)
+        self.tools_layout.addWidget(self.export_btn, 1)
+        self.tools_layout.addWidget(self.profile_combo, 1)
+        self.tools_layout.addWidget(self.profile_btn, 1)
+
+        self.tools_shadow = QGraphicsDropShadowEffect()
+        self.tools_shadow.setBlurRadius(SHADOW_BLUR)
+        self.tools_grp.setGraphicsEffect(self.tools_shadow)
+
+        if self.master.current_theme == "Light":
+            self.histo_shadow.setColor(LIGHT_SHADOW)
+            self.tools_shadow.setColor(LIGHT_SHADOW)
+        elif self.master.current_theme == "Gray":
+            self.histo_shadow.setColor(GRAY_SHADOW)
+            self.tools_shadow.setColor(GRAY_SHADOW)
+        elif self.master.current_theme == "Dark":
+            self.histo_shadow.setColor(DARK_SHADOW)
+            self.tools_shadow.setColor(DARK_SHADOW)
+
+        self.refresh()
+
+    def refresh(self):
+        summary = METRICS.summary()
+        self.histo_table.setRowCount(len(summary))
+        for row, (stage, values) in enumerate(summary.items()):
+            cells = [stage, str(values["count"])]
+            cells += [f"{values[key]:.1f}" for key in ("mean", "p50", "p90", "p99", "max")]
+            for column, text in enumerate(cells):
+                item = QTableWidgetItem(text)
+                item.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
+                item.setTextAlignment(Qt.AlignCenter)
+                self.histo_table.setItem(row, column, item)
+
+        counters = [f"{name}: {value}" for name, value in METRICS.counters.items()]
+        if METRICS.profile_remaining > 0:
+            counters.append(f"profiling: {METRICS.profile_remaining} search(es) left")
+        if self.master.store is not None:
+            cache = self.master.store.cache.summary()
+            counters.append(f"result cache: {cache['entries']} search(es), "
+                            f"{cache['nbytes'] / 1048576:.1f} / {cache['budget'] / 1048576:.0f} MiB, "
+                            f"hit ratio {cache['hit_ratio']:.0%}")
+        self.counters_label.setText("   ".join(counters))
+
+    def export_trace(self):
+        # noinspection PyTypeChecker
+        file_name = QFileDialog.getSaveFileName(self, "Trace file name",
+                                                ".", "Chrome trace (*.json)")[0]
+
+        if file_name == "":
+            return
+
+        if ".json" not in file_name:
+            file_name += ".json"
+
+        METRICS.export_trace(file_name)
+        self.master.statusbar.showMessage(f"Trace saved in {file_name}")
+
+    def start_profile(self):
+        # noinspection PyTypeChecker
+        file_name = QFileDialog.getSaveFileName(self, "Profile file name",
+                                                ".", "cProfile stats (*.prof)")[0]
+
+        if file_name == "":
+            return
+
+        if ".prof" not in file_name:
+            file_name += ".prof"
+
+        METRICS.profile_next(int(self.profile_combo.currentText()), file_name)
+        self.refresh()
+
+    def closeEvent(self, event):
+        """Close event """
+        self.master.diagnostics_window = None
+        self.master.diagnostics_action.setEnabled(True)
+
+
+class LastHeardWindow(QDialog):
+    """ Last Heard Window """
+
+    def __init__(self, master, file_names, **kwargs):
+        super().__init__(**kwargs)
+
+        # ####### Window config
+        self.master = master
+        self.setWindowFlags(Qt.WindowCloseButtonHint)
+        self.setWindowTitle(f"Last heard - {', '.join(file_names)}")
+        self.setWindowIcon(QIcon(ICON))
+
+        self.master.last_heard_action.setDisabled(True)
+        self.rows = dict()
+
+        # ###### Main Layout
+        self.main_layout = QVBoxLayout()
+        self.setLayout(self.main_layout)
+
+        # ####### Table
+        self.table = QTableWidget()
+        self.table.setColumnCount(7)
+        self.table.setHorizontalHeaderLabels(["Time", "Callsign", "ID", "Name",
+                                              "Country", "Destination", "Heard"])
+        for column in range(0, 7):
+            self.table.horizontalHeader().setSectionResizeMode(column, QHeaderView.Stretch)
+        self.table.setMinimumWidth(800)
+        self.table.setMinimumHeight(380)
+        self.main_layout.addWidget(self.table)
+        self.status_label = QLabel("Loading dmrid.dat ..")
+        self.status_label.setAlignment(Qt.AlignCenter)
+        self.main_layout.addWidget(self.status_label)
+
+        self.table_shadow = QGraphicsDropShadowEffect()
+        self.table_shadow.setBlurRadius(SHADOW_BLUR)
+        self.table.setGraphicsEffect(self.table_shadow)
+        if self.master.current_theme == "Light":
+            self.table_shadow.setColor(LIGHT_SHADOW)
+        elif self.master.current_theme == "Gray":
+            self.table_shadow.setColor(GRAY_SHADOW)
+        elif self.master.current_theme == "Dark":
+            self.table_shadow.setColor(DARK_SHADOW)
+
+        # ####### Tail worker
+        self.events_count = 0
+        self.worker = LogTailWorker(file_names)
+        # noinspection PyUnresolvedReferences
+        self.worker.loaded.connect(self.status_label.setText)
+        # noinspection PyUnresolvedReferences
+        self.worker.heard.connect(self.add_events)
+        self.worker.start()
+
+    def add_events(self, batch):
+        """ Move or insert only the rows of the IDs heard in this batch """
+        self.table.setUpdatesEnabled(False)
+        for event, source, destination in batch:
+            if destination is not None:
+                target = destination["callsign"]
+            elif event.destination is None:
+                target = ""
+            elif event.talkgroup:
+                target = f"TG {event.destination}"
+            else:
+                target = str(event.destination)
+
+            count = 1
+            item = self.rows.pop(event.source, None)
+            if item is not None:
+                row = self.table.row(item)
+                count = int(self.table.item(row, 6).text()) + 1
+                self.table.removeRow(row)
+            elif self.table.rowCount() >= LAST_HEARD_ROWS:
+                last = self.table.rowCount() - 1
+                del self.rows[int(self.table.item(last, 2).text())]
+                self.table.removeRow(last)
+
+            if source is not None:
+                cells = [event.time, source["callsign"], str(event.source),
+                         source["name"], source["country"], target, str(count)]
+            else:
+                cells = [event.time, "", str(event.source), "", "", target, str(count)]
+
+            self.table.insertRow(0)
+            for column, text in enumerate(cells):
+                cell = QTableWidgetItem(text)
+                cell.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
+                cell.setTextAlignment(Qt.AlignCenter)
+                self.table.setItem(0, column, cell)
+            self.rows[event.source] = self.table.item(0, 2)
+        self.table.setUpdatesEnabled(True)
+
+        self.events_count += len(batch)
+        self.status_label.setText(f"{self.events_count} event(s), {len(self.rows)} station(s)")
+
+    def closeEvent(self, event):
+        """Close event """
+        self.worker.stop()
+        self.worker.wait()
+        self.master.last_heard_window = None
+        self.master.last_heard_action.setEnabled(True)
+
+
+class AnalyticsWindow(QDialog):
+    """ Analytics Window """
+
+    def __init__(self, master, **kwargs):
+        super().__init__(**kwargs)
+
+        # ####### Window config
+        self.master = master
+        self.setWindowFlags(Qt.WindowCloseButtonHint)
+        self.setWindowTitle("Registry analytics")
+        self.setWindowIcon(QIcon(ICON))
+
+        self.master.analytics_action.setDisabled(True)
+        self.analytics = None
+
+        # ###### Main Layout
+        self.main_layout = QVBoxLayout()
+        self.setLayout(self.main_layout)
+
+        self.report_grp = QGroupBox()
+        self.main_layout.addWidget(self.report_grp, 1)
+        self.report_layout = QVBoxLayout()
+        self.report_grp.setLayout(self.report_layout)
+
+        self.report_combo = QComboBox()
+        self.report_combo.setEditable(True)
+        self.report_combo.lineEdit().setReadOnly(True)
+        self.report_combo.lineEdit().setAlignment(Qt.AlignCenter)
+        self.report_combo.addItems(REPORTS)
+        self.report_combo.activated.connect(self.show_report)
+        self.report_combo.setDisabled(True)
+        format_combo(self.report_combo)
+        self.report_layout.addWidget(self.report_combo)
+
+        self.table = QTableWidget()
+        self.table.setColumnCount(3)
+        self.table.setHorizontalHeaderLabels(["Group", "Count", "Share"])
+        for column in range(0, 3):
+            self.table.horizontalHeader().setSectionResizeMode(column, QHeaderView.Stretch)
+        self.table.setMinimumWidth(500)
+        self.table.setMinimumHeight(380)
+        self.report_layout.addWidget(self.table)
+
+        self.status_label = QLabel("Loading dmrid.dat and rptrs.json ..")
+        self.status_label.setAlignment(Qt.AlignCenter)
+        self.report_layout.addWidget(self.status_label)
+
+        self.report_shadow = QGraphicsDropShadowEffect()
+        self.report_shadow.setBlurRadius(SHADOW_BLUR)
+        self.report_grp.setGraphicsEffect(self.report_shadow)
+        if self.master.current_theme == "Light":
+            self.report_shadow.setColor(LIGHT_SHADOW)
+        elif self.master.current_theme == "Gray":
+            self.report_shadow.setColor(GRAY_SHADOW)
+        elif self.master.current_theme == "Dark":
+            self.report_shadow.setColor(DARK_SHADOW)
+
+        self.loader = AnalyticsLoader()
+        # noinspection PyUnresolvedReferences
+        self.loader.loaded.connect(self.analytics_loaded)
+        self.loader.start()
+
+    def analytics_loaded(self, analytics):
+        self.analytics = analytics
+        if analytics is None:
+            self.status_label.setText("dmrid.dat not found in data_files")
+            return
+        self.report_combo.setEnabled(True)
+        self.show_report()
+
+    def show_report(self):
+        start = now_ms()
+        rows = self.analytics.report(self.report_combo.currentText())
+        elapsed = now_ms() - start
+        total = sum(count for _, count in rows) or 1
+
+        self.table.setUpdatesEnabled(False)
+        self.table.setRowCount(len(rows))
+        for row, (label, count) in enumerate(rows):
+            cells = [label, str(count), f"{100.0 * count / total:.2f} %"]
+            for column, text in enumerate(cells):
+                item = QTableWidgetItem(text)
+                item.setFlags(Qt.NoItemFlags | Qt.ItemIsEnabled)
+                item.setTextAlignment(Qt.AlignCenter)
+                self.table.setItem(row, column, item)
+        self.table.setUpdatesEnabled(True)
+        self.status_label.setText(f"{len(rows)} group(s), {total} record(s), computed in {elapsed:.1f} ms")
+
+    def closeEvent(self, event):
+        """Close event """
+        self.loader.wait()
+        self.master.analytics_window = None
+        self.master.analytics_action.setEnabled(True)
+
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
 
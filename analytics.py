@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID registry analytics: vectorized statistics with NumPy     #
+######################################################################
+import re
+import json
+
+import numpy as np
+
+from registry import DMRID_FILE, RPTRS_FILE
+from blockstore import dataset_exists, open_dataset
+
+ID_WIDTH = 7
+CALLSIGN_WIDTH = 16
+# Normalized ipsc_network (lower case, alphanumerics only) -> network
+NETWORK_ALIASES = {"bm": "BrandMeister",
+                   "brandmeister": "BrandMeister",
+                   "brandmeisternetwork": "BrandMeister",
+                   "dmrplus": "DMR+",
+                   "dmr": "DMR+",
+                   "dmrmarc": "DMR-MARC",
+                   "marc": "DMR-MARC",
+                   "": "Unknown",
+                   "none": "Unknown",
+                   "na": "Unknown"}
+VALID_COLOR_CODES = set(range(0, 16))
+NETWORK_WORDS = re.compile(r"[^0-9a-z]+")
+REPORTS = ["Users by country",
+           "Users by ID block",
+           "Callsign prefixes",
+           "Repeaters by country",
+           "Repeaters by state",
+           "Repeaters by color code",
+           "Repeaters by network",
+           "Repeaters by country and color code"]
+
+
+def read_user_columns(file_name=DMRID_FILE):
+    """ ids (uint32) and callsigns (S16) of dmrid.dat, parsed without a Python loop per line """
+    with open_dataset(file_name, binary=True) as file_path:
+        data = file_path.read()
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buffer == ord("\n"))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    separators = np.flatnonzero(buffer == ord(";"))
+    id_ends = separators[np.minimum(np.searchsorted(separators, line_starts), len(separators) - 1)]
+    valid = (id_ends > line_starts) & (id_ends < line_ends)
+    line_starts, line_ends, id_ends = line_starts[valid], line_ends[valid], id_ends[valid]
+
+    # IDs: right aligned digits gathered in a (n, 7) matrix
+    positions = id_ends[:, None] - ID_WIDTH + np.arange(ID_WIDTH)
+    digits = buffer[np.clip(positions, 0, None)].astype(np.int64) - ord("0")
+    digits[(positions < line_starts[:, None]) | (digits < 0) | (digits > 9)] = 0
+    ids = (digits @ (10 ** np.arange(ID_WIDTH - 1, -1, -1))).astype(np.uint32)
+
+    # Callsigns: left aligned characters until the next ";"
+    call_ends = separators[np.minimum(np.searchsorted(separators, id_ends + 1), len(separators) - 1)]
+    call_ends = np.where(call_ends > line_ends, line_ends, call_ends)
+    call_starts = id_ends + 1
+    for _ in range(0, 2):
+        call_starts += (buffer[np.minimum(call_starts, len(buffer) - 1)] == ord(" ")) & (call_starts < call_ends)
+    positions = call_starts[:, None] + np.arange(CALLSIGN_WIDTH)
+    chars = buffer[np.minimum(positions, len(buffer) - 1)].copy()
+    chars[positions >= call_ends[:, None]] = 0
+    chars[(chars >= ord("a")) & (chars <= ord("z"))] -= 32
+    chars[chars == ord(" ")] = 0
+    callsigns = np.ascontiguousarray(chars).view(f"S{CALLSIGN_WIDTH}").ravel()
+    return ids, callsigns
+
+
+def read_repeater_columns(file_name=RPTRS_FILE):
+    with open_dataset(file_name) as file_path:
+        repeaters = json.load(file_path)["rptrs"]
+    networks = [NETWORK_WORDS.sub("", (repeater.get("ipsc_network") or "").lower())
+                for repeater in repeaters]
+    return {"id": np.array([int(repeater["id"]) for repeater in repeaters], dtype=np.uint32),
+            "country": np.array([(repeater.get("country") or "").strip() or "Unknown"
+                                 for repeater in repeaters]),
+            "state": np.array([(repeater.get("state") or "").strip() or "Unknown"
+                               for repeater in repeaters]),
+            "color_code": np.array([repeater.get("color_code") if repeater.get("color_code") in VALID_COLOR_CODES
+                                    else -1 for repeater in repeaters], dtype=np.int8),
+            "network": np.array([NETWORK_ALIASES.get(network, network.upper() if len(network) <= 4
+                                                     else network.capitalize())
+                                 for network in networks])}
+
+
+def group_count(values, top=None):
+    """ [(value, count)] sorted by decreasing count """
+    labels, counts = np.unique(values, return_counts=True)
+    order = np.argsort(-counts, kind="stable")
+    if top is not None:
+        order = order[:top]
+    return [(label.decode() if isinstance(label, bytes) else str(label), int(counts[i]))
+            for label, i in zip(labels[order], order)]
+
+
+def country_codes(ids):
+    """ 3 digits country code of DMR IDs: 7 digits user IDs and 6 digits repeater IDs """
+    return np.where(ids >= 1000000, ids // 10000, ids // 1000).astype(np.uint32)
+
+
+class RegistryAnalytics:
+    """ Grouped statistics of dmrid.dat and rptrs.json """
+
+    def __init__(self, user_ids, callsigns, repeaters):
+        self.user_ids = user_ids
+        self.callsigns = callsigns
+        self.repeaters = repeaters
+        self.code_countries = self._code_countries()
+
+    @classmethod
+    def load(cls, dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE):
+        user_ids, callsigns = read_user_columns(dmrid_file)
+        repeaters = read_repeater_columns(rptrs_file) if dataset_exists(rptrs_file) else None
+        return cls(user_ids, callsigns, repeaters)
+
+    def _code_countries(self):
+        """ Country code -> most common country of the repeaters using it (dmrid.dat has no country) """
+        if self.repeaters is None:
+            return dict()
+        codes = country_codes(self.repeaters["id"])
+        pairs, counts = np.unique(np.rec.fromarrays([codes, self.repeaters["country"]]), return_counts=True)
+        order = np.lexsort((-counts, pairs.f0))
+        pairs = pairs[order]
+        first = np.concatenate(([True], pairs.f0[1:] != pairs.f0[:-1]))
+        return {int(code): str(country) for code, country in zip(pairs.f0[first], pairs.f1[first])}
+
+    def users_by_country(self, top=None):
+        codes, counts = np.unique(country_codes(self.user_ids), return_counts=True)
+        totals = dict()
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            country = self.code_countries.get(code, f"Code {code}")
+            totals[country] = totals.get(country, 0) + count
+        result = sorted(totals.items(), key=lambda item: -item[1])
+        return result[:top] if top is not None else result
+
+    def id_histogram(self, block_size=100000):
+        """ [(label, count)] of the non empty ID blocks """
+        counts = np.bincount(self.user_ids // block_size)
+        blocks = np.flatnonzero(counts)
+        return [(f"{block * block_size}-{(block + 1) * block_size - 1}", int(counts[block]))
+                for block in blocks]
+
+    def callsign_prefixes(self, top=None):
+        """ ITU style prefixes: characters up to the first digit after the first one (F4, VE3, 4X1) """
+        chars = self.callsigns.view(np.uint8).reshape(len(self.callsigns), CALLSIGN_WIDTH)
+        is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+        is_digit[:, 0] = False
+        has_digit = is_digit.any(axis=1)
+        lengths = np.where(has_digit, is_digit.argmax(axis=1) + 1, (chars != 0).sum(axis=1))
+        prefixes = np.where(np.arange(8) < lengths[:, None], chars[:, :8], 0).astype(np.uint8)
+        # 8 bytes prefixes grouped as uint64 keys: integer sort instead of a string sort
+        keys, counts = np.unique(np.ascontiguousarray(prefixes).view(np.uint64).ravel(), return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:top]
+        return [(label.decode(), int(count))
+                for label, count in zip(keys[order].view("S8"), counts[order])]
+
+    def repeaters_by(self, field, top=None):
+        if self.repeaters is None:
+            return []
+        return group_count(self.repeaters[field], top)
+
+    def repeaters_by_pair(self, first, second, top=None):
+        if self.repeaters is None:
+            return []
+        labels = np.char.add(np.char.add(self.repeaters[first].astype(str), " / CC "),
+                             self.repeaters[second].astype(str))
+        return group_count(labels, top)
+
+    def report(self, name, top=None):
+        if name == "Users by country":
+            return self.users_by_country(top)
+        elif name == "Users by ID block":
+            return self.id_histogram()
+        elif name == "Callsign prefixes":
+            return self.callsign_prefixes(top)
+        elif name == "Repeaters by country":
+            return self.repeaters_by("country", top)
+        elif name == "Repeaters by state":
+            return self.repeaters_by("state", top)
+        elif name == "Repeaters by color code":
+            return self.repeaters_by("color_code", top)
+        elif name == "Repeaters by network":
+            return self.repeaters_by("network", top)
+        elif name == "Repeaters by country and color code":
+            return self.repeaters_by_pair("country", "color_code", top)
+        return []
@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID block store: compressed, seekable copies of data_files   #
+######################################################################
+import io
+import csv
+import json
+import lzma
+import zlib
+import struct
+import hashlib
+import argparse
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from os import remove
+from os.path import getsize, isfile
+
+BLOCK_SUFFIX = ".blk"
+BLOCK_SIZE = 16 * 1024
+BLOCK_CACHE_SIZE = 8
+MAGIC = b"PYRIDBLK"
+FOOTER = struct.Struct("<QQ8s")
+CODECS = {"zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+          "lzma": (lambda data: lzma.compress(data, preset=6), lzma.decompress)}
+
+
+def file_sha256(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as file_path:
+        for chunk in iter(lambda: file_path.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ####### Source datasets -> (id, callsign, payload) records
+def dmrid_records(file_name):
+    with open(file_name, "r", encoding="utf-8", errors="replace") as file_path:
+        for line in file_path:
+            fields = line.split(";")
+            if len(fields) >= 2 and fields[0].strip().isdigit():
+                yield int(fields[0]), fields[1].strip().upper(), fields[1].strip()
+
+
+def csv_records(file_name):
+    with open(file_name, "r", encoding="utf-8", errors="replace", newline="") as file_path:
+        reader = csv.reader(file_path)
+        header = next(reader, [])
+        yield header
+        for row in reader:
+            if len(row) >= 2 and row[0].isdigit():
+                output = io.StringIO()
+                csv.writer(output, lineterminator="").writerow([field.replace("\n", " ") for field in row])
+                yield int(row[0]), row[1].strip().upper(), output.getvalue()
+
+
+def json_root(file_name):
+    return "rptrs" if "rptrs" in file_name else "users"
+
+
+def json_records(file_name):
+    with open(file_name, "r", encoding="utf-8", errors="replace") as file_path:
+        data = json.load(file_path)
+    for record in data.get("users", data.get("rptrs", [])):
+        dmr_id = record.get("radio_id", record.get("id"))
+        if str(dmr_id).isdigit():
+            yield int(dmr_id), (record.get("callsign") or "").strip().upper(), \
+                json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+
+
+def source_records(file_name, dataset=None):
+    """ (kind, header, records) of a data_files dataset, its kind from the `dataset` name
+    when the file is a copy (*.previous) """
+    dataset = dataset or file_name
+    if dataset.endswith(".dat"):
+        return "dmrid", None, list(dmrid_records(file_name))
+    if dataset.endswith(".csv"):
+        records = csv_records(file_name)
+        header = next(records)
+        return "csv", header, list(records)
+    return "json", None, list(json_records(file_name))
+
+
+# ####### Writer
+def write_blocks(file_path, records, compress, block_size, delta=False):
+    """ Compress `records` ((key, value) sorted by key) in blocks of "key\tvalue" lines,
+    returns the sparse index: [first key, offset, size, count] per block """
+    index = list()
+    block = list()
+    size = 0
+    for key, value in records:
+        block.append((key, value))
+        size += len(value) + 8
+        if size >= block_size:
+            index.append(write_block(file_path, block, compress, delta))
+            block = list()
+            size = 0
+    if block:
+        index.append(write_block(file_path, block, compress, delta))
+    return index
+
+
+def write_block(file_path, block, compress, delta):
+    if delta:
+        # integer keys stored as the difference with the previous one: a few digits
+        keys = [block[0][0]] + [key - previous for (key, _), (previous, _) in zip(block[1:], block)]
+    else:
+        keys = [key for key, _ in block]
+    data = compress("\n".join(f"{key}\t{value}" for key, (_, value) in zip(keys, block)).encode("utf-8"))
+    offset = file_path.tell()
+    file_path.write(data)
+    return [block[0][0], offset, len(data), len(block)]
+
+
+def pack(file_name, output=None, codec="zlib", block_size=BLOCK_SIZE):
+    """ Write the block store of a dataset, returns its file name """
+    output = output or file_name + BLOCK_SUFFIX
+    kind, header, records = source_records(file_name)
+    compress = CODECS[codec][0]
+    records.sort(key=lambda record: record[0])
+    by_callsign = sorted((callsign, str(dmr_id)) for dmr_id, callsign, _ in records)
+
+    with open(output, "wb") as file_path:
+        file_path.write(MAGIC)
+        id_blocks = write_blocks(file_path, ((dmr_id, payload) for dmr_id, _, payload in records),
+                                 compress, block_size, delta=True)
+        callsign_blocks = write_blocks(file_path, by_callsign, compress, block_size)
+        index = json.dumps({"kind": kind, "header": header, "codec": codec, "records": len(records),
+                            "source_size": getsize(file_name), "source_sha256": file_sha256(file_name),
+                            "root": json_root(file_name) if kind == "json" else None,
+                            "id_blocks": id_blocks, "callsign_blocks": callsign_blocks}).encode("utf-8")
+        index_offset = file_path.tell()
+        file_path.write(zlib.compress(index))
+        file_path.write(FOOTER.pack(index_offset, file_path.tell() - index_offset, MAGIC))
+    return output
+
+
+def compact(file_name, codec="zlib"):
+    """ Replace a dataset by its block store: the readers of the app fall back on it """
+    output = pack(file_name, codec=codec)
+    remove(file_name)
+    return output
+
+
+# ####### Reader
+class BlockStore:
+    """ Point lookups by ID or callsign decompress one block, scans stream block by block """
+
+    def __init__(self, file_name, cache_size=BLOCK_CACHE_SIZE):
+        self.file_name = file_name
+        self.file_path = open(file_name, "rb")
+        self.file_path.seek(-FOOTER.size, io.SEEK_END)
+        index_offset, index_size, magic = FOOTER.unpack(self.file_path.read(FOOTER.size))
+        if magic != MAGIC:
+            self.file_path.close()
+            raise ValueError(f"{file_name} is not a PyRadioID block store")
+        self.file_path.seek(index_offset)
+        index = json.loads(zlib.decompress(self.file_path.read(index_size)))
+        self.kind = index["kind"]
+        self.header = index["header"]
+        self.codec = index["codec"]
+        self.records = index["records"]
+        self.source_size = index["source_size"]
+        self.source_sha256 = index.get("source_sha256")
+        self.root = index.get("root") or json_root(file_name)
+        self.id_blocks = index["id_blocks"]
+        self.callsign_blocks = index["callsign_blocks"]
+        self.first_ids = [block[0] for block in self.id_blocks]
+        self.first_callsigns = [block[0] for block in self.callsign_blocks]
+        self.decompress = CODECS[self.codec][1]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.blocks_read = 0
+
+    def close(self):
+        self.file_path.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.records
+
+    def _read(self, block):
+        _, offset, size, _ = block
+        self.file_path.seek(offset)
+        self.blocks_read += 1
+        return self.decompress(self.file_path.read(size)).decode("utf-8").split("\n")
+
+    def _block(self, section, number):
+        """ (keys, values) of a block of the "id" or "callsign" section,
+        the last decompressed blocks are kept in an LRU """
+        key = (section, number)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        keys = list()
+        values = list()
+        blocks = self.id_blocks if section == "id" else self.callsign_blocks
+        for line in self._read(blocks[number]):
+            block_key, _, value = line.partition("\t")
+            keys.append(block_key)
+            values.append(value)
+        if section == "id":
+            keys = list(accumulate(map(int, keys)))
+        self.cache[key] = keys, values
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return keys, values
+
+    def get(self, dmr_id):
+        """ Payload (callsign, CSV row or JSON object) of `dmr_id`, None if unknown """
+        number = bisect_right(self.first_ids, dmr_id) - 1
+        if number < 0:
+            return None
+        keys, values = self._block("id", number)
+        row = bisect_left(keys, dmr_id)
+        if row < len(keys) and keys[row] == dmr_id:
+            return values[row]
+        return None
+
+    def callsign_ids(self, callsign):
+        """ Sorted IDs of a callsign, or of a prefix when `callsign` ends with % """
+        callsign = callsign.strip().upper()
+        low, high = callsign, callsign
+        if callsign.endswith("%"):
+            low = callsign[:-1]
+            high = low + "￿"
+        # the block before the first one starting after `low` can hold the first matches
+        number = max(0, bisect_left(self.first_callsigns, low) - 1)
+        ids = list()
+        while number < len(self.callsign_blocks) and self.first_callsigns[number] <= high:
+            keys, values = self._block("callsign", number)
+            start = bisect_left(keys, low)
+            stop = bisect_right(keys, high)
+            ids += [int(value) for value in values[start:stop]]
+            number += 1
+        return sorted(ids)
+
+    def find_callsign(self, callsign):
+        """ [(id, payload)] of a callsign or prefix """
+        return [(dmr_id, self.get(dmr_id)) for dmr_id in self.callsign_ids(callsign)]
+
+    def scan(self):
+        """ (id, payload) of every record in ID order, one block in memory at a time """
+        for block in self.id_blocks:
+            dmr_id = 0
+            for line in self._read(block):
+                delta, _, payload = line.partition("\t")
+                dmr_id += int(delta)
+                yield dmr_id, payload
+
+    def record(self, dmr_id, payload):
+        """ Dict of a payload: the JSON object, the CSV row or id and callsign of dmrid.dat """
+        if payload is None:
+            return None
+        if self.kind == "json":
+            return json.loads(payload)
+        if self.kind == "csv":
+            return dict(zip(self.header, next(csv.reader([payload]))))
+        return {"id": dmr_id, "callsign": payload}
+
+    def source_lines(self):
+        """ The dataset in its source format, records in ID order, one line (str) at a time """
+        if self.kind == "dmrid":
+            for dmr_id, payload in self.scan():
+                yield f"{dmr_id};{payload};\n"
+        elif self.kind == "csv":
+            output = io.StringIO()
+            csv.writer(output, lineterminator="\n").writerow(self.header)
+            yield output.getvalue()
+            for _, payload in self.scan():
+                yield f"{payload}\n"
+        else:
+            separator = f'{{"{self.root}":['
+            for _, payload in self.scan():
+                yield separator + payload
+                separator = ","
+            yield ("" if separator == "," else separator) + "]}"
+
+    @property
+    def nbytes(self):
+        return getsize(self.file_name)
+
+
+# ####### Datasets on disk, raw or compacted
+class SourceStream(io.RawIOBase):
+    """ Read-only byte stream of the source format of a block store, decompressed block by block """
+
+    def __init__(self, file_name):
+        super().__init__()
+        self.store = BlockStore(file_name)
+        self.lines = self.store.source_lines()
+        self.pending = b""
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position == len(self.pending):
+            line = next(self.lines, None)
+            if line is None:
+                return 0
+            self.pending = line.encode("utf-8")
+            self.position = 0
+        size = min(len(buffer), len(self.pending) - self.position)
+        buffer[:size] = self.pending[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.store.close()
+        super().close()
+
+
+def dataset_exists(file_name):
+    return isfile(file_name) or isfile(file_name + BLOCK_SUFFIX)
+
+
+def open_dataset(file_name, binary=False):
+    """ File object of a data_files dataset: the raw file, or once compacted its block store
+    streamed in the source format, one block decompressed at a time """
+    if isfile(file_name) or not isfile(file_name + BLOCK_SUFFIX):
+        if binary:
+            return open(file_name, "rb")
+        return open(file_name, "r", encoding="utf-8", errors="replace", newline="")
+    stream = io.BufferedReader(SourceStream(file_name + BLOCK_SUFFIX), BLOCK_SIZE)
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed, seekable copies of the data_files datasets")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="write the block store of datasets")
+    pack_parser.add_argument("files", nargs="+", help="dmrid.dat, user.csv, users.json or rptrs.json")
+    pack_parser.add_argument("--codec", choices=sorted(CODECS), default="zlib")
+    pack_parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    pack_parser.add_argument("--drop-source", action="store_true",
+                             help="remove the raw files, the app reads the block stores instead")
+    get_parser = subparsers.add_parser("get", help="records of DMR IDs")
+    get_parser.add_argument("store")
+    get_parser.add_argument("ids", nargs="+", type=int)
+    callsign_parser = subparsers.add_parser("callsign", help="records of callsigns (F4% for a prefix)")
+    callsign_parser.add_argument("store")
+    callsign_parser.add_argument("callsigns", nargs="+")
+    info_parser = subparsers.add_parser("info", help="size and blocks of a block store")
+    info_parser.add_argument("store")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        for file_name in args.files:
+            size = getsize(file_name)
+            output = pack(file_name, codec=args.codec, block_size=args.block_size)
+            print(f"{output}: {size / 1e6:.1f} MB -> {getsize(output) / 1e6:.1f} MB")
+            if args.drop_source:
+                remove(file_name)
+        return
+
+    with BlockStore(args.store) as store:
+        if args.command == "get":
+            for dmr_id in args.ids:
+                print(f"{dmr_id}: {store.record(dmr_id, store.get(dmr_id))}")
+        elif args.command == "callsign":
+            for callsign in args.callsigns:
+                for dmr_id, payload in store.find_callsign(callsign):
+                    print(f"{callsign}: {store.record(dmr_id, payload)}")
+        elif args.command == "info":
+            print(f"{store.file_name}: {store.kind}, {len(store)} records, {store.codec}, "
+                  f"{len(store.id_blocks)} ID blocks, {len(store.callsign_blocks)} callsign blocks, "
+                  f"{store.source_size / 1e6:.1f} MB -> {store.nbytes / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID parallel ingest of dmrid.dat, user.csv and users.json    #
+######################################################################
+import re
+import io
+import csv
+import json
+import argparse
+from array import array
+from os import cpu_count
+from os.path import getsize, isfile
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from blockstore import dataset_exists, open_dataset
+from registry import (DMRID_FILE, USER_CSV_FILE, USERS_JSON_FILE, StringColumn, PackedCallsignColumn,
+                      DmrIdIndex, UserDetails, Resolver, IdBitmap, pack_callsign)
+
+MIN_CHUNK_SIZE = 1 << 20
+CHUNKS_PER_WORKER = 4
+
+
+# ####### Byte ranges
+def split_ranges(file_name, parts, first=0, last=None, boundary=b"\n", before=None):
+    """ [(start, end)] byte ranges of about the same size, each one starting right after `boundary`,
+    and when given `before`, right before optional whitespace and `before` """
+    pattern = re.escape(boundary)
+    if before is not None:
+        pattern += rb"(?=\s*" + re.escape(before) + rb")"
+    pattern = re.compile(pattern)
+    if last is None:
+        last = getsize(file_name)
+    size = last - first
+    parts = max(1, min(parts, size // MIN_CHUNK_SIZE or 1))
+    cuts = [first]
+    with open(file_name, "rb") as file_path:
+        for part in range(1, parts):
+            file_path.seek(first + size * part // parts)
+            window = file_path.read(1 << 16)
+            match = pattern.search(window)
+            if match is None:
+                continue
+            cut = first + size * part // parts + match.end()
+            if cuts[-1] < cut < last:
+                cuts.append(cut)
+    cuts.append(last)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def csv_ranges(file_name, parts, first=0):
+    """ split_ranges of a CSV file without the cuts inside a quoted field: a newline in a quoted
+    value follows an odd number of quotes ("" escapes count twice) """
+    ranges = split_ranges(file_name, parts, first)
+    cuts = [first]
+    quotes = 0
+    with open(file_name, "rb") as file_path:
+        for start, end in ranges:
+            file_path.seek(start)
+            for offset in range(start, end, MIN_CHUNK_SIZE):
+                quotes += file_path.read(min(MIN_CHUNK_SIZE, end - offset)).count(b'"')
+            if quotes % 2 == 0 or end == ranges[-1][1]:
+                cuts.append(end)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def json_records_bounds(file_name):
+    """ Byte range of the records of {"users": [ {...}, {...} ]} """
+    with open(file_name, "rb") as file_path:
+        head = file_path.read(1 << 16)
+        file_path.seek(max(0, getsize(file_name) - (1 << 16)))
+        tail_offset = file_path.tell()
+        tail = file_path.read()
+    first = head.find(b"{", head.find(b"["))
+    last = tail_offset + tail.rfind(b"]")
+    return first, last
+
+
+def read_range(file_name, start, end):
+    with open(file_name, "rb") as file_path:
+        file_path.seek(start)
+        return file_path.read(end - start)
+
+
+# ####### Workers: bytes in, raw column buffers out
+class ColumnsBuilder:
+    """ Columns of one chunk, sent back to the parent as raw buffers """
+
+    def __init__(self, string_fields=0):
+        self.ids = array("I")
+        self.values = array("q")
+        self.overflow = list()
+        self.strings = [list() for _ in range(0, string_fields)]
+
+    def add(self, dmr_id, callsign, *strings):
+        value = pack_callsign(callsign)
+        if value is None:
+            value = -1 - len(self.overflow)
+            self.overflow.append(callsign)
+        self.ids.append(dmr_id)
+        self.values.append(value)
+        for column, text in zip(self.strings, strings):
+            column.append(text)
+
+    def buffers(self):
+        overflow = StringColumn.from_strings(self.overflow)
+        columns = [StringColumn.from_strings(strings) for strings in self.strings]
+        return (self.ids.tobytes(), self.values.tobytes(), overflow.blob, overflow.offsets.tobytes(),
+                [(column.blob, column.offsets.tobytes()) for column in columns])
+
+
+def parse_dmrid(data):
+    builder = ColumnsBuilder()
+    for line in data.split(b"\n"):
+        fields = line.split(b";")
+        if len(fields) >= 2 and fields[0].strip().isdigit():
+            builder.add(int(fields[0]), fields[1].strip().decode("utf-8", "replace").upper())
+    return builder.buffers()
+
+
+def parse_dmrid_range(file_name, start, end):
+    return parse_dmrid(read_range(file_name, start, end))
+
+
+def parse_users_csv(data):
+    builder = ColumnsBuilder(len(UserDetails.FIELDS))
+    # newline="": csv keeps the newlines of the quoted values
+    for row in csv.reader(io.StringIO(data.decode("utf-8", "replace"), newline="")):
+        if len(row) >= 7 and row[0].isdigit():
+            builder.add(int(row[0]), row[1].strip().upper(), row[2], row[3], row[4], row[5], row[6])
+    return builder.buffers()
+
+
+def parse_users_csv_range(file_name, start, end):
+    return parse_users_csv(read_range(file_name, start, end))
+
+
+def parse_users_json_range(file_name, start, end):
+    """ None when the range does not decode: a cut on a "},{" inside a string value """
+    chunk = read_range(file_name, start, end).strip().rstrip(b",")
+    try:
+        users = json.loads(b"[" + chunk + b"]")
+    except ValueError:
+        return None
+    return parse_users_json(users)
+
+
+def parse_users_json(users):
+    builder = ColumnsBuilder(len(UserDetails.FIELDS))
+    for user in users:
+        builder.add(int(user["radio_id"] if "radio_id" in user else user["id"]),
+                    (user.get("callsign") or "").strip().upper(),
+                    user.get("fname") or "", user.get("surname") or "", user.get("city") or "",
+                    user.get("state") or "", user.get("country") or "")
+    return builder.buffers()
+
+
+# ####### Merge
+def merge_strings(parts):
+    """ One StringColumn from (blob, offsets bytes) parts, offsets shifted with NumPy """
+    blobs = list()
+    offsets = [np.zeros(1, dtype=np.uint32)]
+    base = 0
+    for blob, offsets_bytes in parts:
+        part_offsets = np.frombuffer(offsets_bytes, dtype=np.uint32)
+        offsets.append(part_offsets[1:] + base)
+        base += len(blob)
+        blobs.append(blob)
+    return np.frombuffer(b"".join(blobs), dtype=np.uint8), np.concatenate(offsets)
+
+
+def take_strings(blob, offsets, order):
+    """ StringColumn of the strings in `order`, gathered without a Python loop """
+    starts = offsets[:-1][order].astype(np.int64)
+    lengths = (offsets[1:] - offsets[:-1])[order].astype(np.int64)
+    new_offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.uint32)
+    gather = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1], dtype=np.int64)
+    return StringColumn(blob[gather].tobytes(), array("I", new_offsets.tobytes()))
+
+
+def merge(results):
+    """ Concatenate the chunk columns, sort them by ID, returns (DmrIdIndex, string columns) """
+    ids = np.concatenate([np.frombuffer(result[0], dtype=np.uint32) for result in results])
+    values = list()
+    overflow_base = 0
+    for result in results:
+        part = np.frombuffer(result[1], dtype=np.int64)
+        values.append(np.where(part < 0, part - overflow_base, part))
+        overflow_base += len(result[3]) // 4 - 1
+    values = np.concatenate(values)
+    overflow_blob, overflow_offsets = merge_strings([(result[2], result[3]) for result in results])
+
+    order = np.argsort(ids, kind="stable")
+    ids = ids[order]
+    values = values[order]
+    packed = np.flatnonzero(values >= 0)
+    callsign_order = packed[np.argsort(values[packed], kind="stable")].astype(np.uint32)
+    callsigns = PackedCallsignColumn(array("q", values.tobytes()), array("I", callsign_order.tobytes()),
+                                     StringColumn(overflow_blob.tobytes(), array("I", overflow_offsets.tobytes())))
+    index = DmrIdIndex(array("I", ids.tobytes()), callsigns)
+
+    columns = list()
+    for field in range(0, len(results[0][4]) if results else 0):
+        blob, offsets = merge_strings([result[4][field] for result in results])
+        columns.append(take_strings(blob, offsets, order))
+    return index, columns
+
+
+def join_failed_chunks(file_name, ranges, results):
+    """ Parse again each chunk that did not decode joined with the next ones, serially """
+    joined = list()
+    row = 0
+    while row < len(ranges):
+        start, end = ranges[row]
+        result = results[row]
+        while result is None and row + 1 < len(ranges):
+            row += 1
+            end = ranges[row][1]
+            result = parse_users_json_range(file_name, start, end)
+        if result is None:
+            raise ValueError(f"{file_name}: invalid JSON between bytes {start} and {end}")
+        joined.append(result)
+        row += 1
+    return joined
+
+
+def run_chunks(parser, file_name, ranges, workers):
+    if workers == 1 or len(ranges) == 1:
+        return [parser(file_name, start, end) for start, end in ranges]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parser, file_name, start, end) for start, end in ranges]
+        return [future.result() for future in futures]
+
+
+# ####### Public API
+def ingest_dmrid(file_name=DMRID_FILE, workers=None):
+    """ DmrIdIndex of dmrid.dat parsed by `workers` processes """
+    if not isfile(file_name):
+        # compacted dataset: its block store is streamed and parsed a chunk of lines at a time
+        with open_dataset(file_name, binary=True) as file_path:
+            chunks = iter(lambda: file_path.readlines(MIN_CHUNK_SIZE), [])
+            return merge([parse_dmrid(b"".join(lines)) for lines in chunks])[0]
+    workers = workers or cpu_count() or 1
+    ranges = split_ranges(file_name, workers * CHUNKS_PER_WORKER)
+    index, _ = merge(run_chunks(parse_dmrid_range, file_name, ranges, workers))
+    return index
+
+
+def ingest_users(file_name=None, workers=None):
+    """ (DmrIdIndex, UserDetails) of user.csv or users.json parsed by `workers` processes """
+    if file_name is None:
+        file_name = USER_CSV_FILE if dataset_exists(USER_CSV_FILE) else USERS_JSON_FILE
+    workers = workers or cpu_count() or 1
+    if not isfile(file_name):
+        with open_dataset(file_name, binary=True) as file_path:
+            data = file_path.read()
+        results = [parse_users_json(json.loads(data)["users"]) if file_name.endswith(".json")
+                   else parse_users_csv(data)]
+    elif file_name.endswith(".json"):
+        first, last = json_records_bounds(file_name)
+        ranges = split_ranges(file_name, workers * CHUNKS_PER_WORKER, first, last, boundary=b"},", before=b"{")
+        results = join_failed_chunks(file_name, ranges,
+                                     run_chunks(parse_users_json_range, file_name, ranges, workers))
+    else:
+        with open(file_name, "rb") as file_path:
+            header = len(file_path.readline())
+        ranges = csv_ranges(file_name, workers * CHUNKS_PER_WORKER, header)
+        results = run_chunks(parse_users_csv_range, file_name, ranges, workers)
+    index, columns = merge(results)
+    return index, UserDetails(index.ids, columns)
+
+
+def load_resolver(dmrid_file=DMRID_FILE, users_file=None, workers=None):
+    """ Resolver built with the parallel ingest """
+    index = ingest_dmrid(dmrid_file, workers)
+    details = None
+    if users_file is not None or dataset_exists(USER_CSV_FILE) or dataset_exists(USERS_JSON_FILE):
+        details = ingest_users(users_file, workers)[1]
+    return Resolver(index, details, bitmap=IdBitmap.from_ids(index.ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel ingest of the RadioID datasets")
+    parser.add_argument("files", nargs="*", default=[DMRID_FILE],
+                        help="dmrid.dat, user.csv or users.json files")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    for file_name in args.files:
+        start = perf_counter()
+        if file_name.endswith(".dat"):
+            index = ingest_dmrid(file_name, args.workers)
+        else:
+            index, _ = ingest_users(file_name, args.workers)
+        elapsed = perf_counter() - start
+        print(f"{file_name}: {len(index)} records in {elapsed * 1000:.0f} ms "
+              f"({index.nbytes / 1e6:.1f} MB of index)")
+
+
+if __name__ == "__main__":
+    main()
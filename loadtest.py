@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID load test: lookup latency and memory as the registry grows #
+######################################################################
+import json
+import random
+import argparse
+import resource
+import tracemalloc
+from array import array
+from os import makedirs, remove
+from os.path import isfile, join
+from time import perf_counter
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from metrics import Histogram
+from registry import (DMRID_FILE, RPTRS_FILE, ID_SPACE, IdBitmap, Resolver, RepeaterDetails, JoinIndex,
+                      StringColumn)
+from ingest import ingest_dmrid
+from store import RegistryStore
+from blockstore import BlockStore, pack
+from shared_index import SharedIndex, write_index
+from synth import SYNTH_DIR, SourceModel, generate
+
+# no 100x: the generated IDs stay in the 7 digits ID space, it holds about 37 times the source users
+SCALES = [1, 10, 30]
+WORKLOAD = {"exact": 40, "callsign": 10, "prefix": 10, "wildcard": 5, "batch": 10,
+            "repeater": 10, "related": 5, "store": 5, "block": 5}
+# lookups of the local database and of the block store, they need those files built first
+STORE_LOOKUPS = {"store"}
+BLOCK_LOOKUPS = {"block"}
+BATCH_SIZE = 100
+# share of the exact lookups for IDs nobody has (talkgroups, typos in the logs)
+MISS_RATE = 0.1
+DURATION = 10
+CLIENTS = 4
+
+
+def parse_workload(text):
+    """ "exact=50,prefix=20" -> {"exact": 50, "prefix": 20} """
+    workload = dict()
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in WORKLOAD:
+            raise ValueError(f"unknown lookup {kind}, use {', '.join(WORKLOAD)}")
+        workload[kind] = float(weight or 1)
+    return workload
+
+
+def dataset_dir(scale, synth_dir=SYNTH_DIR):
+    return join(synth_dir, f"x{scale:g}")
+
+
+def dataset_files(scale, synth_dir=SYNTH_DIR):
+    """ (dmrid.dat, rptrs.json) of a scale, the data_files ones at 1x """
+    if scale == 1:
+        return DMRID_FILE, RPTRS_FILE
+    return join(dataset_dir(scale, synth_dir), "dmrid.dat"), join(dataset_dir(scale, synth_dir), "rptrs.json")
+
+
+def store_files(scale, synth_dir=SYNTH_DIR):
+    """ (SQLite database, dmrid.dat block store) of a scale, built by prepare """
+    return join(dataset_dir(scale, synth_dir), "registry.sqlite"), join(dataset_dir(scale, synth_dir), "dmrid.dat.blk")
+
+
+def prepare(scale, workload, synth_dir=SYNTH_DIR):
+    """ Build the database and the block store of a scale the workload needs, once """
+    dmrid_file, rptrs_file = dataset_files(scale, synth_dir)
+    store_file, block_file = store_files(scale, synth_dir)
+    makedirs(dataset_dir(scale, synth_dir), exist_ok=True)
+    if STORE_LOOKUPS & set(workload) and not isfile(store_file):
+        start = perf_counter()
+        store = RegistryStore(store_file)
+        try:
+            store.ingest_dmrid(dmrid_file)
+            store.ingest_repeaters(rptrs_file)
+        finally:
+            store.close()
+        print(f"{scale:g}x: database built in {perf_counter() - start:.1f} s")
+    if BLOCK_LOOKUPS & set(workload) and not isfile(block_file):
+        start = perf_counter()
+        pack(dmrid_file, output=block_file)
+        print(f"{scale:g}x: block store packed in {perf_counter() - start:.1f} s")
+    return (store_file if STORE_LOOKUPS & set(workload) else None,
+            block_file if BLOCK_LOOKUPS & set(workload) else None)
+
+
+def no_repeaters():
+    return RepeaterDetails(array("I"), [StringColumn() for _ in RepeaterDetails.FIELDS])
+
+
+def peak_rss():
+    """ Peak resident memory of this process in bytes. VmHWM first: on Linux ru_maxrss (in KiB)
+    also counts the memory the parent process had when it started this one """
+    try:
+        with open("/proc/self/status", "r") as file_path:
+            for line in file_path:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Workload:
+    """ Random lookups of one client drawn from the records of the index """
+
+    def __init__(self, index, joins, workload, seed):
+        self.index = index
+        self.joins = joins
+        self.rng = random.Random(seed)
+        self.kinds = list(workload)
+        self.weights = list(workload.values())
+
+    def dmr_id(self):
+        if self.rng.random() < MISS_RATE:
+            return self.rng.randrange(ID_SPACE)
+        return self.index.ids[self.rng.randrange(len(self.index.ids))]
+
+    def callsign(self):
+        return self.index.callsigns[self.rng.randrange(len(self.index.ids))]
+
+    def repeater_id(self):
+        repeaters = self.joins.repeaters
+        if not len(repeaters) or self.rng.random() < MISS_RATE:
+            return self.rng.randrange(ID_SPACE)
+        return repeaters.ids[self.rng.randrange(len(repeaters))]
+
+    def related(self):
+        """ Arguments of JoinIndex.related for a repeater row or a user row """
+        if len(self.joins.repeaters) and self.rng.random() < 0.5:
+            record = self.joins.repeater(self.rng.randrange(len(self.joins.repeaters)))
+            return record["callsign"], record["id"], record["city"], record["state"], True
+        row = self.rng.randrange(len(self.index.ids))
+        return self.index.callsigns[row], self.index.ids[row], "", "", False
+
+    def next(self):
+        """ (kind, argument) of the next lookup """
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        if kind in ("exact", "block"):
+            return kind, self.dmr_id()
+        if kind == "batch":
+            return kind, [self.dmr_id() for _ in range(BATCH_SIZE)]
+        if kind == "repeater":
+            return kind, self.repeater_id()
+        if kind == "related":
+            return kind, self.related()
+        if kind == "store":
+            if self.rng.random() < 0.5:
+                return kind, [("DMR ID of a user", str(self.dmr_id()))]
+            return kind, [("DMR user callsign", self.callsign())]
+        callsign = self.callsign()
+        if kind == "prefix":
+            return kind, callsign[:self.rng.randint(2, 4)] + "%"
+        if kind == "wildcard":
+            # "F4%TV": the prefix narrows the rows, the tail is matched on each one
+            return kind, f"{callsign[:2]}%{callsign[-2:]}"
+        return kind, callsign
+
+
+def run_client(index, bitmap, joins, workload, duration, seed, store_file=None, block_file=None):
+    """ {kind: [latency in ms]} of the lookups of one client for `duration` seconds,
+    each client has its own database connection and block store reader """
+    resolver = Resolver(index, bitmap=bitmap)
+    queries = Workload(index, joins, workload, seed)
+    store = RegistryStore(store_file) if store_file is not None else None
+    blocks = BlockStore(block_file) if block_file is not None else None
+    samples = {kind: list() for kind in workload}
+    end = perf_counter() + duration
+    try:
+        while True:
+            kind, argument = queries.next()
+            start = perf_counter()
+            if start >= end:
+                break
+            if kind == "exact":
+                resolver.resolve(argument)
+            elif kind == "batch":
+                for dmr_id in argument:
+                    resolver.resolve(dmr_id)
+            elif kind == "callsign":
+                index.find_callsign(argument)
+            elif kind == "repeater":
+                joins.repeater_by_id(argument)
+            elif kind == "related":
+                joins.related(*argument)
+            elif kind == "store":
+                store.search("user", argument)
+            elif kind == "block":
+                blocks.get(argument)
+            else:
+                index.match_callsign(argument)
+            samples[kind].append((perf_counter() - start) * 1000)
+    finally:
+        if store is not None:
+            store.close()
+        if blocks is not None:
+            blocks.close()
+    return samples
+
+
+def run_shared_client(file_name, workload, duration, seed, store_file, block_file):
+    """ run_client in a worker process attached to the shared index, with its peak RSS """
+    shared = SharedIndex(file_name)
+    try:
+        joins = JoinIndex(shared.index, shared.repeaters or no_repeaters())
+        samples = run_client(shared.index, shared.bitmap, joins, workload, duration, seed, store_file, block_file)
+        return samples, peak_rss()
+    finally:
+        shared.close()
+
+
+def traced_load(dmrid_file, workers):
+    """ Peak of the Python allocations of a load, apart: tracing slows the load down a lot """
+    tracemalloc.start()
+    try:
+        ingest_dmrid(dmrid_file, workers)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(dmrid_file, rptrs_file, workload, clients, duration, processes, workers, seed, trace=False,
+            store_file=None, block_file=None):
+    """ Load the indexes of `dmrid_file` and `rptrs_file` then run the clients, returns the report of a scale """
+    start = perf_counter()
+    index = ingest_dmrid(dmrid_file, workers)
+    load_seconds = perf_counter() - start
+    bitmap = IdBitmap.from_ids(index.ids)
+    start = perf_counter()
+    repeaters = RepeaterDetails.load(rptrs_file) or no_repeaters()
+    joins = JoinIndex(index, repeaters)
+    joins_seconds = perf_counter() - start
+    report = {"dmrid_file": dmrid_file, "rows": len(index), "load_seconds": load_seconds,
+              "repeaters": len(repeaters), "joins_seconds": joins_seconds,
+              "index_bytes": index.nbytes, "load_rss": peak_rss(), "worker_rss": None,
+              "clients": clients, "processes": processes,
+              "traced_peak": traced_load(dmrid_file, workers) if trace else None}
+
+    seeds = [seed + client for client in range(clients)]
+    if processes:
+        file_name = dmrid_file + ".loadtest.index"
+        write_index(file_name, index, bitmap, repeaters=repeaters)
+        try:
+            with ProcessPoolExecutor(max_workers=clients, mp_context=get_context("spawn")) as pool:
+                outputs = list(pool.map(run_shared_client, [file_name] * clients, [workload] * clients,
+                                        [duration] * clients, seeds, [store_file] * clients,
+                                        [block_file] * clients))
+        finally:
+            remove(file_name)
+        results = [samples for samples, _ in outputs]
+        report["worker_rss"] = max(rss for _, rss in outputs)
+    else:
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(run_client, [index] * clients, [bitmap] * clients, [joins] * clients,
+                                    [workload] * clients, [duration] * clients, seeds,
+                                    [store_file] * clients, [block_file] * clients))
+
+    report["peak_rss"] = peak_rss()
+    report["lookups"] = dict()
+    total = 0
+    for kind in workload:
+        samples = [sample for result in results for sample in result[kind]]
+        histogram = Histogram(max(1, len(samples)))
+        for sample in samples:
+            histogram.add(sample)
+        report["lookups"][kind] = histogram.summary()
+        total += len(samples)
+    report["throughput"] = total / duration
+    return report
+
+
+def print_report(scale, report):
+    traced = ""
+    if report["traced_peak"] is not None:
+        traced = f", {report['traced_peak'] / 2 ** 20:.1f} MiB of Python allocations"
+    workers = ""
+    if report["worker_rss"] is not None:
+        # ru_maxrss is per process: the parent does not see the memory of the client processes
+        workers = f", {report['worker_rss'] / 2 ** 20:.1f} MiB in the largest client process"
+    print(f"{scale:g}x: {report['rows']} rows loaded in {report['load_seconds']:.2f} s, "
+          f"{report['repeaters']} repeaters and joins in {report['joins_seconds']:.2f} s, "
+          f"index {report['index_bytes'] / 2 ** 20:.1f} MiB{traced}, peak RSS {report['load_rss'] / 2 ** 20:.1f} MiB "
+          f"after the load, {report['peak_rss'] / 2 ** 20:.1f} MiB in this process after the lookups{workers}")
+    print(f"    {report['throughput']:.0f} lookups/s with {report['clients']} "
+          f"{'processes' if report['processes'] else 'threads'}")
+    for kind, summary in report["lookups"].items():
+        print(f"    {kind:9s} {summary['count']:8d}  p50 {summary['p50']:9.3f} ms  "
+              f"p99 {summary['p99']:9.3f} ms  max {summary['max']:9.3f} ms")
+
+
+def print_scaling(reports):
+    """ Growth of each measure from the first scale: what grows faster than the data is a limit """
+    (first_scale, first), others = reports[0], reports[1:]
+    for scale, report in others:
+        ratios = [f"rows x{report['rows'] / first['rows']:.1f}",
+                  f"load x{report['load_seconds'] / first['load_seconds']:.1f}",
+                  f"RSS x{report['load_rss'] / first['load_rss']:.1f}"]
+        for kind, summary in report["lookups"].items():
+            base = first["lookups"][kind]["p99"]
+            if base > 0:
+                ratios.append(f"{kind} p99 x{summary['p99'] / base:.1f}")
+        print(f"{scale:g}x / {first_scale:g}x: {', '.join(ratios)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent mixed lookups on synthetic registries of "
+                                                 "growing size: load time, memory and latency per scale")
+    parser.add_argument("scales", nargs="*", type=float, default=SCALES,
+                        help="dataset sizes (10 for 10x), about 37x at most: the generated IDs stay "
+                             "in the 7 digits ID space, 100x does not fit")
+    parser.add_argument("--workload", type=parse_workload, default=WORKLOAD,
+                        help=f"lookup mix (default {','.join(f'{k}={v}' for k, v in WORKLOAD.items())})")
+    parser.add_argument("--clients", type=int, default=CLIENTS, help="concurrent clients")
+    parser.add_argument("--processes", action="store_true",
+                        help="clients are processes attached to a shared index (default: threads)")
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds of lookups per scale")
+    parser.add_argument("--workers", type=int, default=None, help="ingest processes")
+    parser.add_argument("--synth-dir", default=SYNTH_DIR, help="synthetic datasets directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also measure the Python allocations of a load (a second, slower load)")
+    parser.add_argument("--json", default=None, help="write the reports in this file")
+    args = parser.parse_args()
+
+    model = None
+    reports = list()
+    context = get_context("spawn")
+    for scale in args.scales:
+        dmrid_file, rptrs_file = dataset_files(scale, args.synth_dir)
+        if not isfile(dmrid_file):
+            model = model or SourceModel()
+            start = perf_counter()
+            generate(scale, dataset_dir(scale, args.synth_dir), args.seed, model=model)
+            print(f"{scale:g}x: generated in {perf_counter() - start:.1f} s")
+        store_file, block_file = prepare(scale, args.workload, args.synth_dir)
+        # a fresh process per scale: its peak RSS is the one of this scale only
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            report = pool.submit(measure, dmrid_file, rptrs_file, args.workload, args.clients, args.duration,
+                                 args.processes, args.workers, args.seed, args.tracemalloc,
+                                 store_file, block_file).result()
+        report["scale"] = scale
+        print_report(scale, report)
+        reports.append((scale, report))
+
+    if len(reports) > 1:
+        print_scaling(reports)
+    if args.json:
+        with open(args.json, "w") as file_path:
+            json.dump([report for _, report in reports], file_path, indent=1)
+
+
+if __name__ == "__main__":
+    main()
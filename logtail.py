@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID log tail: annotate DMR IDs of MMDVMHost/hotspot logs     #
+######################################################################
+import re
+import sys
+import json
+import argparse
+from os import stat
+from time import sleep, strftime
+
+from registry import Resolver, DMRID_FILE
+from ingest import load_resolver
+from shared_index import SharedIndex
+
+POLL_INTERVAL = 0.2
+READ_SIZE = 65536
+# a longer line without newline is returned in pieces: the memory of a follower stays bounded
+MAX_LINE_LENGTH = 4 * READ_SIZE
+# "DMR Slot 2, received network voice header from 2080001 to TG 208"
+CALL_REGEXP = re.compile(r"\bfrom (\d{1,7}) to (TG )?(\d{1,7})\b")
+# Any other 6/7 digits token ("Downlink Activate received from 2080001", DMRGateway ...)
+ID_REGEXP = re.compile(r"(?<![\d.:-])(\d{6,7})(?![\d.:-])")
+TIME_REGEXP = re.compile(r"^\w: (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)")
+
+
+class HeardEvent:
+    """ One log line with the IDs it contains """
+
+    __slots__ = ("time", "source", "destination", "talkgroup", "line", "log")
+
+    def __init__(self, time, source, destination, talkgroup, line, log):
+        self.time = time
+        self.source = source
+        self.destination = destination
+        self.talkgroup = talkgroup
+        self.line = line
+        self.log = log
+
+    def as_dict(self):
+        return {"time": self.time, "source": self.source,
+                "destination": self.destination, "talkgroup": self.talkgroup,
+                "line": self.line, "log": self.log}
+
+
+def tokenize(line, log=""):
+    """ HeardEvent of a log line, None if the line has no DMR ID """
+    match = CALL_REGEXP.search(line)
+    if match is not None:
+        source = int(match.group(1))
+        talkgroup = match.group(2) is not None
+        destination = int(match.group(3))
+    else:
+        match = ID_REGEXP.search(line)
+        if match is None:
+            return None
+        source = int(match.group(1))
+        talkgroup = False
+        destination = None
+
+    time = TIME_REGEXP.match(line)
+    return HeardEvent(time.group(1) if time is not None else strftime("%Y-%m-%d %H:%M:%S"),
+                      source, destination, talkgroup, line, log)
+
+
+def annotate(event, resolver):
+    """ Resolve the IDs of an event, returns (source, destination) dicts or None """
+    source = resolver.resolve(event.source)
+    destination = None
+    if event.destination is not None and not event.talkgroup:
+        destination = resolver.resolve(event.destination)
+    return source, destination
+
+
+def format_user(user):
+    text = user["callsign"]
+    details = ", ".join(value for value in (user["name"], user["country"]) if value)
+    if details:
+        text += f" ({details})"
+    return text
+
+
+def annotated_line(event, source, destination):
+    notes = list()
+    if source is not None:
+        notes.append(f"{event.source}={format_user(source)}")
+    if destination is not None:
+        notes.append(f"{event.destination}={format_user(destination)}")
+    if not notes:
+        return event.line
+    return f"{event.line}  [{' / '.join(notes)}]"
+
+
+class LogFollower:
+    """ `tail -F` of one file: survives truncation and rotation, keeps only a partial line """
+
+    def __init__(self, file_name, from_start=False):
+        self.file_name = file_name
+        self.handle = None
+        self.inode = None
+        self.partial = ""
+        self.from_start = from_start
+
+    def _open(self):
+        try:
+            self.handle = open(self.file_name, "r", encoding="utf-8", errors="replace")
+        except OSError:
+            self.handle = None
+            return
+        self.inode = stat(self.file_name).st_ino
+        if not self.from_start:
+            self.handle.seek(0, 2)
+        self.from_start = True
+        self.partial = ""
+
+    def _rotated(self):
+        try:
+            info = stat(self.file_name)
+        except OSError:
+            return False
+        return info.st_ino != self.inode or info.st_size < self.handle.tell()
+
+    def read_lines(self):
+        """ Complete lines written since the last call """
+        if self.handle is None:
+            self._open()
+            if self.handle is None:
+                return []
+
+        data = self.handle.read(READ_SIZE)
+        if data == "":
+            if self._rotated():
+                self.handle.close()
+                self._open()
+            return []
+
+        data = self.partial + data
+        lines = data.split("\n")
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE_LENGTH:
+            lines.append(self.partial)
+            self.partial = ""
+        return lines
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+def follow(file_names, from_start=False, running=lambda: True):
+    """ Yield (file name, line) of several growing log files until `running()` is False """
+    followers = [LogFollower(file_name, from_start) for file_name in file_names]
+    try:
+        while running():
+            idle = True
+            for follower in followers:
+                for line in follower.read_lines():
+                    idle = False
+                    yield follower.file_name, line
+            if idle:
+                sleep(POLL_INTERVAL)
+    finally:
+        for follower in followers:
+            follower.close()
+
+
+def read_stdin():
+    for line in sys.stdin:
+        yield "-", line.rstrip("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the DMR IDs of MMDVMHost style logs "
+                                                 "with the callsigns of dmrid.dat")
+    parser.add_argument("logs", nargs="*", help="log files to follow (stdin if none)")
+    parser.add_argument("--from-start", action="store_true", help="read the files from the beginning")
+    parser.add_argument("--json", action="store_true", help="print one JSON event per line")
+    parser.add_argument("--dmrid", default=DMRID_FILE, help="dmrid.dat file")
+    parser.add_argument("--users", default=None, help="user.csv or users.json for names and countries")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="parse the registry files with N processes (0: single process)")
+    parser.add_argument("--shared-index", default=None,
+                        help="attach the index file written by shared_index.py publish instead of loading")
+    args = parser.parse_args()
+
+    if args.shared_index:
+        resolver = SharedIndex(args.shared_index).resolver()
+    elif args.workers:
+        resolver = load_resolver(args.dmrid, args.users, args.workers)
+    else:
+        resolver = Resolver.load(args.dmrid, args.users)
+    lines = follow(args.logs, args.from_start) if args.logs else read_stdin()
+    output = sys.stdout
+
+    try:
+        for log, line in lines:
+            event = tokenize(line, log)
+            if event is None:
+                if not args.json:
+                    output.write(line + "\n")
+                continue
+            source, destination = annotate(event, resolver)
+            if args.json:
+                record = event.as_dict()
+                record["source_user"] = source
+                record["destination_user"] = destination
+                output.write(json.dumps(record) + "\n")
+            else:
+                output.write(annotated_line(event, source, destination) + "\n")
+            if args.logs:
+                output.flush()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID query metrics: timing spans, histograms, traces, profile #
+######################################################################
+import json
+import cProfile
+import pstats
+from time import perf_counter
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+HISTOGRAM_SIZE = 500
+TRACE_SIZE = 5000
+BREAKDOWN_STAGES = [("db", "db"),
+                    ("net", "net"),
+                    ("parse", "parse"),
+                    ("fill", "fill"),
+                    ("render", "render")]
+
+
+def now_ms():
+    return perf_counter() * 1000.0
+
+
+class Histogram:
+    """ Rolling window of the last samples of a stage (in ms) """
+
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.samples = deque(maxlen=size)
+        self.total_count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.total_count += 1
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self):
+        return {"count": self.total_count,
+                "window": len(self.samples),
+                "mean": sum(self.samples) / len(self.samples) if self.samples else 0.0,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "max": max(self.samples) if self.samples else 0.0}
+
+
+class Query:
+    """ Timing spans of one search, from make_url to the table repaint """
+
+    def __init__(self, query_id, label):
+        self.query_id = query_id
+        self.label = label
+        self.start = now_ms()
+        self.spans = list()
+        self.open_spans = dict()
+
+    def begin(self, name):
+        self.open_spans[name] = now_ms()
+
+    def end(self, name):
+        start = self.open_spans.pop(name, None)
+        if start is None:
+            return 0.0
+        return self.add(name, start, now_ms())
+
+    def add(self, name, start, end):
+        self.spans.append((name, start, end))
+        return end - start
+
+    def stage_total(self, stage):
+        """ Wall time covered by the spans named `stage` or `stage.<something>`,
+        concurrent spans (fan-out requests) are counted once """
+        intervals = sorted((start, end) for name, start, end in self.spans
+                           if name == stage or name.startswith(f"{stage}."))
+        total = 0.0
+        current_start = current_end = None
+        for start, end in intervals:
+            if current_end is None or start > current_end:
+                if current_end is not None:
+                    total += current_end - current_start
+                current_start, current_end = start, end
+            else:
+                current_end = max(current_end, end)
+        if current_end is not None:
+            total += current_end - current_start
+        return total
+
+    def breakdown(self):
+        parts = list()
+        for stage, label in BREAKDOWN_STAGES:
+            if any(name == stage or name.startswith(f"{stage}.") for name, _, _ in self.spans):
+                parts.append(f"{label} {self.stage_total(stage):.0f} ms")
+        return " · ".join(parts)
+
+
+class Metrics:
+    """ Hot path instrumentation shared by the whole application """
+
+    def __init__(self):
+        self.histograms = OrderedDict()
+        self.counters = OrderedDict()
+        self.trace = deque(maxlen=TRACE_SIZE)
+        self.origin = now_ms()
+        self.query_count = 0
+        self.current = None
+        self.profiler = None
+        self.profile_remaining = 0
+        self.profile_file = None
+
+    # ####### Queries
+    def begin_query(self, label):
+        self.query_count += 1
+        self.current = Query(self.query_count, label)
+        if self.profile_remaining > 0 and self.profiler is None:
+            self.profiler = cProfile.Profile()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self.current
+
+    def end_query(self, query=None):
+        """ Close a query, feed the histograms and the trace, return the breakdown """
+        query = query or self.current
+        if query is None:
+            return ""
+        end = now_ms()
+        for name, start, stop in query.spans:
+            self.histogram(name).add(stop - start)
+            self.trace.append({"name": name, "cat": "query", "ph": "X",
+                               "ts": (start - self.origin) * 1000.0,
+                               "dur": (stop - start) * 1000.0,
+                               "pid": 1, "tid": query.query_id,
+                               "args": {"query": query.label}})
+        self.histogram("total").add(end - query.start)
+        self.trace.append({"name": "total", "cat": "query", "ph": "X",
+                           "ts": (query.start - self.origin) * 1000.0,
+                           "dur": (end - query.start) * 1000.0,
+                           "pid": 1, "tid": query.query_id,
+                           "args": {"query": query.label}})
+        if query is self.current:
+            self.current = None
+        self._profile_step()
+        return query.breakdown()
+
+    @contextmanager
+    def span(self, name, query=None):
+        query = query or self.current
+        start = now_ms()
+        try:
+            yield
+        finally:
+            if query is not None:
+                query.add(name, start, now_ms())
+            else:
+                self.histogram(name).add(now_ms() - start)
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        return OrderedDict((name, hist.summary()) for name, hist in self.histograms.items())
+
+    # ####### Export
+    def export_trace(self, file_name):
+        """ Write the recorded spans in the Chrome trace event format (chrome://tracing, Perfetto) """
+        with open(file_name, "w") as file_path:
+            json.dump({"traceEvents": list(self.trace),
+                       "displayTimeUnit": "ms",
+                       "otherData": {"histograms": self.summary(),
+                                     "counters": dict(self.counters)}},
+                      file_path, indent=1)
+
+    # ####### cProfile capture
+    def profile_next(self, searches, file_name):
+        """ Profile the next `searches` queries and dump the stats in `file_name` """
+        self.profile_remaining = searches
+        self.profile_file = file_name
+
+    def _profile_step(self):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        self.profile_remaining -= 1
+        if self.profile_remaining <= 0:
+            stats = pstats.Stats(self.profiler)
+            stats.dump_stats(self.profile_file)
+            self.profiler = None
+            self.profile_remaining = 0
+
+
+METRICS = Metrics()
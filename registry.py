@@ -0,0 +1,601 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID local registry: compact in-memory indexes of data_files  #
+######################################################################
+import re
+import csv
+import json
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from itertools import islice
+
+from blockstore import dataset_exists, open_dataset
+
+DMRID_FILE = "./data_files/dmrid.dat"
+RPTRS_FILE = "./data_files/rptrs.json"
+USER_CSV_FILE = "./data_files/user.csv"
+USERS_JSON_FILE = "./data_files/users.json"
+RESOLVER_CACHE_SIZE = 4096
+RELATED_LIMIT = 100
+ID_DIGITS = 7
+ID_SPACE = 10 ** ID_DIGITS
+NON_EMPTY_BYTE = re.compile(rb"[^\x00]")
+NON_FULL_BYTE = re.compile(rb"[^\xff]")
+# Callsigns are packed in base 37: digit 0 pads the short ones on the right,
+# so the packed integers sort like the strings and a prefix is a value range.
+CALLSIGN_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+CALLSIGN_DIGITS = {char: i + 1 for i, char in enumerate(CALLSIGN_ALPHABET)}
+PACKED_LENGTH = 12
+PACKED_BASE = len(CALLSIGN_ALPHABET) + 1
+PACKED_POWERS = [PACKED_BASE ** i for i in range(0, PACKED_LENGTH + 1)]
+
+
+class StringColumn:
+    """ Strings stored back to back in one bytes blob, addressed by an offsets array """
+
+    def __init__(self, blob=b"", offsets=None):
+        self.blob = blob
+        self.offsets = offsets if offsets is not None else array("I", [0])
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = array("I", [0])
+        position = 0
+        for value in encoded:
+            position += len(value)
+            offsets.append(position)
+        return cls(b"".join(encoded), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return bytes(self.blob[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8")
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + len(self.offsets) * self.offsets.itemsize
+
+
+def pack_callsign(callsign):
+    """ 64 bits integer of a callsign of up to 12 [0-9A-Z] characters, None otherwise """
+    if len(callsign) > PACKED_LENGTH:
+        return None
+    value = 0
+    try:
+        for char in callsign:
+            value = value * PACKED_BASE + CALLSIGN_DIGITS[char]
+    except KeyError:
+        return None
+    return value * PACKED_POWERS[PACKED_LENGTH - len(callsign)]
+
+
+def unpack_callsign(value):
+    chars = list()
+    for _ in range(0, PACKED_LENGTH):
+        value, digit = divmod(value, PACKED_BASE)
+        if digit:
+            chars.append(CALLSIGN_ALPHABET[digit - 1])
+    return "".join(reversed(chars))
+
+
+def prefix_range(prefix):
+    """ [low, high] packed values of the callsigns starting with `prefix`, None if not packable """
+    low = pack_callsign(prefix)
+    if low is None:
+        return None
+    return low, low + PACKED_POWERS[PACKED_LENGTH - len(prefix)] - 1
+
+
+class PackedCallsignColumn:
+    """ One callsign per row as packed 64 bits integers, with a sorted order for
+    exact and prefix lookups and an overflow pool for the callsigns that do not pack """
+
+    def __init__(self, values, order, overflow):
+        # values[row] >= 0 is a packed callsign, -1 - k is overflow[k]
+        self.values = values
+        self.order = order
+        self.overflow = overflow
+
+    @classmethod
+    def from_strings(cls, callsigns):
+        values = array("q")
+        overflow = list()
+        for callsign in callsigns:
+            value = pack_callsign(callsign)
+            if value is None:
+                value = -1 - len(overflow)
+                overflow.append(callsign)
+            values.append(value)
+        return cls.from_values(values, StringColumn.from_strings(overflow))
+
+    @classmethod
+    def from_values(cls, values, overflow):
+        order = array("I", sorted((row for row in range(len(values)) if values[row] >= 0),
+                                  key=values.__getitem__))
+        return cls(values, order, overflow)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, row):
+        value = self.values[row]
+        if value < 0:
+            return self.overflow[-1 - value]
+        return unpack_callsign(value)
+
+    def _range(self, low, high):
+        key = self.values.__getitem__
+        start = bisect_left(self.order, low, key=key)
+        stop = bisect_right(self.order, high, key=key)
+        return self.order[start:stop]
+
+    def _overflow_rows(self, test):
+        wanted = {-1 - k for k in range(len(self.overflow)) if test(self.overflow[k])}
+        if not wanted:
+            return []
+        return [row for row in range(len(self.values)) if self.values[row] in wanted]
+
+    def find(self, callsign):
+        """ Rows holding exactly `callsign` """
+        callsign = callsign.strip().upper()
+        value = pack_callsign(callsign)
+        if value is None:
+            return self._overflow_rows(lambda other: other == callsign)
+        return list(self._range(value, value))
+
+    def prefix(self, prefix):
+        """ Rows of the callsigns starting with `prefix` """
+        prefix = prefix.strip().upper()
+        rows = self._overflow_rows(lambda other: other.startswith(prefix))
+        bounds = prefix_range(prefix[:PACKED_LENGTH])
+        if bounds is not None:
+            rows = list(self._range(*bounds)) + rows
+            if len(prefix) > PACKED_LENGTH:
+                rows = [row for row in rows if self[row].startswith(prefix)]
+        return rows
+
+    def match(self, pattern):
+        """ Rows matching a RadioID style pattern where % is a wildcard """
+        pattern = pattern.strip().upper()
+        if "%" not in pattern:
+            return self.find(pattern)
+        head, _, tail = pattern.partition("%")
+        if tail == "":
+            return self.prefix(head)
+        regexp = re.compile(".*".join(re.escape(part) for part in pattern.split("%")) + "$")
+        return [row for row in self.prefix(head) if regexp.match(self[row])]
+
+    @property
+    def nbytes(self):
+        return (len(self.values) * self.values.itemsize + len(self.order) * self.order.itemsize
+                + self.overflow.nbytes)
+
+
+def read_repeater_ids(file_name=RPTRS_FILE):
+    with open_dataset(file_name) as file_path:
+        return [int(repeater["id"]) for repeater in json.load(file_path)["rptrs"]
+                if str(repeater.get("id", "")).isdigit()]
+
+
+def prefix_bounds(prefix, digits=ID_DIGITS):
+    """ [low, high] of the `digits` long IDs starting with `prefix` ("208" -> 2080000, 2089999) """
+    scale = 10 ** (digits - len(prefix))
+    low = int(prefix) * scale
+    return low, low + scale - 1
+
+
+class IdBitmap:
+    """ One bit per ID of the 7 digits DMR ID space (1.25 MB): assigned or not """
+
+    def __init__(self, bits=None):
+        self.bits = bits if bits is not None else bytearray(ID_SPACE // 8)
+
+    @classmethod
+    def from_ids(cls, *id_lists):
+        bitmap = cls()
+        bits = bitmap.bits
+        for ids in id_lists:
+            for dmr_id in ids:
+                if 0 <= dmr_id < ID_SPACE:
+                    bits[dmr_id >> 3] |= 1 << (dmr_id & 7)
+        return bitmap
+
+    @classmethod
+    def load(cls, dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE):
+        id_lists = [read_dmrid(dmrid_file)[0]]
+        if dataset_exists(rptrs_file):
+            id_lists.append(read_repeater_ids(rptrs_file))
+        return cls.from_ids(*id_lists)
+
+    def add(self, dmr_id):
+        self.bits[dmr_id >> 3] |= 1 << (dmr_id & 7)
+
+    def __contains__(self, dmr_id):
+        return 0 <= dmr_id < ID_SPACE and (self.bits[dmr_id >> 3] >> (dmr_id & 7)) & 1 == 1
+
+    def count(self, low=0, high=ID_SPACE - 1):
+        """ Number of assigned IDs in [low, high] """
+        low = max(low, 0)
+        high = min(high, ID_SPACE - 1)
+        if low > high:
+            return 0
+        first_byte = (low + 7) >> 3
+        last_byte = (high + 1) >> 3
+        if first_byte >= last_byte:
+            return sum(1 for dmr_id in range(low, high + 1) if dmr_id in self)
+        total = int.from_bytes(self.bits[first_byte:last_byte], "little").bit_count()
+        total += sum(1 for dmr_id in range(low, first_byte << 3) if dmr_id in self)
+        total += sum(1 for dmr_id in range(last_byte << 3, high + 1) if dmr_id in self)
+        return total
+
+    def free_blocks(self, low=0, high=ID_SPACE - 1, min_size=1):
+        """ [(first, last)] runs of unassigned IDs in [low, high], empty or full bytes are skipped """
+        bits = self.bits
+        blocks = list()
+        start = None
+        dmr_id = max(low, 0)
+        high = min(high, ID_SPACE - 1)
+        while dmr_id <= high:
+            if dmr_id & 7 == 0 and dmr_id + 7 <= high:
+                byte = bits[dmr_id >> 3]
+                end_byte = (high + 1) >> 3
+                if byte == 0:
+                    if start is None:
+                        start = dmr_id
+                    match = NON_EMPTY_BYTE.search(bits, dmr_id >> 3, end_byte)
+                    dmr_id = match.start() << 3 if match is not None else end_byte << 3
+                    continue
+                if byte == 0xFF:
+                    if start is not None:
+                        blocks.append((start, dmr_id - 1))
+                        start = None
+                    match = NON_FULL_BYTE.search(bits, dmr_id >> 3, end_byte)
+                    dmr_id = match.start() << 3 if match is not None else end_byte << 3
+                    continue
+            if (bits[dmr_id >> 3] >> (dmr_id & 7)) & 1:
+                if start is not None:
+                    blocks.append((start, dmr_id - 1))
+                    start = None
+            elif start is None:
+                start = dmr_id
+            dmr_id += 1
+        if start is not None:
+            blocks.append((start, high))
+        return [(first, last) for first, last in blocks if last - first + 1 >= min_size]
+
+    def prefix_report(self, prefix, min_size=1, digits=ID_DIGITS):
+        """ Allocation of a country prefix ("208"): size, assigned and free blocks """
+        low, high = prefix_bounds(prefix, digits)
+        assigned = self.count(low, high)
+        return {"prefix": prefix, "low": low, "high": high,
+                "size": high - low + 1, "assigned": assigned,
+                "free": high - low + 1 - assigned,
+                "free_blocks": self.free_blocks(low, high, min_size)}
+
+
+def read_dmrid(file_name=DMRID_FILE):
+    """ Parse dmrid.dat ("id;callsign;" lines) into (ids, callsigns) lists """
+    ids = list()
+    callsigns = list()
+    with open_dataset(file_name, binary=True) as file_path:
+        for line in file_path:
+            fields = line.split(b";")
+            if len(fields) < 2 or not fields[0].strip().isdigit():
+                continue
+            ids.append(int(fields[0]))
+            callsigns.append(fields[1].strip().decode("utf-8", "replace").upper())
+    return ids, callsigns
+
+
+class DmrIdIndex:
+    """ Sorted DMR ID -> callsign index built from dmrid.dat, searchable by callsign """
+
+    def __init__(self, ids, callsigns):
+        self.ids = ids
+        self.callsigns = callsigns
+
+    @classmethod
+    def from_records(cls, ids, callsigns):
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        return cls(array("I", [ids[i] for i in order]),
+                   PackedCallsignColumn.from_strings([callsigns[i] for i in order]))
+
+    @classmethod
+    def load(cls, file_name=DMRID_FILE):
+        return cls.from_records(*read_dmrid(file_name))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, dmr_id):
+        """ Row of `dmr_id` or -1 """
+        row = bisect_left(self.ids, dmr_id)
+        if row < len(self.ids) and self.ids[row] == dmr_id:
+            return row
+        return -1
+
+    def __contains__(self, dmr_id):
+        return self.row(dmr_id) >= 0
+
+    def callsign(self, dmr_id):
+        row = self.row(dmr_id)
+        if row < 0:
+            return None
+        return self.callsigns[row]
+
+    def find_callsign(self, callsign):
+        """ Sorted DMR IDs of a callsign (a callsign often has several IDs) """
+        return sorted(self.ids[row] for row in self.callsigns.find(callsign))
+
+    def match_callsign(self, pattern):
+        """ Sorted DMR IDs of the callsigns matching `pattern` ("F4%", "%TV", ...) """
+        return sorted(self.ids[row] for row in self.callsigns.match(pattern))
+
+    @property
+    def nbytes(self):
+        return len(self.ids) * self.ids.itemsize + self.callsigns.nbytes
+
+
+class UserDetails:
+    """ DMR ID -> name, city, state and country from user.csv or users.json """
+
+    FIELDS = ["fname", "surname", "city", "state", "country"]
+
+    def __init__(self, ids, columns):
+        self.ids = ids
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records):
+        """ `records` is an iterable of (id, fname, surname, city, state, country) """
+        records = sorted(records)
+        ids = array("I", [record[0] for record in records])
+        columns = [StringColumn.from_strings([record[i + 1] for record in records])
+                   for i in range(len(cls.FIELDS))]
+        return cls(ids, columns)
+
+    @classmethod
+    def load(cls, file_name=None):
+        """ Load user.csv or users.json, None if no file was downloaded """
+        if file_name is None:
+            if dataset_exists(USER_CSV_FILE):
+                file_name = USER_CSV_FILE
+            elif dataset_exists(USERS_JSON_FILE):
+                file_name = USERS_JSON_FILE
+            else:
+                return None
+
+        if file_name.endswith(".json"):
+            with open_dataset(file_name) as file_path:
+                users = json.load(file_path)["users"]
+            records = [(int(user["radio_id"] if "radio_id" in user else user["id"]),
+                        user.get("fname", "") or "", user.get("surname", "") or "",
+                        user.get("city", "") or "", user.get("state", "") or "",
+                        user.get("country", "") or "")
+                       for user in users]
+        else:
+            with open_dataset(file_name) as file_path:
+                reader = csv.reader(file_path)
+                next(reader, None)
+                records = [(int(row[0]), row[2], row[3], row[4], row[5], row[6])
+                           for row in reader if len(row) >= 7 and row[0].isdigit()]
+        return cls.from_records(records)
+
+    def get(self, dmr_id):
+        row = bisect_left(self.ids, dmr_id)
+        if row < len(self.ids) and self.ids[row] == dmr_id:
+            return {field: self.columns[i][row] for i, field in enumerate(self.FIELDS)}
+        return None
+
+
+class RepeaterDetails:
+    """ Repeater ID -> callsign, location, frequency and network from rptrs.json """
+
+    FIELDS = ["callsign", "city", "state", "country", "frequency", "offset", "color_code",
+              "trustee", "ipsc_network"]
+
+    def __init__(self, ids, columns):
+        self.ids = ids
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records):
+        """ `records` is an iterable of (id, callsign, city, ..., ipsc_network) """
+        records = sorted(records)
+        ids = array("I", [record[0] for record in records])
+        columns = [StringColumn.from_strings([record[i + 1] for record in records])
+                   for i in range(len(cls.FIELDS))]
+        return cls(ids, columns)
+
+    @classmethod
+    def load(cls, file_name=RPTRS_FILE):
+        """ Load rptrs.json, None if it was not downloaded """
+        if not dataset_exists(file_name):
+            return None
+        with open_dataset(file_name) as file_path:
+            repeaters = json.load(file_path)["rptrs"]
+        return cls.from_records((int(repeater["id"]),) + tuple("" if repeater.get(field) is None
+                                                               else str(repeater[field]).strip()
+                                                               for field in cls.FIELDS)
+                                for repeater in repeaters if str(repeater.get("id", "")).isdigit())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, repeater_id):
+        row = bisect_left(self.ids, repeater_id)
+        if row < len(self.ids) and self.ids[row] == repeater_id:
+            return {field: self.columns[i][row] for i, field in enumerate(self.FIELDS)}
+        return None
+
+
+class Resolver:
+    """ DMR ID resolution through the local indexes with an LRU of the hot IDs """
+
+    def __init__(self, index, details=None, cache_size=RESOLVER_CACHE_SIZE, bitmap=None):
+        self.index = index
+        self.details = details
+        self.bitmap = bitmap
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, dmrid_file=DMRID_FILE, users_file=None):
+        index = DmrIdIndex.load(dmrid_file)
+        return cls(index, UserDetails.load(users_file), bitmap=IdBitmap.from_ids(index.ids))
+
+    def resolve(self, dmr_id):
+        """ Dict with callsign, name, city, state and country of `dmr_id`, None if unknown """
+        if self.bitmap is not None and 0 <= dmr_id < ID_SPACE and dmr_id not in self.bitmap:
+            # unassigned IDs (talkgroups, typos) never reach the LRU, the bitmap
+            # only covers the 7 digits space: longer IDs go through the index
+            return None
+        try:
+            result = self.cache[dmr_id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(dmr_id)
+            return result
+
+        result = None
+        callsign = self.index.callsign(dmr_id)
+        if callsign is not None:
+            result = {"id": dmr_id, "callsign": callsign, "name": "",
+                      "city": "", "state": "", "country": ""}
+            if self.details is not None:
+                user = self.details.get(dmr_id)
+                if user is not None:
+                    result["name"] = f"{user['fname']} {user['surname']}".strip()
+                    result["city"] = user["city"]
+                    result["state"] = user["state"]
+                    result["country"] = user["country"]
+
+        self.cache[dmr_id] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+
+class JoinIndex:
+    """ Precomputed links between the users of dmrid.dat and the repeaters of rptrs.json:
+    callsign -> IDs, trustee -> repeaters and city / state -> repeaters """
+
+    def __init__(self, users, repeaters):
+        self.users = users
+        self.repeaters = repeaters
+        fields = RepeaterDetails.FIELDS
+        trustees = repeaters.columns[fields.index("trustee")]
+        cities = repeaters.columns[fields.index("city")]
+        states = repeaters.columns[fields.index("state")]
+        self.trustees = PackedCallsignColumn.from_strings([trustees[row].strip().upper()
+                                                           for row in range(len(repeaters))])
+        self.cities = dict()
+        self.states = dict()
+        for row in range(len(repeaters)):
+            self.cities.setdefault(cities[row].strip().casefold(), array("I")).append(row)
+            self.states.setdefault(states[row].strip().casefold(), array("I")).append(row)
+
+    @classmethod
+    def load(cls, dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE):
+        repeaters = RepeaterDetails.load(rptrs_file)
+        if repeaters is None:
+            repeaters = RepeaterDetails(array("I"), [StringColumn() for _ in RepeaterDetails.FIELDS])
+        return cls(DmrIdIndex.load(dmrid_file), repeaters)
+
+    def callsign_ids(self, callsign):
+        """ Every DMR ID of a callsign """
+        return self.users.find_callsign(callsign)
+
+    def repeater(self, row):
+        record = {field: self.repeaters.columns[i][row] for i, field in enumerate(RepeaterDetails.FIELDS)}
+        record["id"] = self.repeaters.ids[row]
+        return record
+
+    def repeater_by_id(self, repeater_id):
+        row = bisect_left(self.repeaters.ids, repeater_id)
+        if row < len(self.repeaters.ids) and self.repeaters.ids[row] == repeater_id:
+            return self.repeater(row)
+        return None
+
+    def repeater_rows(self, rows, exclude=None, limit=None):
+        """ Records of the first `limit` rows, the repeater `exclude` left out: only those are built """
+        rows = (row for row in rows if self.repeaters.ids[row] != exclude)
+        return [self.repeater(row) for row in islice(rows, limit)]
+
+    def trustee_repeaters(self, callsign, exclude=None, limit=None):
+        """ Repeaters whose trustee is `callsign` """
+        return self.repeater_rows(self.trustees.find(callsign), exclude, limit)
+
+    def location_repeaters(self, city, state="", exclude=None, limit=None):
+        """ Repeaters of a city (in `state` when given), or of a state when `city` is empty """
+        city = city.strip().casefold()
+        state = state.strip().casefold()
+        if not city:
+            return self.repeater_rows(self.states.get(state, []), exclude, limit) if state else []
+        rows = self.cities.get(city, [])
+        if state:
+            state_column = self.repeaters.columns[RepeaterDetails.FIELDS.index("state")]
+            rows = (row for row in rows if state_column[row].strip().casefold() == state)
+        return self.repeater_rows(rows, exclude, limit)
+
+    def related(self, callsign, dmr_id, city="", state="", repeater=False, limit=RELATED_LIMIT):
+        """ [(relation, record)] of a user or repeater result row, at most `limit` per relation """
+        related = list()
+        if repeater:
+            record = self.repeater_by_id(dmr_id)
+            trustee = record["trustee"].strip().upper() if record is not None else ""
+            if trustee:
+                related += [(f"ID of trustee {trustee}", {"id": other, "callsign": trustee})
+                            for other in self.callsign_ids(trustee)[:limit]]
+                related += [(f"Also run by {trustee}", other)
+                            for other in self.trustee_repeaters(trustee, dmr_id, limit)]
+        else:
+            others = (other for other in self.callsign_ids(callsign) if other != dmr_id)
+            related += [(f"Other ID of {callsign}", {"id": other, "callsign": callsign})
+                        for other in islice(others, limit)]
+            related += [(f"Repeater run by {callsign}", other)
+                        for other in self.trustee_repeaters(callsign, limit=limit)]
+        related += [("Repeater in the same city" if city else "Repeater in the same state", other)
+                    for other in self.location_repeaters(city, state, dmr_id, limit)]
+        return related
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DMR ID allocation reports from dmrid.dat and rptrs.json")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser("check", help="are these IDs assigned ?")
+    check_parser.add_argument("ids", nargs="+", type=int)
+    count_parser = subparsers.add_parser("count", help="assigned IDs in [low, high]")
+    count_parser.add_argument("low", type=int)
+    count_parser.add_argument("high", type=int)
+    free_parser = subparsers.add_parser("free", help="unassigned ID blocks of a country prefix")
+    free_parser.add_argument("prefix")
+    free_parser.add_argument("--min-size", type=int, default=100)
+    free_parser.add_argument("--digits", type=int, default=ID_DIGITS)
+    args = parser.parse_args()
+
+    bitmap = IdBitmap.load()
+    if args.command == "check":
+        for dmr_id in args.ids:
+            print(f"{dmr_id}: {'assigned' if dmr_id in bitmap else 'free'}")
+    elif args.command == "count":
+        print(bitmap.count(args.low, args.high))
+    elif args.command == "free":
+        report = bitmap.prefix_report(args.prefix, args.min_size, args.digits)
+        print(f"{report['prefix']}: {report['low']}-{report['high']}, "
+              f"{report['assigned']} assigned, {report['free']} free")
+        for first, last in report["free_blocks"]:
+            print(f"{first}-{last} ({last - first + 1})")
+
+
+if __name__ == "__main__":
+    main()
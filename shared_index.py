@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID shared index: one read-only copy of the registry per host #
+######################################################################
+import os
+import json
+import mmap
+import struct
+import argparse
+from os.path import isdir, isfile
+from time import perf_counter
+
+from registry import (DMRID_FILE, RPTRS_FILE, USER_CSV_FILE, USERS_JSON_FILE, RESOLVER_CACHE_SIZE, StringColumn,
+                      PackedCallsignColumn, DmrIdIndex, UserDetails, RepeaterDetails, IdBitmap, Resolver)
+from ingest import ingest_dmrid, ingest_users
+from blockstore import dataset_exists
+
+# /dev/shm is memory backed: the mapped pages are the shared memory, without a
+# resource tracker that would unlink a segment when its creator exits.
+SHARED_INDEX_FILE = ("/dev/shm/pyradioid.index" if isdir("/dev/shm")
+                     else "./data_files/registry.index")
+MAGIC = b"PYRIDX01"
+HEADER = struct.Struct("<8sQ")
+ALIGNMENT = 8
+
+
+def string_sections(name, column):
+    return [(f"{name}.blob", "B", column.blob), (f"{name}.offsets", "I", column.offsets)]
+
+
+def index_sections(index, bitmap, details=None, repeaters=None):
+    """ [(name, typecode, buffer)] of the indexes, in file order """
+    sections = [("ids", "I", index.ids),
+                ("callsigns.values", "q", index.callsigns.values),
+                ("callsigns.order", "I", index.callsigns.order)]
+    sections += string_sections("callsigns.overflow", index.callsigns.overflow)
+    sections.append(("bitmap", "B", bitmap.bits))
+    for prefix, table in (("users", details), ("repeaters", repeaters)):
+        if table is None:
+            continue
+        sections.append((f"{prefix}.ids", "I", table.ids))
+        for field, column in zip(table.FIELDS, table.columns):
+            sections += string_sections(f"{prefix}.{field}", column)
+    return sections
+
+
+def aligned(position):
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_index(file_name, index, bitmap, details=None, repeaters=None):
+    """ Write the indexes in `file_name`, atomically: attached workers keep their mapping
+    of the previous file until they attach again """
+    sections = index_sections(index, bitmap, details, repeaters)
+    directory = dict()
+    position = 0
+    for name, typecode, buffer in sections:
+        nbytes = memoryview(buffer).nbytes
+        directory[name] = [position, nbytes, typecode]
+        position = aligned(position + nbytes)
+    header = json.dumps({"sections": directory}).encode("utf-8")
+    data_start = aligned(HEADER.size + len(header))
+
+    temp_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(temp_name, "wb") as file_path:
+        file_path.write(HEADER.pack(MAGIC, len(header)))
+        file_path.write(header)
+        for name, _, buffer in sections:
+            file_path.seek(data_start + directory[name][0])
+            file_path.write(memoryview(buffer).cast("B"))
+        file_path.truncate(data_start + position)
+    os.replace(temp_name, file_name)
+    return data_start + position
+
+
+class SharedIndex:
+    """ Indexes attached zero-copy from a file written by `publish`, read-only """
+
+    def __init__(self, file_name=SHARED_INDEX_FILE):
+        self.file_name = file_name
+        with open(file_name, "rb") as file_path:
+            self.map = mmap.mmap(file_path.fileno(), 0, access=mmap.ACCESS_READ)
+        self.views = [memoryview(self.map)]
+        magic, header_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{file_name} is not a PyRadioID index")
+        header = json.loads(bytes(self.map[HEADER.size:HEADER.size + header_size]))
+        self.sections = header["sections"]
+        self.data_start = aligned(HEADER.size + header_size)
+
+        self.index = DmrIdIndex(self.section("ids"),
+                                PackedCallsignColumn(self.section("callsigns.values"),
+                                                     self.section("callsigns.order"),
+                                                     self.strings("callsigns.overflow")))
+        self.bitmap = IdBitmap(self.section("bitmap"))
+        self.details = self.table(UserDetails, "users")
+        self.repeaters = self.table(RepeaterDetails, "repeaters")
+
+    @classmethod
+    def publish(cls, file_name=SHARED_INDEX_FILE, dmrid_file=DMRID_FILE, users_file=None,
+                rptrs_file=RPTRS_FILE, workers=None):
+        """ Build the indexes once (in parallel) and write them for the workers to attach """
+        index = ingest_dmrid(dmrid_file, workers)
+        details = None
+        if users_file is not None or dataset_exists(USER_CSV_FILE) or dataset_exists(USERS_JSON_FILE):
+            details = ingest_users(users_file, workers)[1]
+        repeaters = RepeaterDetails.load(rptrs_file)
+        id_lists = [index.ids] + ([repeaters.ids] if repeaters is not None else [])
+        write_index(file_name, index, IdBitmap.from_ids(*id_lists), details, repeaters)
+        return cls(file_name)
+
+    def section(self, name):
+        """ Read-only memoryview of a section, cast to its typecode """
+        offset, nbytes, typecode = self.sections[name]
+        start = self.data_start + offset
+        view = self.views[0][start:start + nbytes]
+        self.views.append(view)
+        if typecode != "B":
+            view = view.cast(typecode)
+            self.views.append(view)
+        return view
+
+    def strings(self, name):
+        return StringColumn(self.section(f"{name}.blob"), self.section(f"{name}.offsets"))
+
+    def table(self, cls, prefix):
+        if f"{prefix}.ids" not in self.sections:
+            return None
+        return cls(self.section(f"{prefix}.ids"), [self.strings(f"{prefix}.{field}") for field in cls.FIELDS])
+
+    def resolver(self, cache_size=RESOLVER_CACHE_SIZE):
+        """ Resolver of this process over the shared indexes (the LRU stays per process) """
+        return Resolver(self.index, self.details, cache_size, bitmap=self.bitmap)
+
+    @property
+    def nbytes(self):
+        return len(self.map)
+
+    def close(self):
+        """ Unmap the file, the index objects must not be used afterwards """
+        for view in reversed(self.views):
+            view.release()
+        self.views = list()
+        self.map.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish the registry indexes for several "
+                                                 "processes, or look up IDs through them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    publish_parser = subparsers.add_parser("publish", help="build and write the shared index")
+    publish_parser.add_argument("--users", default=None, help="user.csv or users.json")
+    publish_parser.add_argument("--workers", type=int, default=None, help="ingest processes")
+    lookup_parser = subparsers.add_parser("lookup", help="resolve DMR IDs through the shared index")
+    lookup_parser.add_argument("ids", nargs="+", type=int)
+    parser.add_argument("--file", default=SHARED_INDEX_FILE, help="shared index file")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.command == "publish":
+        shared = SharedIndex.publish(args.file, users_file=args.users, workers=args.workers)
+        print(f"{args.file}: {len(shared.index)} users, "
+              f"{len(shared.repeaters) if shared.repeaters is not None else 0} repeaters, "
+              f"{shared.nbytes / 1e6:.1f} MB in {(perf_counter() - start) * 1000:.0f} ms")
+    elif args.command == "lookup":
+        if not isfile(args.file):
+            parser.error(f"{args.file} does not exist, run publish first")
+        shared = SharedIndex(args.file)
+        print(f"attached {args.file} in {(perf_counter() - start) * 1000:.2f} ms")
+        resolver = shared.resolver()
+        for dmr_id in args.ids:
+            result = resolver.resolve(dmr_id)
+            if result is None and shared.repeaters is not None:
+                result = shared.repeaters.get(dmr_id)
+            print(f"{dmr_id}: {result}")
+    shared.close()
+
+
+if __name__ == "__main__":
+    main()
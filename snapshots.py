@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID snapshot archive: every downloaded version, as intervals #
+######################################################################
+import json
+import sqlite3
+import argparse
+from os import remove
+from os.path import basename, getmtime, isfile
+from time import time
+from datetime import datetime
+
+from blockstore import source_records, file_sha256
+
+HISTORY_FILE = "./data_files/history.sqlite"
+SNAPSHOT_DATASETS = ["dmrid.dat", "rptrs.json"]
+PREVIOUS_SUFFIX = ".previous"
+# A record is stored once per interval of snapshots where it did not change:
+# the archive grows with the churn between downloads, not with their size.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    taken REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    records INTEGER NOT NULL,
+    added INTEGER NOT NULL,
+    changed INTEGER NOT NULL,
+    removed INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS snapshots_taken ON snapshots (dataset, taken);
+CREATE TABLE IF NOT EXISTS datasets (
+    code INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS intervals (
+    code INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    valid_from INTEGER NOT NULL,
+    valid_to INTEGER,
+    record TEXT NOT NULL,
+    PRIMARY KEY (code, id, valid_from)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS intervals_from ON intervals (code, valid_from);
+CREATE INDEX IF NOT EXISTS intervals_to ON intervals (code, valid_to);
+"""
+
+
+def parse_date(text):
+    """ Epoch of "YYYY-MM-DD" or "YYYY-MM-DD HH:MM[:SS]", the end of the day for a bare date """
+    if len(text) == 10:
+        text += " 23:59:59"
+    return datetime.fromisoformat(text).timestamp()
+
+
+def format_date(taken):
+    return datetime.fromtimestamp(taken).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SnapshotArchive:
+    """ Versions of dmrid.dat and rptrs.json as (id, record, first snapshot, end snapshot) intervals """
+
+    def __init__(self, file_name=HISTORY_FILE):
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name, check_same_thread=False, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def code(self, dataset, create=False):
+        """ Small integer of a dataset name in the intervals table, None if never archived """
+        if create:
+            self.connection.execute("INSERT OR IGNORE INTO datasets (dataset) VALUES (?)", (dataset,))
+        row = self.connection.execute("SELECT code FROM datasets WHERE dataset = ?", (dataset,)).fetchone()
+        return row[0] if row is not None else None
+
+    # ####### Recording
+    def latest(self, dataset):
+        row = self.connection.execute("SELECT snapshot, taken, sha256 FROM snapshots WHERE dataset = ? "
+                                      "ORDER BY snapshot DESC LIMIT 1", (dataset,)).fetchone()
+        return row
+
+    def record(self, file_name, taken=None, dataset=None):
+        """ Archive a version of a dataset, returns its summary, None if it did not change """
+        dataset = dataset or basename(file_name)
+        taken = taken if taken is not None else time()
+        sha256 = file_sha256(file_name)
+        latest = self.latest(dataset)
+        if latest is not None:
+            if latest[2] == sha256:
+                return None
+            if taken < latest[1]:
+                raise ValueError(f"{dataset}: a newer version ({format_date(latest[1])}) is already archived")
+
+        kind, _, records = source_records(file_name, dataset)
+        current = {dmr_id: payload for dmr_id, _, payload in records}
+        code = self.code(dataset, create=True)
+        previous = dict(self.connection.execute("SELECT id, record FROM intervals "
+                                                "WHERE code = ? AND valid_to IS NULL", (code,)))
+        added = [dmr_id for dmr_id in current if dmr_id not in previous]
+        changed = [dmr_id for dmr_id, payload in current.items()
+                   if dmr_id in previous and previous[dmr_id] != payload]
+        removed = [dmr_id for dmr_id in previous if dmr_id not in current]
+
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO snapshots (dataset, kind, taken, sha256, records, added, changed, removed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (dataset, kind, taken, sha256, len(current), len(added), len(changed), len(removed)))
+            snapshot = cursor.lastrowid
+            self.connection.executemany("UPDATE intervals SET valid_to = ? "
+                                        "WHERE code = ? AND id = ? AND valid_to IS NULL",
+                                        ((snapshot, code, dmr_id) for dmr_id in changed + removed))
+            self.connection.executemany("INSERT INTO intervals (code, id, valid_from, record) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        ((code, dmr_id, snapshot, current[dmr_id])
+                                         for dmr_id in sorted(added + changed)))
+        return {"dataset": dataset, "snapshot": snapshot, "taken": taken, "records": len(current),
+                "added": len(added), "changed": len(changed), "removed": len(removed)}
+
+    def record_previous(self, file_name, dataset=None):
+        """ Archive the version a download replaced (kept as *.previous) unless the archive already
+        holds it or a newer version, then remove it, returns its summary or None """
+        previous = file_name + PREVIOUS_SUFFIX
+        if not isfile(previous):
+            return None
+        dataset = dataset or basename(file_name)
+        taken = getmtime(previous)
+        latest = self.latest(dataset)
+        result = None
+        if latest is None or taken >= latest[1]:
+            result = self.record(previous, taken, dataset)
+        remove(previous)
+        return result
+
+    # ####### Queries
+    def snapshots(self, dataset=None):
+        sql = "SELECT snapshot, dataset, taken, records, added, changed, removed FROM snapshots"
+        parameters = ()
+        if dataset is not None:
+            sql += " WHERE dataset = ?"
+            parameters = (dataset,)
+        fields = ["snapshot", "dataset", "taken", "records", "added", "changed", "removed"]
+        rows = self.connection.execute(sql + " ORDER BY snapshot", parameters)
+        return [dict(zip(fields, row)) for row in rows]
+
+    def snapshot_at(self, dataset, taken):
+        """ Last snapshot of `dataset` taken at or before `taken`, None if none """
+        row = self.connection.execute("SELECT snapshot FROM snapshots WHERE dataset = ? AND taken <= ? "
+                                      "ORDER BY taken DESC LIMIT 1", (dataset, taken)).fetchone()
+        return row[0] if row is not None else None
+
+    def lookup(self, dataset, dmr_id, taken):
+        """ Record of `dmr_id` in the version of `dataset` current at `taken`, None if unknown then """
+        snapshot = self.snapshot_at(dataset, taken)
+        if snapshot is None:
+            return None
+        row = self.connection.execute("SELECT record FROM intervals WHERE code = ? AND id = ? "
+                                      "AND valid_from <= ? AND (valid_to IS NULL OR valid_to > ?) "
+                                      "ORDER BY valid_from DESC LIMIT 1",
+                                      (self.code(dataset), dmr_id, snapshot, snapshot)).fetchone()
+        return row[0] if row is not None else None
+
+    def history(self, dataset, dmr_id):
+        """ [(from date, to date or None, record)] of `dmr_id` """
+        sql = "SELECT first.taken, last.taken, record FROM intervals " \
+              "JOIN snapshots AS first ON first.snapshot = valid_from " \
+              "LEFT JOIN snapshots AS last ON last.snapshot = valid_to " \
+              "WHERE code = ? AND id = ? ORDER BY valid_from"
+        return list(self.connection.execute(sql, (self.code(dataset), dmr_id)))
+
+    def changes(self, dataset, start, end):
+        """ [(id, record before, record after)] of the IDs added, changed or removed
+        between the versions current at `start` and at `end` """
+        first = self.snapshot_at(dataset, start) or 0
+        last = self.snapshot_at(dataset, end) or 0
+        if last <= first:
+            return []
+        # only the intervals opened or closed in (first, last] can differ
+        sql = "SELECT id, record, valid_from, valid_to FROM intervals WHERE code = ? " \
+              "AND ((valid_from > ? AND valid_from <= ?) OR (valid_to > ? AND valid_to <= ?))"
+        before = dict()
+        after = dict()
+        rows = self.connection.execute(sql, (self.code(dataset), first, last, first, last))
+        for dmr_id, record, valid_from, valid_to in rows:
+            if valid_from <= first:
+                before[dmr_id] = record
+            if valid_from <= last and (valid_to is None or valid_to > last):
+                after[dmr_id] = record
+        return [(dmr_id, before.get(dmr_id), after.get(dmr_id))
+                for dmr_id in sorted(set(before) | set(after))
+                if before.get(dmr_id) != after.get(dmr_id)]
+
+
+def record_download(file_name, archive_file=HISTORY_FILE):
+    """ Archive a fresh download, and first the version it replaced (kept as *.previous)
+    if it was never archived, the previous file is removed once recorded """
+    archive = SnapshotArchive(archive_file)
+    try:
+        dataset = basename(file_name)
+        results = [archive.record_previous(file_name, dataset), archive.record(file_name, dataset=dataset)]
+        return [result for result in results if result is not None]
+    finally:
+        archive.close()
+
+
+def archive_previous(file_name, archive_file=HISTORY_FILE):
+    """ Archive and remove the *.previous left by a download that was not indexed (sync --no-index)
+    before a new download takes its place """
+    archive = SnapshotArchive(archive_file)
+    try:
+        return archive.record_previous(file_name)
+    finally:
+        archive.close()
+
+
+def format_record(record):
+    if record is None:
+        return "-"
+    if record.startswith("{"):
+        record = json.loads(record)
+        return " ".join(str(record.get(field) or "") for field in ("callsign", "city", "country", "frequency",
+                                                                  "trustee"))
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History of the dmrid.dat and rptrs.json downloads")
+    parser.add_argument("--archive", default=HISTORY_FILE, help="history database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="archive versions of datasets")
+    record_parser.add_argument("files", nargs="+")
+    record_parser.add_argument("--date", default=None, help="date of the version (default: now)")
+    subparsers.add_parser("list", help="archived versions")
+    at_parser = subparsers.add_parser("at", help="records of IDs at a date")
+    at_parser.add_argument("dataset", choices=SNAPSHOT_DATASETS)
+    at_parser.add_argument("date")
+    at_parser.add_argument("ids", nargs="+", type=int)
+    history_parser = subparsers.add_parser("history", help="every record of an ID")
+    history_parser.add_argument("dataset", choices=SNAPSHOT_DATASETS)
+    history_parser.add_argument("id", type=int)
+    changes_parser = subparsers.add_parser("changes", help="IDs added, changed or removed between two dates")
+    changes_parser.add_argument("dataset", choices=SNAPSHOT_DATASETS)
+    changes_parser.add_argument("start")
+    changes_parser.add_argument("end")
+    args = parser.parse_args()
+
+    archive = SnapshotArchive(args.archive)
+    if args.command == "record":
+        for file_name in args.files:
+            result = archive.record(file_name, parse_date(args.date) if args.date else None)
+            if result is None:
+                print(f"{file_name}: unchanged")
+            else:
+                print(f"{file_name}: snapshot {result['snapshot']}, {result['records']} records, "
+                      f"+{result['added']} ~{result['changed']} -{result['removed']}")
+    elif args.command == "list":
+        for snapshot in archive.snapshots():
+            print(f"{snapshot['snapshot']:5d} {snapshot['dataset']:12s} {format_date(snapshot['taken'])} "
+                  f"{snapshot['records']} records, "
+                  f"+{snapshot['added']} ~{snapshot['changed']} -{snapshot['removed']}")
+    elif args.command == "at":
+        taken = parse_date(args.date)
+        for dmr_id in args.ids:
+            print(f"{dmr_id}: {format_record(archive.lookup(args.dataset, dmr_id, taken))}")
+    elif args.command == "history":
+        for first, last, record in archive.history(args.dataset, args.id):
+            print(f"{format_date(first)} -> {format_date(last) if last else 'now':19s} {format_record(record)}")
+    elif args.command == "changes":
+        for dmr_id, before, after in archive.changes(args.dataset, parse_date(args.start), parse_date(args.end)):
+            print(f"{dmr_id}: {format_record(before)} -> {format_record(after)}")
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
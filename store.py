@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID local database: SQLite + FTS5 store of the data_files    #
+######################################################################
+import csv
+import json
+import sqlite3
+from array import array
+from collections import OrderedDict
+from os.path import isfile
+
+from registry import DMRID_FILE, RPTRS_FILE, USER_CSV_FILE, USERS_JSON_FILE
+from blockstore import dataset_exists, open_dataset
+from metrics import METRICS
+
+DB_FILE = "./data_files/registry.sqlite"
+BATCH_SIZE = 50000
+USER_FIELDS = ["id", "callsign", "fname", "surname", "city", "state", "country"]
+RPT_FIELDS = ["id", "callsign", "city", "state", "country", "frequency", "color_code",
+              "offset", "assigned", "ts_linked", "trustee", "ipsc_network"]
+# Search type of the combo boxes -> column
+FILTER_FIELDS = {"DMR ID of a user": "id",
+                 "DMR user callsign": "callsign",
+                 "City": "city",
+                 "Country": "country",
+                 "DMR Repeater ID": "id",
+                 "Repeater callsign": "callsign",
+                 "Repeater city": "city",
+                 "Repeater country": "country"}
+FTS_FIELDS = {"user": ["city", "state", "country", "surname"],
+              "repeater": ["city", "state", "country", "trustee"]}
+TABLES = {"user": "users", "repeater": "repeaters"}
+# dmrid.dat, users.json and user.csv all fill the users table: each row keeps a bit per file holding it
+USER_SOURCES = {".dat": 1, ".json": 2, ".csv": 4}
+ALL_USER_SOURCES = sum(USER_SOURCES.values())
+RESULT_CACHE_BUDGET = 16 * 1024 * 1024
+# Approximate bytes of an entry besides its ID array (key tuple, array header, LRU link)
+RESULT_CACHE_OVERHEAD = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    callsign TEXT NOT NULL,
+    fname TEXT NOT NULL DEFAULT '',
+    surname TEXT NOT NULL DEFAULT '',
+    city TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT '',
+    country TEXT NOT NULL DEFAULT '',
+    sources INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS users_callsign ON users (callsign, id);
+CREATE INDEX IF NOT EXISTS users_city ON users (city COLLATE NOCASE, country COLLATE NOCASE, id);
+CREATE INDEX IF NOT EXISTS users_country ON users (country COLLATE NOCASE, city COLLATE NOCASE, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5 (
+    city, state, country, surname, content='users', content_rowid='id');
+CREATE TABLE IF NOT EXISTS repeaters (
+    id INTEGER PRIMARY KEY,
+    callsign TEXT NOT NULL,
+    city TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT '',
+    country TEXT NOT NULL DEFAULT '',
+    frequency TEXT NOT NULL DEFAULT '',
+    color_code INTEGER,
+    offset TEXT NOT NULL DEFAULT '',
+    assigned TEXT NOT NULL DEFAULT '',
+    ts_linked TEXT NOT NULL DEFAULT '',
+    trustee TEXT NOT NULL DEFAULT '',
+    ipsc_network TEXT NOT NULL DEFAULT '');
+CREATE INDEX IF NOT EXISTS repeaters_callsign ON repeaters (callsign, id);
+CREATE INDEX IF NOT EXISTS repeaters_city ON repeaters (city COLLATE NOCASE, country COLLATE NOCASE, id);
+CREATE INDEX IF NOT EXISTS repeaters_country ON repeaters (country COLLATE NOCASE, state COLLATE NOCASE, id);
+CREATE INDEX IF NOT EXISTS repeaters_trustee ON repeaters (trustee, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS repeaters_fts USING fts5 (
+    city, state, country, trustee, content='repeaters', content_rowid='id');
+"""
+
+
+def user_source(file_name):
+    """ Bit of a users dataset in the sources column """
+    return USER_SOURCES["." + file_name.rpartition(".")[2]]
+
+
+def batched(rows, size=BATCH_SIZE):
+    batch = list()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def id_prefix_ranges(prefix, max_length=7):
+    """ [(low, high)] ID ranges of the IDs written with `prefix` (1 to 7 digits) """
+    ranges = list()
+    for length in range(max(len(prefix), 1), max_length + 1):
+        scale = 10 ** (length - len(prefix))
+        low = int(prefix or "0") * scale
+        ranges.append((max(low, 10 ** (length - 1) if length > 1 else 0), low + scale - 1))
+    return ranges
+
+
+def normalize_filters(table, filters):
+    """ Hashable key of `filters`: columns and values as SQL compares them, in a stable order """
+    normalized = list()
+    for search_type, value in filters:
+        field = FILTER_FIELDS[search_type]
+        value = value.strip()
+        # callsigns are stored upper case, the other text columns compare NOCASE
+        value = value.upper() if field == "callsign" else value.lower()
+        normalized.append((field, value))
+    return table, tuple(sorted(normalized))
+
+
+class ResultCache:
+    """ LRU of the ID arrays of recent searches, bounded in bytes and
+    emptied when the store generation changes """
+
+    def __init__(self, budget=RESULT_CACHE_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self.entries:
+                METRICS.count("result cache invalidations")
+            self.clear()
+            self.generation = generation
+
+    def get(self, generation, key):
+        """ Cached IDs of `key`, None if the search must run """
+        self._check_generation(generation)
+        ids = self.entries.get(key)
+        if ids is None:
+            self.misses += 1
+            METRICS.count("result cache misses")
+            return None
+        self.hits += 1
+        METRICS.count("result cache hits")
+        self.entries.move_to_end(key)
+        return ids
+
+    def put(self, generation, key, ids):
+        self._check_generation(generation)
+        ids = array("I", ids)
+        size = len(ids) * ids.itemsize + RESULT_CACHE_OVERHEAD
+        if size > self.budget:
+            return ids
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.nbytes -= len(old) * old.itemsize + RESULT_CACHE_OVERHEAD
+        self.entries[key] = ids
+        self.nbytes += size
+        while self.nbytes > self.budget:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= len(old) * old.itemsize + RESULT_CACHE_OVERHEAD
+            self.evictions += 1
+        return ids
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return {"entries": len(self.entries), "nbytes": self.nbytes, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "hit_ratio": self.hit_ratio,
+                "evictions": self.evictions, "generation": self.generation}
+
+
+class RegistryStore:
+    """ Persistent SQLite registry of users and repeaters with FTS5 indexes """
+
+    def __init__(self, file_name=DB_FILE, cache_budget=RESULT_CACHE_BUDGET):
+        self.file_name = file_name
+        self.cache = ResultCache(cache_budget)
+        self.connection = sqlite3.connect(file_name, check_same_thread=False, cached_statements=256)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA temp_store=MEMORY")
+        self.connection.execute("PRAGMA mmap_size=268435456")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(users)")]
+        if "sources" not in columns:
+            # database of an older version: its rows may come from any file
+            self.connection.execute(f"ALTER TABLE users ADD COLUMN sources INTEGER NOT NULL "
+                                    f"DEFAULT {ALL_USER_SOURCES}")
+
+    @staticmethod
+    def exists(file_name=DB_FILE):
+        return isfile(file_name)
+
+    def close(self):
+        self.connection.close()
+
+    # ####### Metadata
+    def generation(self):
+        """ Counter bumped by every ingest, the cached results of older generations are stale """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def counts(self):
+        return {"users": self.connection.execute("SELECT count(*) FROM users").fetchone()[0],
+                "repeaters": self.connection.execute("SELECT count(*) FROM repeaters").fetchone()[0]}
+
+    # ####### Bulk ingest
+    def _ingest(self, table, sql, rows, source=None):
+        """ One transaction: secondary indexes are dropped, rows inserted in ID order, the IDs
+        missing from the new file deleted, then the indexes and the FTS5 table are rebuilt
+        in one pass each. The file is parsed first: a bad record leaves the table untouched.
+        With a `source` bit only the rows no other file holds are deleted """
+        rows = sorted(rows)
+        ids = {row[0] for row in rows}
+        connection = self.connection
+        indexes = connection.execute("SELECT sql, name FROM sqlite_master WHERE type = 'index' "
+                                     "AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()
+        connection.execute("PRAGMA synchronous=OFF")
+        try:
+            # explicit BEGIN: the sqlite3 module would let DROP INDEX autocommit
+            connection.execute("BEGIN")
+            with connection:
+                if source is None:
+                    removed = [(dmr_id,) for (dmr_id,) in connection.execute(f"SELECT id FROM {table}")
+                               if dmr_id not in ids]
+                    connection.executemany(f"DELETE FROM {table} WHERE id = ?", removed)
+                else:
+                    removed = [(dmr_id,) for (dmr_id,) in connection.execute(
+                        f"SELECT id FROM {table} WHERE sources & ?", (source,)) if dmr_id not in ids]
+                    connection.executemany(f"UPDATE {table} SET sources = sources & ~{source} WHERE id = ?",
+                                           removed)
+                    connection.execute(f"DELETE FROM {table} WHERE sources = 0")
+                for _, name in indexes:
+                    connection.execute(f"DROP INDEX {name}")
+                for batch in batched(rows):
+                    connection.executemany(sql, batch)
+                for index_sql, _ in indexes:
+                    connection.execute(index_sql)
+                connection.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+                connection.execute("INSERT INTO meta (key, value) VALUES ('generation', '1') "
+                                   "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        finally:
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+    def ingest_dmrid(self, file_name=DMRID_FILE):
+        """ dmrid.dat only has callsigns: the details already ingested are kept """
+        def rows():
+            with open_dataset(file_name, binary=True) as file_path:
+                for line in file_path:
+                    fields = line.split(b";")
+                    if len(fields) >= 2 and fields[0].strip().isdigit():
+                        yield int(fields[0]), fields[1].strip().decode("utf-8", "replace").upper()
+
+        source = user_source(file_name)
+        self._ingest("users", f"INSERT INTO users (id, callsign, sources) VALUES (?, ?, {source}) "
+                              f"ON CONFLICT(id) DO UPDATE SET callsign = excluded.callsign, "
+                              f"sources = sources | {source}", rows(), source)
+
+    def ingest_users(self, file_name=None):
+        """ user.csv or users.json, full user records """
+        if file_name is None:
+            file_name = USER_CSV_FILE if dataset_exists(USER_CSV_FILE) else USERS_JSON_FILE
+
+        def rows():
+            if file_name.endswith(".json"):
+                with open_dataset(file_name) as file_path:
+                    users = json.load(file_path)["users"]
+                for user in users:
+                    yield (int(user["radio_id"] if "radio_id" in user else user["id"]),
+                           (user.get("callsign") or "").upper(), user.get("fname") or "",
+                           user.get("surname") or "", user.get("city") or "",
+                           user.get("state") or "", user.get("country") or "")
+            else:
+                with open_dataset(file_name) as file_path:
+                    reader = csv.reader(file_path)
+                    next(reader, None)
+                    for row in reader:
+                        if len(row) >= 7 and row[0].isdigit():
+                            yield int(row[0]), row[1].upper(), row[2], row[3], row[4], row[5], row[6]
+
+        source = user_source(file_name)
+        updates = ", ".join(f"{field} = excluded.{field}" for field in USER_FIELDS[1:])
+        self._ingest("users", f"INSERT INTO users ({', '.join(USER_FIELDS)}, sources) "
+                              f"VALUES (?, ?, ?, ?, ?, ?, ?, {source}) "
+                              f"ON CONFLICT(id) DO UPDATE SET {updates}, sources = sources | {source}",
+                     rows(), source)
+
+    def ingest_repeaters(self, file_name=RPTRS_FILE):
+        def rows():
+            with open_dataset(file_name) as file_path:
+                repeaters = json.load(file_path)["rptrs"]
+            for repeater in repeaters:
+                yield tuple([int(repeater["id"])] +
+                            [repeater.get(field) if field == "color_code" else str(repeater.get(field) or "")
+                             for field in RPT_FIELDS[1:]])
+
+        placeholders = ", ".join("?" for _ in RPT_FIELDS)
+        self._ingest("repeaters", f"INSERT OR REPLACE INTO repeaters ({', '.join(RPT_FIELDS)}) "
+                                  f"VALUES ({placeholders})", rows())
+
+    def ingest_all(self):
+        """ Ingest every dataset present in data_files, returns the names of the ingested files """
+        ingested = list()
+        if dataset_exists(DMRID_FILE):
+            self.ingest_dmrid()
+            ingested.append(DMRID_FILE)
+        for file_name in (USERS_JSON_FILE, USER_CSV_FILE):
+            if dataset_exists(file_name):
+                self.ingest_users(file_name)
+                ingested.append(file_name)
+        if dataset_exists(RPTRS_FILE):
+            self.ingest_repeaters()
+            ingested.append(RPTRS_FILE)
+        self.connection.execute("PRAGMA optimize")
+        return ingested
+
+    # ####### Queries
+    @staticmethod
+    def _condition(table, field, value):
+        """ SQL condition and parameters of one filter, RadioID semantics: % is a wildcard """
+        value = value.strip()
+        if field == "id":
+            if "%" not in value:
+                return "id = ?", [int(value)]
+            prefix, _, rest = value.partition("%")
+            if rest == "":
+                ranges = id_prefix_ranges(prefix)
+                return "(" + " OR ".join("id BETWEEN ? AND ?" for _ in ranges) + ")", \
+                       [bound for pair in ranges for bound in pair]
+            return "CAST(id AS TEXT) LIKE ?", [value]
+
+        if field == "callsign":
+            value = value.upper()
+            if "%" not in value:
+                return "callsign = ?", [value]
+            prefix, _, rest = value.partition("%")
+            if rest == "" and prefix:
+                return "callsign >= ? AND callsign < ?", [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+            return "callsign LIKE ?", [value]
+
+        if "%" not in value:
+            return f"{field} = ? COLLATE NOCASE", [value]
+        # only the text before a % at the start of a word is sure to start a token:
+        # "%ville" or "P%s" would need infix tokens that FTS5 does not index
+        words = [part.partition("%")[0] for part in value.split()]
+        words = [word for word in words if word.isalnum()]
+        if words and field in FTS_FIELDS[table]:
+            # FTS5 prefix match narrows the rows, LIKE keeps the RadioID semantics
+            match = " ".join(f'{field} : "{word}"*' for word in words)
+            return f"id IN (SELECT rowid FROM {TABLES[table]}_fts WHERE {TABLES[table]}_fts MATCH ?) " \
+                   f"AND {field} LIKE ?", [match, value]
+        return f"{field} LIKE ?", [value]
+
+    def search_ids(self, table, filters):
+        """ Sorted IDs matching all `filters`, a list of (search type, value) """
+        conditions = list()
+        parameters = list()
+        for search_type, value in filters:
+            condition, values = self._condition(table, FILTER_FIELDS[search_type], value)
+            conditions.append(condition)
+            parameters += values
+        sql = f"SELECT id FROM {TABLES[table]} WHERE {' AND '.join(conditions)} ORDER BY id"
+        return [row[0] for row in self.connection.execute(sql, parameters)]
+
+    def fetch(self, table, ids):
+        """ Rows of the sorted `ids` as RadioID API result dicts """
+        fields = USER_FIELDS if table == "user" else RPT_FIELDS
+        sql = f"SELECT {', '.join(fields)} FROM {TABLES[table]} " \
+              f"WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id"
+        return [dict(row) for row in self.connection.execute(sql, (json.dumps(list(ids)),))]
+
+    def cached_search_ids(self, table, filters):
+        """ search_ids through the result cache of the current generation """
+        generation = self.generation()
+        key = normalize_filters(table, filters)
+        ids = self.cache.get(generation, key)
+        if ids is None:
+            ids = self.cache.put(generation, key, self.search_ids(table, filters))
+        return ids
+
+    def search(self, table, filters):
+        """ Same answer layout as the RadioID API: {"count": n, "results": [...]} """
+        results = self.fetch(table, self.cached_search_ids(table, filters))
+        return {"count": len(results), "results": results}
+
+    def text_search(self, table, text, limit=1000):
+        """ Free text FTS5 search on city, state, country and surname (or trustee) """
+        words = [word for word in text.split() if word.isalnum()]
+        if not words:
+            return []
+        match = " ".join(f'"{word}"*' for word in words)
+        sql = f"SELECT rowid FROM {TABLES[table]}_fts WHERE {TABLES[table]}_fts MATCH ? ORDER BY rank LIMIT ?"
+        return [row[0] for row in self.connection.execute(sql, (match, limit))]
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID dataset sync: concurrent downloads and index rebuild     #
+######################################################################
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+from os.path import basename, isfile, getsize
+from time import perf_counter
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from registry import DMRID_FILE, RPTRS_FILE, USER_CSV_FILE, USERS_JSON_FILE
+from store import RegistryStore
+from blockstore import BLOCK_SUFFIX, BlockStore, compact
+from snapshots import record_download, archive_previous, file_sha256, SNAPSHOT_DATASETS, PREVIOUS_SUFFIX
+
+DATASETS = [("https://radioid.net/static/dmrid.dat", DMRID_FILE),
+            ("https://radioid.net/static/rptrs.json", RPTRS_FILE),
+            ("https://radioid.net/static/user.csv", USER_CSV_FILE),
+            ("https://radioid.net/static/users.json", USERS_JSON_FILE)]
+SYNC_STATE_FILE = "./data_files/sync_state.json"
+MAX_PARALLEL_DOWNLOADS = 4
+CHUNK_SIZE = 256 * 1024
+TIMEOUT = 60
+PART_SUFFIX = ".part"
+
+
+class SyncError(Exception):
+    """ A dataset could not be downloaded or verified """
+
+
+def load_state(file_name=SYNC_STATE_FILE):
+    if not isfile(file_name):
+        return dict()
+    with open(file_name, "r") as file_path:
+        return json.load(file_path)
+
+
+def save_state(state, file_name=SYNC_STATE_FILE):
+    temp_name = file_name + PART_SUFFIX
+    with open(temp_name, "w") as file_path:
+        json.dump(state, file_path, indent=1)
+    os.replace(temp_name, file_name)
+
+
+def is_compacted(file_name):
+    """ Only the block store of the dataset is on disk """
+    return not isfile(file_name) and isfile(file_name + BLOCK_SUFFIX)
+
+
+def local_copy_matches(file_name, entry):
+    """ The file on disk is the one described by the sync state (so a 304 can be trusted) """
+    if entry is None:
+        return False
+    if is_compacted(file_name):
+        with BlockStore(file_name + BLOCK_SUFFIX) as store:
+            return store.source_size == entry.get("size") and store.source_sha256 == entry.get("sha256")
+    return (isfile(file_name) and getsize(file_name) == entry.get("size")
+            and file_sha256(file_name) == entry.get("sha256"))
+
+
+def download(url, file_name, entry=None, progress=None):
+    """ Download `url` in `file_name` unless unchanged, returns (status, new state entry)
+    status is "updated" or "unchanged", the previous file stays in place until verified """
+    name = basename(file_name)
+    request = Request(url)
+    if local_copy_matches(file_name, entry):
+        if entry.get("etag"):
+            request.add_header("If-None-Match", entry["etag"])
+        if entry.get("last_modified"):
+            request.add_header("If-Modified-Since", entry["last_modified"])
+
+    part_name = file_name + PART_SUFFIX
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with urlopen(request, timeout=TIMEOUT) as reply, open(part_name, "wb") as file_path:
+            total = int(reply.headers.get("Content-Length") or 0)
+            if progress is not None:
+                progress(name, "download", 0, total)
+            while True:
+                chunk = reply.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_path.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                if progress is not None:
+                    progress(name, "download", size, total)
+            headers = reply.headers
+    except HTTPError as error:
+        if isfile(part_name):
+            os.remove(part_name)
+        if error.code == 304:
+            return "unchanged", entry
+        raise SyncError(f"{name}: HTTP {error.code} {error.reason}")
+    except (URLError, OSError) as error:
+        if isfile(part_name):
+            os.remove(part_name)
+        raise SyncError(f"{name}: {error}")
+
+    if total and size != total:
+        os.remove(part_name)
+        raise SyncError(f"{name}: truncated download ({size} of {total} bytes)")
+    if size == 0:
+        os.remove(part_name)
+        raise SyncError(f"{name}: empty download")
+    new_entry = {"url": url, "size": size, "sha256": digest.hexdigest(),
+                 "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+    if local_copy_matches(file_name, new_entry):
+        # server without validators: same bytes as the local copy
+        os.remove(part_name)
+        return "unchanged", new_entry
+
+    if name in SNAPSHOT_DATASETS and isfile(file_name):
+        if isfile(file_name + PREVIOUS_SUFFIX):
+            # left by a download that was not indexed: archived before it is replaced
+            try:
+                archive_previous(file_name)
+            except (sqlite3.Error, ValueError, OSError) as error:
+                os.remove(part_name)
+                raise SyncError(f"{name}: {basename(file_name + PREVIOUS_SUFFIX)} not archived: {error}")
+        # kept until the snapshot archive has recorded it
+        os.replace(file_name, file_name + PREVIOUS_SUFFIX)
+    os.replace(part_name, file_name)
+    return "updated", new_entry
+
+
+def build_indexes(file_name, compact_file=False):
+    """ Post download stage of one dataset: snapshot history, local database and,
+    when compacting, the block store that replaces the raw file """
+    steps = list()
+    name = basename(file_name)
+    if name in SNAPSHOT_DATASETS:
+        record_download(file_name)
+        steps.append("snapshot")
+    store = RegistryStore()
+    try:
+        if file_name == DMRID_FILE:
+            store.ingest_dmrid(file_name)
+        elif file_name == RPTRS_FILE:
+            store.ingest_repeaters(file_name)
+        else:
+            store.ingest_users(file_name)
+    finally:
+        store.close()
+    steps.append("database")
+    if compact_file:
+        compact(file_name)
+        steps.append("block store")
+    elif isfile(file_name + BLOCK_SUFFIX):
+        # packed from an older copy, the raw file is read first
+        os.remove(file_name + BLOCK_SUFFIX)
+    return steps
+
+
+class DatasetSync:
+    """ Download the datasets with a bounded pool, each file that lands is indexed
+    right away by a single post download worker (one SQLite writer) """
+
+    def __init__(self, datasets=None, workers=MAX_PARALLEL_DOWNLOADS, index=True,
+                 state_file=SYNC_STATE_FILE, progress=None, compact=False):
+        self.datasets = datasets if datasets is not None else DATASETS
+        self.workers = workers
+        self.index = index
+        # compacted datasets stay compacted, the others only are when asked
+        self.compact = compact
+        self.state_file = state_file
+        self.progress = progress
+
+    def notify(self, name, stage, done=0, total=0):
+        if self.progress is not None:
+            self.progress(name, stage, done, total)
+
+    def post_download(self, file_name, compact_file):
+        name = basename(file_name)
+        self.notify(name, "index")
+        start = perf_counter()
+        steps = build_indexes(file_name, compact_file)
+        self.notify(name, "done")
+        return steps, perf_counter() - start
+
+    def run(self):
+        """ {file name: {"status", "seconds", "indexed", "index_seconds", "error"}} """
+        state = load_state(self.state_file)
+        results = dict()
+        start = perf_counter()
+        compacted = {file_name: self.compact or is_compacted(file_name) for _, file_name in self.datasets}
+        with ThreadPoolExecutor(max_workers=self.workers) as downloads, \
+                ThreadPoolExecutor(max_workers=1) as post:
+            futures = {downloads.submit(download, url, file_name, state.get(file_name), self.progress): file_name
+                       for url, file_name in self.datasets}
+            post_futures = dict()
+            for future in as_completed(futures):
+                file_name = futures[future]
+                name = basename(file_name)
+                try:
+                    status, entry = future.result()
+                except SyncError as error:
+                    results[file_name] = {"status": "error", "error": str(error)}
+                    self.notify(name, "error")
+                    continue
+                results[file_name] = {"status": status, "seconds": perf_counter() - start}
+                # sha256 of the last copy indexed: a download not indexed yet, or whose build
+                # failed, is indexed by the next sync even if the server has nothing new
+                indexed = (state.get(file_name) or dict()).get("indexed")
+                if is_compacted(file_name):
+                    # only packed once built
+                    indexed = entry["sha256"]
+                state[file_name] = dict(entry, indexed=indexed)
+                if self.index and (status == "updated" or indexed != entry["sha256"]):
+                    post_futures[post.submit(self.post_download, file_name, compacted[file_name])] = (file_name, entry)
+                else:
+                    self.notify(name, status)
+
+            for future in as_completed(post_futures):
+                file_name, entry = post_futures[future]
+                try:
+                    steps, seconds = future.result()
+                except Exception as error:
+                    results[file_name]["status"] = "error"
+                    results[file_name]["error"] = f"{basename(file_name)}: indexing failed: {error}"
+                    self.notify(basename(file_name), "error")
+                    continue
+                state[file_name] = dict(entry, indexed=entry["sha256"])
+                results[file_name]["indexed"] = steps
+                results[file_name]["index_seconds"] = seconds
+                results[file_name]["seconds"] = perf_counter() - start
+        save_state(state, self.state_file)
+        return results
+
+
+def summary(results):
+    parts = list()
+    for file_name, result in results.items():
+        if result["status"] == "error":
+            parts.append(result["error"])
+        else:
+            parts.append(f"{basename(file_name)} {result['status']}")
+    return ", ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download every RadioID dataset that changed "
+                                                 "and rebuild the local indexes")
+    parser.add_argument("--workers", type=int, default=MAX_PARALLEL_DOWNLOADS, help="parallel downloads")
+    parser.add_argument("--no-index", action="store_true", help="only download")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep the updated datasets as block stores only, the raw files are removed")
+    args = parser.parse_args()
+
+    def progress(name, stage, done, total):
+        if stage != "download":
+            print(f"{name}: {stage}")
+
+    start = perf_counter()
+    results = DatasetSync(workers=args.workers, index=not args.no_index, progress=progress,
+                          compact=args.compact).run()
+    for file_name, result in results.items():
+        print(f"{file_name}: {result.get('error') or result['status']}"
+              f"{' (' + ', '.join(result['indexed']) + ')' if result.get('indexed') else ''}")
+    print(f"synced in {perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID synthetic datasets: dmrid.dat and rptrs.json at scale    #
+######################################################################
+import json
+import random
+import argparse
+from collections import Counter
+from os import makedirs
+from os.path import isfile, join
+from time import perf_counter
+
+import numpy as np
+
+from registry import DMRID_FILE, RPTRS_FILE, ID_DIGITS, prefix_bounds
+
+SYNTH_DIR = "./data_files/synth"
+PREFIX_DIGITS = 3
+REPEATER_DIGITS = 6
+# A full prefix takes over the nearest prefix without source IDs: the 692 free 3 digits
+# prefixes of the 7 digits space hold about 37 times the source users
+PREFIX_OWNERS_FILE = "prefixes.json"
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+DIGITS = "0123456789"
+CALLSIGN_RETRIES = 8
+RESERVOIR_SIZE = 256
+
+
+def split_callsign(callsign):
+    """ (prefix up to the last digit, suffix): "VE3THW" -> ("VE3", "THW") """
+    for position in range(len(callsign) - 1, -1, -1):
+        if callsign[position].isdigit():
+            return callsign[:position + 1], callsign[position + 1:]
+    return callsign[:2], callsign[2:]
+
+
+def apportion(counts, total):
+    """ Split `total` proportionally to `counts` ({key: count}), largest remainders first """
+    weight = sum(counts.values())
+    if weight == 0 or total <= 0:
+        return {}
+    exact = {key: count * total / weight for key, count in counts.items()}
+    shares = {key: int(value) for key, value in exact.items()}
+    left = total - sum(shares.values())
+    for key in sorted(exact, key=lambda key: shares[key] - exact[key])[:left]:
+        shares[key] += 1
+    return {key: share for key, share in shares.items() if share}
+
+
+class SourceModel:
+    """ What the generator keeps from the real datasets: ID prefixes, IDs per callsign,
+    callsign shapes and the repeater records with their ipsc_network strings """
+
+    def __init__(self, dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE):
+        self.user_lines = list()
+        self.repeater_lines = list()
+        self.prefix_callsigns = dict()
+        ids = list()
+        callsign_ids = Counter()
+        with open(dmrid_file, "r", encoding="utf-8", errors="replace") as file_path:
+            for line in file_path:
+                fields = line.split(";")
+                if len(fields) < 2 or not fields[0].strip().isdigit():
+                    continue
+                dmr_id = fields[0].strip()
+                ids.append(int(dmr_id))
+                if len(dmr_id) == REPEATER_DIGITS:
+                    self.repeater_lines.append(line)
+                    continue
+                callsign = fields[1].strip().upper()
+                self.user_lines.append(line)
+                self.prefix_callsigns.setdefault(dmr_id[:PREFIX_DIGITS], list()).append(callsign)
+                callsign_ids[callsign] += 1
+
+        with open(rptrs_file, "r", encoding="utf-8") as file_path:
+            self.repeaters = json.load(file_path)["rptrs"]
+        ids += [int(record["id"]) for record in self.repeaters if str(record["id"]).isdigit()]
+        self.taken = np.unique(np.array(ids, dtype=np.int64))
+        self.callsigns = set(callsign_ids)
+        self.prefix_counts = {prefix: len(callsigns) for prefix, callsigns in self.prefix_callsigns.items()}
+        # one entry per callsign: sampling it keeps the share of callsigns with several IDs
+        self.ids_per_callsign = list(callsign_ids.values())
+
+        self.networks = [record.get("ipsc_network") for record in self.repeaters]
+        network_counts = Counter(self.networks)
+        # share of the repeaters whose ipsc_network spelling is seen once, kept at every scale
+        single_networks = sum(1 for count in network_counts.values() if count == 1)
+        self.single_network_rate = single_networks / max(1, len(self.networks))
+        trustees = [(record.get("trustee") or "").strip().upper() for record in self.repeaters]
+        self.known_trustee_rate = sum(1 for trustee in trustees if trustee in self.callsigns) / max(1, len(trustees))
+        self.trustee_callsign_rate = sum(1 for record, trustee in zip(self.repeaters, trustees)
+                                         if (record.get("callsign") or "").strip().upper() == trustee
+                                         ) / max(1, len(trustees))
+
+    @property
+    def users(self):
+        return len(self.user_lines)
+
+    def taken_prefixes(self, length):
+        """ Prefixes holding source IDs of `length` digits """
+        low, high = 10 ** (length - 1), 10 ** length - 1
+        ids = self.taken[(self.taken >= low) & (self.taken <= high)]
+        return {str(prefix) for prefix in np.unique(ids // 10 ** (length - PREFIX_DIGITS))}
+
+
+class Generator:
+    """ New records shaped like the source ones, IDs allocated in order in each prefix """
+
+    def __init__(self, model, seed=0):
+        self.model = model
+        self.rng = random.Random(seed)
+        self.callsigns = set(model.callsigns)
+        self.cursors = dict()
+        # (prefix, length) -> prefix whose IDs it holds, and the prefixes each one has filled in order
+        self.owners = {(prefix, length): prefix for length in (ID_DIGITS, REPEATER_DIGITS)
+                       for prefix in model.taken_prefixes(length)}
+        self.regions = dict()
+        self.extra_letters = Counter()
+        self.reservoirs = dict()
+        self.seen = Counter()
+        self.network_counts = Counter(model.networks)
+        self.single_networks = sum(1 for count in self.network_counts.values() if count == 1)
+        self.bases = [network for network in model.networks if network]
+        for callsigns in model.prefix_callsigns.values():
+            for callsign in callsigns:
+                self.remember(callsign)
+
+    def remember(self, callsign):
+        """ Reservoir sample of the callsigns of each callsign prefix, the trustee candidates """
+        head = split_callsign(callsign)[0]
+        self.seen[head] += 1
+        reservoir = self.reservoirs.setdefault(head, list())
+        if len(reservoir) < RESERVOIR_SIZE:
+            reservoir.append(callsign)
+        else:
+            slot = self.rng.randrange(self.seen[head])
+            if slot < RESERVOIR_SIZE:
+                reservoir[slot] = callsign
+
+    def free_ids(self, prefix, count, length):
+        """ Up to `count` free IDs of `length` digits starting with `prefix`, in order """
+        low, high = prefix_bounds(prefix, length)
+        cursor = self.cursors.get((prefix, length), low)
+        taken = self.model.taken[np.searchsorted(self.model.taken, cursor):
+                                 np.searchsorted(self.model.taken, high, side="right")]
+        # holds `count` free IDs unless the end of the range comes first
+        block = np.arange(cursor, min(high, cursor + count + len(taken)) + 1)
+        block = block[~np.isin(block, taken)][:count]
+        self.cursors[(prefix, length)] = int(block[-1]) + 1 if len(block) == count else high + 1
+        return block
+
+    def claim(self, prefix, length):
+        """ The nearest prefix without IDs of `length` digits nor owner, now filled by `prefix` """
+        number = int(prefix)
+        first, last = 10 ** (PREFIX_DIGITS - 1), 10 ** PREFIX_DIGITS - 1
+        for distance in range(1, last - first + 1):
+            for candidate in (number + distance, number - distance):
+                if first <= candidate <= last and (str(candidate), length) not in self.owners:
+                    self.owners[(str(candidate), length)] = prefix
+                    return str(candidate)
+        raise ValueError(f"{length} digits ID space exhausted, use a smaller scale")
+
+    def allocate(self, prefix, count, length):
+        """ `count` free IDs of `length` digits in `prefix`, then in the prefixes it takes over """
+        self.owners.setdefault((prefix, length), prefix)
+        region = self.regions.setdefault((prefix, length), [prefix])
+        chunks = list()
+        position = 0
+        while count > 0:
+            if position == len(region):
+                region.append(self.claim(prefix, length))
+            block = self.free_ids(region[position], count, length)
+            chunks.append(block)
+            count -= len(block)
+            position += 1
+        return np.concatenate(chunks) if chunks else np.array([], dtype=np.int64)
+
+    def prefix_owners(self, length=ID_DIGITS):
+        """ {prefix taken over: source prefix} """
+        return {prefix: owner for (prefix, size), owner in self.owners.items() if size == length and prefix != owner}
+
+    def callsign(self, template):
+        """ New callsign with the prefix of `template` and a random suffix of the same shape """
+        head, suffix = split_callsign(template)
+        key = (head, len(suffix))
+        shape = (suffix or "A") + "A" * self.extra_letters[key]
+        for attempt in range(1, 1000):
+            callsign = head + "".join(self.rng.choice(DIGITS) if char.isdigit() else
+                                      self.rng.choice(LETTERS) if char.isalpha() else char
+                                      for char in shape)
+            if callsign not in self.callsigns:
+                self.callsigns.add(callsign)
+                return callsign
+            if attempt % CALLSIGN_RETRIES == 0:
+                # the short suffixes of this prefix are used up
+                shape += "A"
+                self.extra_letters[key] += 1
+        raise ValueError(f"no free callsign like {template}")
+
+    def users(self, count):
+        """ (id, callsign) of `count` new users, prefix by prefix in ID order """
+        quotas = apportion(self.model.prefix_counts, count)
+        for prefix in sorted(quotas):
+            ids = self.allocate(prefix, quotas[prefix], ID_DIGITS)
+            templates = self.model.prefix_callsigns[prefix]
+            row = 0
+            while row < len(ids):
+                callsign = self.callsign(self.rng.choice(templates))
+                self.remember(callsign)
+                size = self.rng.choice(self.model.ids_per_callsign)
+                for dmr_id in ids[row:row + size]:
+                    yield int(dmr_id), callsign
+                row += size
+
+    def trustee(self, template):
+        head = split_callsign((template or "").strip().upper())[0]
+        if head in self.reservoirs and self.rng.random() < self.model.known_trustee_rate:
+            return self.rng.choice(self.reservoirs[head])
+        return self.callsign((template or "").strip().upper())
+
+    def network(self):
+        """ An ipsc_network string: a real one, or a new spelling of one while the spellings
+        seen once are below their source share """
+        total = sum(self.network_counts.values()) + 1
+        if self.single_networks >= self.model.single_network_rate * total or not self.bases:
+            network = self.rng.choice(self.model.networks)
+        else:
+            network = self.spelling(self.rng.choice(self.bases))
+            for _ in range(CALLSIGN_RETRIES):
+                if network not in self.network_counts:
+                    break
+                network = self.spelling(self.rng.choice(self.bases))
+        count = self.network_counts[network] = self.network_counts[network] + 1
+        if count == 1:
+            self.single_networks += 1
+        elif count == 2:
+            self.single_networks -= 1
+        return network
+
+    def spelling(self, network):
+        """ A misspelling of `network` as found in rptrs.json """
+        edit = self.rng.randrange(6)
+        if edit == 0:
+            return network.lower()
+        if edit == 1:
+            return network.upper()
+        if edit == 2 and len(network) > 2:
+            position = self.rng.randrange(1, len(network) - 1)
+            return network[:position] + network[position + 1] + network[position] + network[position + 2:]
+        if edit == 3:
+            return f"{network} {self.rng.randrange(1, 10000)}"
+        if edit == 4:
+            return network.replace(" ", "-") if " " in network else f" {network} "
+        return network.title()
+
+    def repeaters(self, count):
+        """ `count` new rptrs.json records, copies of random real ones with new IDs and callsigns """
+        templates = [self.rng.choice(self.model.repeaters) for _ in range(count)]
+        by_prefix = dict()
+        for row, template in enumerate(templates):
+            by_prefix.setdefault(str(template["id"])[:PREFIX_DIGITS], list()).append(row)
+        ids = [0] * count
+        for prefix in sorted(by_prefix):
+            rows = by_prefix[prefix]
+            for row, dmr_id in zip(rows, self.allocate(prefix, len(rows), REPEATER_DIGITS)):
+                ids[row] = int(dmr_id)
+
+        for row in sorted(range(count), key=ids.__getitem__):
+            template = templates[row]
+            record = dict(template)
+            if record.get("locator") == record.get("id"):
+                record["locator"] = str(ids[row])
+            record["id"] = str(ids[row])
+            record["trustee"] = self.trustee(template.get("trustee"))
+            if self.rng.random() < self.model.trustee_callsign_rate:
+                record["callsign"] = record["trustee"]
+            else:
+                record["callsign"] = self.callsign((template.get("callsign") or "").strip().upper())
+            record["ipsc_network"] = self.network()
+            yield record
+
+
+def generate(scale, output_dir, seed=0, dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE, model=None):
+    """ Write dmrid.dat and rptrs.json with `scale` times the source records in `output_dir`
+    (the source records plus generated ones, in the source layout), returns their file names """
+    model = model or SourceModel(dmrid_file, rptrs_file)
+    generator = Generator(model, seed)
+    makedirs(output_dir, exist_ok=True)
+    dmrid_output = join(output_dir, "dmrid.dat")
+    rptrs_output = join(output_dir, "rptrs.json")
+    with open(dmrid_output, "w", encoding="utf-8") as dmrid_path, \
+            open(rptrs_output, "w", encoding="utf-8") as rptrs_path:
+        # dmrid.dat lists the users then the repeaters
+        dmrid_path.writelines(model.user_lines)
+        for dmr_id, callsign in generator.users(round(model.users * (scale - 1))):
+            dmrid_path.write(f"{dmr_id};{callsign};\n")
+        dmrid_path.writelines(model.repeater_lines)
+        rptrs_path.write('{"rptrs":[')
+        rptrs_path.write(",".join(json.dumps(record, separators=(",", ":")) for record in model.repeaters))
+        for record in generator.repeaters(round(len(model.repeaters) * (scale - 1))):
+            dmrid_path.write(f"{record['id']};{record['callsign']};\n")
+            rptrs_path.write(",")
+            rptrs_path.write(json.dumps(record, separators=(",", ":")))
+        rptrs_path.write("]}\n")
+    with open(join(output_dir, PREFIX_OWNERS_FILE), "w") as file_path:
+        json.dump(generator.prefix_owners(), file_path, indent=1, sort_keys=True)
+    return dmrid_output, rptrs_output
+
+
+def profile(dmrid_file=DMRID_FILE, rptrs_file=RPTRS_FILE, owners=None):
+    """ The statistics the generator keeps, to compare a synthetic dataset with the source,
+    the users of a prefix taken over counted in the prefix of `owners` that filled it """
+    owners = owners or dict()
+    with open(rptrs_file, "r", encoding="utf-8") as file_path:
+        repeaters = json.load(file_path)["rptrs"]
+    repeater_ids = {str(record["id"]) for record in repeaters}
+    networks = Counter(record.get("ipsc_network") for record in repeaters)
+    prefixes = Counter()
+    callsign_ids = Counter()
+    rows = 0
+    with open(dmrid_file, "r", encoding="utf-8", errors="replace") as file_path:
+        for line in file_path:
+            fields = line.split(";")
+            if len(fields) < 2 or not fields[0].strip().isdigit():
+                continue
+            rows += 1
+            if fields[0].strip() not in repeater_ids:
+                prefix = fields[0].strip()[:PREFIX_DIGITS]
+                prefixes[owners.get(prefix, prefix)] += 1
+                callsign_ids[fields[1].strip().upper()] += 1
+    users = sum(prefixes.values())
+    repeaters = sum(networks.values())
+    return {"rows": rows, "users": users, "repeaters": repeaters,
+            "prefixes": {prefix: count / users for prefix, count in prefixes.items()},
+            "duplicate_rate": sum(count for count in callsign_ids.values() if count > 1) / max(1, users),
+            "ids_per_callsign": users / max(1, len(callsign_ids)),
+            "networks": len(networks),
+            "single_networks": sum(1 for count in networks.values() if count == 1) / max(1, repeaters),
+            "top_networks": [(network, count / repeaters) for network, count in networks.most_common(5)]}
+
+
+def prefix_distance(first, second):
+    """ Total variation distance of two prefix distributions (0: identical, 1: disjoint) """
+    return sum(abs(first.get(prefix, 0) - second.get(prefix, 0)) for prefix in set(first) | set(second)) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaled up dmrid.dat and rptrs.json shaped like the real ones")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate_parser = subparsers.add_parser("generate", help="write synthetic datasets")
+    generate_parser.add_argument("scales", nargs="+", type=float, help="size in source sizes (10 for 10x)")
+    generate_parser.add_argument("--output", default=SYNTH_DIR, help="one x<scale> directory per scale in it")
+    generate_parser.add_argument("--seed", type=int, default=0)
+    profile_parser = subparsers.add_parser("profile", help="compare datasets with the source")
+    profile_parser.add_argument("directories", nargs="+", help="directories holding dmrid.dat and rptrs.json")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        model = SourceModel()
+        for scale in args.scales:
+            start = perf_counter()
+            output_dir = join(args.output, f"x{scale:g}")
+            generate(scale, output_dir, args.seed, model=model)
+            print(f"{output_dir}: {scale:g}x in {perf_counter() - start:.1f} s")
+    elif args.command == "profile":
+        source = profile()
+        for directory in ["source"] + args.directories:
+            owners = None
+            if directory != "source" and isfile(join(directory, PREFIX_OWNERS_FILE)):
+                with open(join(directory, PREFIX_OWNERS_FILE), "r") as file_path:
+                    owners = json.load(file_path)
+            stats = source if directory == "source" else profile(join(directory, "dmrid.dat"),
+                                                                  join(directory, "rptrs.json"), owners)
+            top = ", ".join(f"{network or repr(network)} {share:.1%}" for network, share in stats["top_networks"])
+            print(f"{directory}: {stats['users']} users, {stats['repeaters']} repeaters, "
+                  f"prefix distance {prefix_distance(source['prefixes'], stats['prefixes']):.4f}, "
+                  f"{stats['duplicate_rate']:.1%} of users share a callsign, "
+                  f"{stats['ids_per_callsign']:.3f} IDs per callsign, {stats['networks']} networks "
+                  f"({stats['single_networks']:.1%} seen once): {top}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+######################################################################
+# PyRadioID local database: ingest of several users datasets         #
+######################################################################
+import sys
+import json
+import unittest
+from os.path import dirname, join, abspath
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from store import RegistryStore  # noqa: E402
+
+
+class UsersSourcesTest(unittest.TestCase):
+    """ dmrid.dat, users.json and user.csv share the users table: no ingest drops the rows of another """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.dmrid_file = join(self.directory.name, "dmrid.dat")
+        self.csv_file = join(self.directory.name, "user.csv")
+        self.json_file = join(self.directory.name, "users.json")
+        with open(self.dmrid_file, "w") as file_path:
+            file_path.write("1234567;F4ABC;\n1234568;F4ABD;\n1234569;F4ABE;\n")
+        with open(self.csv_file, "w") as file_path:
+            file_path.write("RADIO_ID,CALLSIGN,FIRST_NAME,LAST_NAME,CITY,STATE,COUNTRY\n"
+                            "1234567,F4ABC,Jean,Dupont,Paris,,France\n"
+                            "2345678,DL1XYZ,Hans,Muller,Berlin,,Germany\n")
+        with open(self.json_file, "w") as file_path:
+            json.dump({"users": [{"radio_id": 3456789, "callsign": "k1abc", "fname": "Ann",
+                                  "surname": "Lee", "city": "Boston", "state": "MA",
+                                  "country": "United States"}]}, file_path)
+        self.store = RegistryStore(join(self.directory.name, "registry.sqlite"))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def ids(self):
+        return [row[0] for row in self.store.connection.execute("SELECT id FROM users ORDER BY id")]
+
+    def test_dmrid_then_csv(self):
+        self.store.ingest_dmrid(self.dmrid_file)
+        self.store.ingest_users(self.csv_file)
+        self.assertEqual(self.ids(), [1234567, 1234568, 1234569, 2345678])
+        self.assertEqual(self.store.fetch("user", [1234567])[0]["city"], "Paris")
+
+    def test_csv_then_dmrid(self):
+        self.store.ingest_users(self.csv_file)
+        self.store.ingest_dmrid(self.dmrid_file)
+        self.assertEqual(self.ids(), [1234567, 1234568, 1234569, 2345678])
+        # dmrid.dat only has callsigns: the details stay
+        self.assertEqual(self.store.fetch("user", [1234567])[0]["city"], "Paris")
+
+    def test_three_sources(self):
+        self.store.ingest_users(self.json_file)
+        self.store.ingest_dmrid(self.dmrid_file)
+        self.store.ingest_users(self.csv_file)
+        self.assertEqual(len(self.ids()), 5)
+
+    def test_removed_ids(self):
+        """ An ID gone from a file is deleted unless another file still holds it """
+        self.store.ingest_dmrid(self.dmrid_file)
+        self.store.ingest_users(self.csv_file)
+        with open(self.dmrid_file, "w") as file_path:
+            file_path.write("1234568;F4ABD;\n")
+        self.store.ingest_dmrid(self.dmrid_file)
+        self.assertEqual(self.ids(), [1234567, 1234568, 2345678])
+
+
+if __name__ == "__main__":
+    unittest.main()